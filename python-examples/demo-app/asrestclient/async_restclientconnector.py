@@ -0,0 +1,403 @@
+import asyncio
+import inspect
+import time
+
+import aiohttp
+
+from . import compression
+from . import constants
+from . import digest
+from . import predexp
+from . import streaming
+from . import wireformat
+from .restclientconnector import ASRestClientConnector
+from .restclientconnector import RestClientAPIError
+from .restclientconnector import RecordNotFoundError
+from .restclientconnector import RecordExistsError
+
+
+async def gather(aws, limit=100, return_exceptions=False):
+    '''Await a collection of coroutines with at most `limit` of them running at once.
+
+    The collection is consumed lazily, so it may be a generator producing far more coroutines
+    than should be in flight at the same time.
+
+    Args:
+        aws (iterable[awaitable]): The coroutines or futures to await.
+        limit (int) optional: The maximum number of awaitables in flight. Default: `100`
+        return_exceptions (bool) optional: If `True` exceptions are returned in place of results,
+            otherwise the first exception is raised once the awaitables in flight have been
+            cancelled, and the coroutines not yet started closed. Default: `False`
+    Returns:
+        list: The results of the awaitables, in the order they were supplied.
+    '''
+    source = iter(aws)
+    indexed = enumerate(source)
+    results = {}
+    errors = []
+    workers = []
+
+    async def worker():
+        # Each worker pulls the next awaitable from the shared iterator, this is safe as all
+        # workers run on the same event loop thread.
+        for index, aw in indexed:
+            try:
+                results[index] = await aw
+            except Exception as ex:
+                results[index] = ex
+                if not return_exceptions and not errors:
+                    errors.append(ex)
+                    for other in workers:
+                        if other is not asyncio.current_task():
+                            other.cancel()
+            if errors:
+                return
+
+    workers.extend(asyncio.ensure_future(worker()) for _ in range(limit))
+    # The workers cancelled after an error end with CancelledError, which is not raised
+    await asyncio.gather(*workers, return_exceptions=True)
+    if errors:
+        _close_unstarted(source)
+        raise errors[0]
+
+    return [results[index] for index in range(len(results))]
+
+
+def _close_unstarted(source):
+    '''Close the coroutines gather did not start, so they are not reported as never awaited'''
+    if inspect.isgenerator(source):
+        # Closing a generator stops it creating them at all
+        source.close()
+        return
+    for aw in source:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+
+
+class AsyncASRestClientConnector(object):
+    '''
+    Asyncio version of ASRestClientConnector, used to talk to Aerospike Rest Client
+    from within an event loop.
+    '''
+
+    def __init__(self, base_uri='http://localhost:8080', limit=100, limit_per_host=0,
+                 connect_timeout=None, read_timeout=None, max_batch_size=1000,
+                 wire_format=constants.JSON_WIRE_FORMAT, metrics=None, compression=None,
+                 limiter=None):
+        '''constructor
+           The constructor builds a base endpoint for RestClient operations of the form:
+           base_uri/v1
+           The underlying aiohttp session is created on first use, so the connector may be
+           constructed outside of a running event loop.
+        Args:
+            base_uri (str) optional: The address on which the Rest client is listening.
+                Default: `'http://localhost:8080'`
+            limit (int) optional: The maximum number of simultaneous connections. Default: `100`
+            limit_per_host (int) optional: The maximum number of simultaneous connections to a
+                single host, `0` means no per host limit. Default: `0`
+            connect_timeout (float) optional: Seconds to wait when establishing a connection.
+                Default: `None` (wait forever)
+            read_timeout (float) optional: Seconds to wait for the REST client to send a response.
+                Default: `None` (wait forever)
+            max_batch_size (int) optional: The maximum number of keys sent in a single batch
+                request. Larger batches are split and the parts are sent concurrently.
+                Default: `1000`
+            wire_format (str) optional: The encoding of request and response bodies, either `'json'` or
+                `'msgpack'`. Default: `'json'`
+            metrics (ConnectorMetrics) optional: Collects latency, byte, status code and error
+                metrics for every request. Default: `None`
+            compression (Compression) optional: Compresses large request bodies, and requests compressed
+                responses which are decompressed as they are read. Default: `None`
+            limiter (AsyncAdaptiveLimiter) optional: Limits the requests in flight, adapting the limit to
+                the REST client's latency and failures. Requests sent within `limiter.priority_lane()` are
+                admitted first. Default: `None`
+        Raises:
+            ValueError: If the wire_format is not supported.
+        '''
+
+        # Build the base rest endpoint: base_uri/v1
+        base_uri = base_uri + '/' if base_uri[-1] != '/' else base_uri
+        self.rest_endpoint = base_uri + 'v1'
+        self.kvs_endpoint = self.rest_endpoint + '/kvs'
+        self.operate_endpoint = self.rest_endpoint + '/operate'
+        self.batch_endpoint = self.rest_endpoint + '/batch'
+
+        self.max_batch_size = max_batch_size
+        self.wire_format = wire_format
+        self._headers = wireformat.get_headers(wire_format)
+        self.compression = compression
+        if compression is not None:
+            self._headers['Accept-Encoding'] = compression.accept_encoding_header
+        self.metrics = metrics
+        self.limiter = limiter
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+
+    async def close(self):
+        '''Close all pooled connections held by the connector.'''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_record(self, namespace, setname, userkey, **query_params):
+        '''Retrieve a map representation of a record stored in aerospike
+
+        Args:
+            namespace (str): The namespace for the record.
+            setname (str, int): The setname for the record.
+            userkey (str) optional: The userkey of the record.
+            query_params (Map[str:str]) optional: A Map of query params.
+        Returns:
+            dict: A dictionary containing entries for 'bins', 'generation' and 'ttl'
+                example: {'bins': {'a': 1, 'b': 'c'}, 'generation': 2, 'ttl': 1234}
+        Raises:
+            RecordNotFoundError: If the specified record does not exist.
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
+        return await self._request(
+            'GET', record_uri, 'Get record failed: ', labels=('get_record', namespace, setname), params=query_params)
+
+    async def create_record(self, namespace, setname, userkey, bins, **query_params):
+        '''Store a new record in the Aerospike database.
+
+        Args:
+            namespace (str): The namespace for the record.
+            setname (str, int): The setname for the record.
+            userkey (str) optional: The userkey of the record.
+            bins (dict[str:any]): A dictionary containing the bins to store in the record
+            query_params (Map[str:str]) optional: A Map of query params.
+        Raises:
+            RecordExistsError: If the specified record already exists.
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
+        await self._request(
+            'POST', record_uri, 'Create record failed: ', body=bins,
+            labels=('create_record', namespace, setname), params=query_params)
+
+    async def update_record(self, namespace, setname, userkey, bins, **query_params):
+        '''Update an existing record
+        Args:
+            namespace (str): The namespace for the record.
+            setname (str, int): The setname for the record.
+            userkey (str) optional: The userkey of the record.
+            bins (dict[str:any]): A dictionary containing the bins to update in the record.
+                These may also contain bins which do not yet exist.
+            query_params (Map[str:str]) optional: A Map of query params.
+        Raises:
+            RecordNotFoundError: If the specified record does not exist.
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
+        await self._request(
+            'PATCH', record_uri, 'Update record failed: ', body=bins,
+            labels=('update_record', namespace, setname), params=query_params)
+
+    async def replace_record(self, namespace, setname, userkey, bins, **query_params):
+        '''Replace an existing record in the Aerospike database.
+
+        Args:
+            namespace (str): The namespace for the record.
+            setname (str, int): The setname for the record.
+            userkey (str) optional: The userkey of the record.
+            bins (dict[str:any]): A dictionary containing the bins to store in the record
+            query_params (Map[str:str]) optional: A Map of query params.
+        Raises:
+            RecordNotFoundError: If the specified record does not yet exist.
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
+        await self._request(
+            'PUT', record_uri, 'Replace record failed: ', body=bins,
+            labels=('replace_record', namespace, setname), params=query_params)
+
+    async def delete_record(self, namespace, setname, userkey, **query_params):
+        '''Delete a record from the Aerospike database
+
+        Args:
+            namespace (str): The namespace for the record.
+            setname (str, int): The setname for the record.
+            userkey (str) optional: The userkey of the record.
+            query_params (Map[str:str]) optional: A Map of query params.
+        Raises:
+            RecordNotFoundError: If the specified record does not exist.
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
+        await self._request(
+            'DELETE', record_uri, 'Delete record failed: ',
+            labels=('delete_record', namespace, setname), params=query_params)
+
+    async def operate_record(self, namespace, setname, userkey, operations, **query_params):
+        '''Perform a series of operations on the specified record.
+
+        Args:
+            namespace (str): The namespace for the record.
+            setname (str, int): The setname for the record.
+            userkey (str) optional: The userkey of the record.
+            operations (list[dict[str:any]]): A list of operation dicts.
+            query_params (Map[str:str]) optional: A Map of query params.
+        Returns:
+            dict: A dictionary containing entries for 'bins', 'generation' and 'ttl'
+                example: {'bins': {'b1': 12345}, 'generation': 2, 'ttl': 1234}
+        Raises:
+            RestClientAPIError: If an error is encountered when performing the operations
+        '''
+        query_params = predexp.encode_params(query_params)
+        operate_uri = self._get_record_uri(self.operate_endpoint, namespace, setname, userkey)
+        return await self._request(
+            'POST', operate_uri, 'Operate on record failed: ', body=operations,
+            labels=('operate_record', namespace, setname), params=query_params)
+
+    async def get_records(self, namespace, setname, userkeys, bins=None, group_by_partition=False,
+                          **query_params):
+        '''Retrieve several records stored in aerospike using the batch endpoint.
+
+        If there are more than `max_batch_size` keys, they are split into several batch requests
+        which are sent concurrently.
+
+        Args:
+            namespace (str): The namespace for the records.
+            setname (str, int): The setname for the records.
+            userkeys (list[str]): The userkeys of the records.
+            bins (list[str]) optional: The names of the bins to retrieve. Default: all bins.
+            group_by_partition (bool) optional: If `True` the keys are sent by digest, ordered by
+                partition, so each batch request covers fewer partitions. Default: `False`
+            query_params (Map[str:str]) optional: A Map of query params. A `keytype` entry is
+                applied to every key in the batch. A `predexp` filters the records server side.
+        Returns:
+            list[dict, None]: One entry per userkey, in the same order. Each entry is a dictionary
+                containing entries for 'bins', 'generation' and 'ttl', or None if the record
+                does not exist.
+        Raises:
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        keytype = query_params.pop('keytype', None)
+        if group_by_partition:
+            order, userkeys = digest.group_by_partition(setname, userkeys, keytype)
+            keytype = constants.DIGEST_KEYTYPE
+        batch_requests = ASRestClientConnector._build_batch_requests(namespace, setname, userkeys, bins, keytype)
+
+        batch_results = await asyncio.gather(*[
+            self._request(
+                'POST', self.batch_endpoint, 'Get records failed: ',
+                body=batch_requests[start:start + self.max_batch_size],
+                labels=('get_records', namespace, setname), params=query_params)
+            for start in range(0, len(batch_requests), self.max_batch_size)
+        ])
+
+        records = [batch_record['record'] for batch_result in batch_results for batch_record in batch_result]
+        if group_by_partition:
+            return digest.restore_order(records, order)
+        return records
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            # With compression, bodies are decompressed by the connector so the savings are counted
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout, auto_decompress=self.compression is None)
+        return self._session
+
+    async def _request(self, method, uri, error_msg, body=None, labels=None, **kwargs):
+        '''Send a request over the pooled session.
+
+        The body is encoded, and the response is requested, in the connector's wire format.
+        If metrics are enabled the request is recorded under labels, an
+        (operation, namespace, setname) tuple.
+
+        Returns:
+            The decoded body for successful responses which have one, else None.
+        Raises:
+            RestClientAPIError: If the request fails, see `raise_from_status`.
+        '''
+        content_encoding = None
+        if body is not None:
+            data = kwargs['data'] = wireformat.encode(self.wire_format, body)
+            if self.compression is not None:
+                kwargs['data'], content_encoding = self.compression.compress(labels and labels[0], data)
+                if content_encoding is not None:
+                    kwargs['headers'] = dict(self._headers, **{'Content-Encoding': content_encoding})
+        kwargs.setdefault('headers', self._headers)
+
+        status, content = await self._send(method, uri, labels, kwargs)
+        if content_encoding is not None and status == compression.UNSUPPORTED_MEDIA_TYPE:
+            # The REST client does not accept compressed bodies, so they are no longer compressed
+            self.compression.reject(content_encoding)
+            kwargs.update(data=data, headers=self._headers)
+            status, content = await self._send(method, uri, labels, kwargs)
+
+        if status < 400:
+            return wireformat.decode(self.wire_format, content) if content else None
+
+        self.raise_from_status(status, content.decode('utf-8', 'replace'), msg=error_msg)
+
+    async def _send(self, method, uri, labels, kwargs):
+        '''Send a single request, recording it in the metrics
+
+        Returns:
+            (int, bytes): The status and the body of the response.
+        '''
+        metrics = self.metrics if labels is not None else None
+        if metrics is not None:
+            start = time.perf_counter()
+            request_bytes = len(kwargs.get('data') or b'')
+
+        permit = await self.limiter.acquire() if self.limiter is not None else None
+        failed = True
+        try:
+            async with self._get_session().request(method, uri, **kwargs) as response:
+                if self.compression is None:
+                    content = await response.read()
+                else:
+                    content = await self._read_decompressed(response, labels and labels[0])
+            failed = response.status >= 500
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as cex:
+            if metrics is not None:
+                metrics.record(*labels, status=0, latency=time.perf_counter() - start,
+                               request_bytes=request_bytes)
+            raise RestClientAPIError('Request to {uri} failed: {err!r}'.format(uri=uri, err=cex))
+        finally:
+            if permit is not None:
+                self.limiter.release(permit, failed)
+
+        if metrics is not None:
+            metrics.record(*labels, status=response.status, latency=time.perf_counter() - start,
+                           request_bytes=request_bytes, response_bytes=len(content))
+        return response.status, content
+
+    async def _read_decompressed(self, response, operation):
+        decoder = self.compression.decoder(operation, response.headers.get('Content-Encoding'))
+        chunks = []
+        async for chunk in response.content.iter_chunked(streaming.CHUNK_SIZE):
+            chunks.append(decoder.decode(chunk))
+        chunks.append(decoder.finish())
+        return b''.join(chunks)
+
+    _get_record_uri = staticmethod(ASRestClientConnector._get_record_uri)
+
+    @staticmethod
+    def raise_from_status(status, text, msg=''):
+
+        if status == 404:
+            raise RecordNotFoundError(msg + text)
+
+        if status == 409:
+            raise RecordExistsError(msg + text)
+
+        raise RestClientAPIError(msg + text)
@@ -0,0 +1,108 @@
+from . import limiter
+from . import restclientconnector
+from . import constants
+from .user_connector import UserConnector
+
+class AsyncUserConnector(object):
+
+    '''
+    Asyncio version of UserConnector. Provides an interface to store
+    User objects into the aerospike database from within an event loop.
+    '''
+
+    def __init__(self, client, namespace, setname):
+        '''constructor
+
+        Args:
+            namespace (String): The Aerospike Namespace to be used to store users.
+            setname (String): The Aerospike Set to be used to store users
+            client (AsyncASRestClientConnector): A connector instance which will be utilized to perform
+                REST operations.
+        '''
+        self.namespace = namespace
+        self.setname = setname
+        self.client = client
+
+    async def create_user(self, user, errror_if_exists=True):
+        '''
+        Description:
+            Store a user into the aerospike database. It will not update an existing user.
+        Args:
+            user (User): A user object to be stored into the Aerospike database. The `user.id`
+                field will be cast to a string before being used as the key.
+            error_if_exists (bool): A flag indicating whether an exception should be raised if
+                a user with a matching id already exists in the Database. Default: `True`
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        bins = UserConnector._user_to_bins(user)
+
+        try:
+            await self.client.create_record(self.namespace, self.setname, user.id, bins)
+        except restclientconnector.RecordExistsError as ree:
+            if errror_if_exists:
+                raise ree
+
+    async def get_user(self, user_id):
+        '''
+        Description
+            Retrieves a User instance populated with information stored in the Aerospike Database. If
+            a user is not found None will be returned. The read is sent in the priority lane of the
+            connector's limiter.
+        Args:
+            user_id: A unique id for a user. It will be converted to a String before being used to look up
+                a user.
+        Returns:
+            User, None: Returns a new User instance if the user is found in Aerospike, else None
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        try:
+            with limiter.priority_lane():
+                record = await self.client.get_record(self.namespace, self.setname, user_id)
+            return UserConnector._user_from_bins(record['bins'])
+        except restclientconnector.RecordNotFoundError:
+            return None
+
+    async def get_users(self, user_ids):
+        '''
+        Description
+            Retrieves several users with batch requests, rather than one request per user.
+        Args:
+            user_ids (list): Unique ids for the users. They will be converted to Strings before being used
+                to look up the users.
+        Returns:
+            list[User, None]: One entry per id, in the same order. Each entry is a new User instance if
+                the user is found in Aerospike, else None
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        records = await self.client.get_records(self.namespace, self.setname, user_ids)
+        return [UserConnector._user_from_bins(record['bins']) if record else None for record in records]
+
+    async def add_interest(self, user_id, interest):
+        '''
+        Description
+            Adds an interest to the list of interests for a User stored in the database. This will not create a
+            new user.
+        Args:
+            user_id: A unique id for a user. It will be converted to a String before being used to look up
+                a user.
+            interest (string): An interest to append to the list of interestss for the user
+        Returns:
+            list[string]: The updated list of interests for the user.
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        add_interest_ops = UserConnector._add_interest_and_retrieve_ops(interest)
+
+        # Add update only to prevent creation of a new user
+        response = await self.client.operate_record(
+            self.namespace, self.setname, user_id,
+            add_interest_ops, recordExistsAction=constants.UPDATE_ONLY)
+        # The response contains one entry for the length of interests, the second is the new list of interests
+        return response['bins']['interests'][1]
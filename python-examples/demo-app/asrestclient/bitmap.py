@@ -0,0 +1,209 @@
+'''
+A local mirror of a bytes bin, synchronised by sending only the bits which changed
+
+    flags = bitmap.Bitmap(client, 'test', 'flags', 'features', 'bits')
+    flags.load()
+    flags[1234] = True
+    flags.flush()
+
+Bits are numbered as by the server's bit operations, bit 0 being the most significant bit of the
+first byte.
+'''
+import base64
+
+from . import constants
+from . import restclientconnector
+
+# Dirty bytes separated by at most this many clean bytes are sent in one operation, as the
+# overhead of an extra operation outweighs a few no-op bytes
+MAX_GAP_BYTES = 16
+
+
+class Bitmap(object):
+    '''
+    A bytearray mirror of a bytes bin. Changes are made to the local copy and tracked, and
+    `flush` sends them in a single operate request: a BIT_OR of the bits set and a BIT_AND of the
+    bits cleared, per range of changed bytes. Bits changed by other clients are preserved, even
+    in the same bytes. Not thread safe.
+    '''
+
+    def __init__(self, client, namespace, setname, userkey, bin_name, byte_size=0):
+        '''constructor
+
+        Args:
+            client (ASRestClientConnector): The connector used to read and write the bin.
+            namespace (str): The namespace of the record.
+            setname (str): The set of the record.
+            userkey (str): The key of the record.
+            bin_name (str): The bytes bin.
+            byte_size (int) optional: The size of the bitmap if the bin does not exist yet. Default: `0`
+        '''
+        self.client = client
+        self.namespace = namespace
+        self.setname = setname
+        self.userkey = userkey
+        self.bin_name = bin_name
+
+        self._data = bytearray(byte_size)
+        # The size of the bin on the server
+        self._server_size = 0
+        # Maps the index of a changed byte to the masks of its bits set and cleared
+        self._set_masks = {}
+        self._clear_masks = {}
+
+    def load(self):
+        '''Replace the local copy with the bin stored on the server, discarding unflushed changes.
+        If the record or bin does not exist, the local copy is kept, to be created by `flush`.
+
+        Raises:
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        try:
+            record = self.client.get_record(self.namespace, self.setname, self.userkey, bins=[self.bin_name])
+        except restclientconnector.RecordNotFoundError:
+            return
+        self._set_from_bin(record['bins'].get(self.bin_name))
+
+    @property
+    def byte_size(self):
+        return len(self._data)
+
+    @property
+    def dirty(self):
+        '''Whether there are local changes which have not been flushed'''
+        return bool(self._set_masks or self._clear_masks) or self._server_size != len(self._data)
+
+    def view(self):
+        '''Get a read only view of the local copy, without copying it'''
+        return memoryview(self._data).toreadonly()
+
+    def __len__(self):
+        '''The number of bits'''
+        return len(self._data) * 8
+
+    def __getitem__(self, bit):
+        byte_index, mask = self._locate(bit)
+        return bool(self._data[byte_index] & mask)
+
+    def __setitem__(self, bit, value):
+        byte_index, mask = self._locate(bit)
+        if value:
+            self._change(byte_index, mask, 0)
+        else:
+            self._change(byte_index, 0, mask)
+
+    def set_range(self, bit_offset, bit_size, value=True):
+        '''Set or clear bit_size bits starting at bit_offset'''
+        for bit in range(bit_offset, bit_offset + bit_size):
+            self[bit] = value
+
+    def write(self, byte_offset, data):
+        '''Overwrite bytes of the bitmap, starting at byte_offset
+
+        Raises:
+            IndexError: If the data does not fit in the bitmap.
+        '''
+        if byte_offset < 0 or byte_offset + len(data) > len(self._data):
+            raise IndexError('Write of {} bytes at {} is outside of the bitmap'.format(len(data), byte_offset))
+        for byte_index, byte in enumerate(data, byte_offset):
+            self._change(byte_index, byte, ~byte & 0xff)
+
+    def resize(self, byte_size):
+        '''Grow or shrink the bitmap, new bytes are zero. The server bin is resized by `flush`.'''
+        if byte_size < len(self._data):
+            del self._data[byte_size:]
+            for masks in (self._set_masks, self._clear_masks):
+                for byte_index in [index for index in masks if index >= byte_size]:
+                    del masks[byte_index]
+        else:
+            # Bytes the server still holds beyond an unflushed shrink are cleared by flush, as
+            # resizing the bin back to its own size would keep their old bits
+            for byte_index in range(len(self._data), min(byte_size, self._server_size)):
+                self._set_masks.pop(byte_index, None)
+                self._clear_masks[byte_index] = 0xff
+            self._data.extend(bytes(byte_size - len(self._data)))
+
+    def flush(self):
+        '''Send the local changes to the server in a single operate request
+
+        Raises:
+            RestClientAPIError: If the operations fail. The changes are kept, to be sent again.
+        '''
+        ops = self.flush_ops()
+        if not ops:
+            return
+
+        self.client.operate_record(self.namespace, self.setname, self.userkey, ops)
+        self._set_masks = {}
+        self._clear_masks = {}
+        self._server_size = len(self._data)
+
+    def flush_ops(self):
+        '''Build the operations sending the local changes'''
+        ops = []
+        if self._server_size != len(self._data):
+            ops.append(self._op(constants.BIT_RESIZE_OP, byteSize=len(self._data)))
+
+        for start, end in self._dirty_ranges():
+            or_value = bytes(self._set_masks.get(index, 0) for index in range(start, end))
+            and_value = bytes(~self._clear_masks.get(index, 0) & 0xff for index in range(start, end))
+            bit_range = {'bitOffset': start * 8, 'bitSize': (end - start) * 8}
+            if any(or_value):
+                ops.append(self._op(constants.BIT_OR_OP, value=self._encode(or_value), **bit_range))
+            if any(byte != 0xff for byte in and_value):
+                ops.append(self._op(constants.BIT_AND_OP, value=self._encode(and_value), **bit_range))
+        return ops
+
+    def _change(self, byte_index, set_mask, clear_mask):
+        self._data[byte_index] = (self._data[byte_index] | set_mask) & ~clear_mask & 0xff
+        # The latest change to a bit wins, so it is removed from the opposite mask
+        if set_mask:
+            self._set_masks[byte_index] = self._set_masks.get(byte_index, 0) | set_mask
+            self._remove_mask(self._clear_masks, byte_index, set_mask)
+        if clear_mask:
+            self._clear_masks[byte_index] = self._clear_masks.get(byte_index, 0) | clear_mask
+            self._remove_mask(self._set_masks, byte_index, clear_mask)
+
+    @staticmethod
+    def _remove_mask(masks, byte_index, mask):
+        remaining = masks.get(byte_index, 0) & ~mask
+        if remaining:
+            masks[byte_index] = remaining
+        else:
+            masks.pop(byte_index, None)
+
+    def _dirty_ranges(self):
+        '''Get the (start, end) byte ranges covering the changed bytes'''
+        ranges = []
+        for byte_index in sorted(set(self._set_masks) | set(self._clear_masks)):
+            if ranges and byte_index - ranges[-1][1] <= MAX_GAP_BYTES:
+                ranges[-1][1] = byte_index + 1
+            else:
+                ranges.append([byte_index, byte_index + 1])
+        return ranges
+
+    def _locate(self, bit):
+        if not 0 <= bit < len(self._data) * 8:
+            raise IndexError('Bit {} is outside of the bitmap'.format(bit))
+        return bit >> 3, 0x80 >> (bit & 7)
+
+    def _set_from_bin(self, value):
+        if value is None:
+            return
+        # JSON responses hold bytes bins as base64 strings, MessagePack responses as bytes
+        if isinstance(value, str):
+            value = base64.b64decode(value)
+        self._data = bytearray(value)
+        self._server_size = len(self._data)
+        self._set_masks = {}
+        self._clear_masks = {}
+
+    def _encode(self, value):
+        # Only MessagePack can carry bytes, JSON requests take them base64 encoded
+        if self.client.wire_format == constants.MSGPACK_WIRE_FORMAT:
+            return value
+        return base64.b64encode(value).decode('ascii')
+
+    def _op(self, operation, **op_values):
+        op_values['bin'] = self.bin_name
+        return {constants.OPERATION_NAME: operation, constants.OPERATION_VALUES: op_values}
@@ -0,0 +1,169 @@
+'''
+Coalescing of interest appends, so many add_interest calls for a user cost one operate request
+'''
+import collections
+from concurrent import futures
+import threading
+import time
+
+from . import constants
+
+
+class InterestCoalescer(object):
+    '''
+    Buffers interests added to each user, and appends each user's buffered interests with a
+    single operate request once `max_items` are pending or `window` seconds have passed since
+    the first of them was added.
+
+    At most one request per user is in flight, so interests are appended in the order they
+    were submitted.
+    '''
+
+    def __init__(self, client, namespace, setname, window=0.01, max_items=100, max_workers=8):
+        '''constructor
+
+        Args:
+            client (ASRestClientConnector): The connector used to send the operate requests.
+            namespace (str): The namespace of the users.
+            setname (str): The set of the users.
+            window (float) optional: The maximum number of seconds an interest waits before being
+                sent. Default: `0.01`
+            max_items (int) optional: The number of pending interests which causes a user's
+                interests to be sent immediately. Default: `100`
+            max_workers (int) optional: The maximum number of concurrent operate requests. Default: `8`
+        '''
+        self.client = client
+        self.namespace = namespace
+        self.setname = setname
+        self.window = window
+        self.max_items = max_items
+
+        self.submitted = 0
+        self.requests = 0
+
+        # Maps user id to [first submission time, [(interest, future)]], in submission order
+        self._pending = collections.OrderedDict()
+        self._in_flight = set()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._flusher = threading.Thread(target=self._run, name='interest-coalescer', daemon=True)
+        self._flusher.start()
+
+    def submit(self, user_id, interest):
+        '''Queue an interest to be appended to a user's interests
+
+        Args:
+            user_id: The id of the user, which must already exist.
+            interest (str): The interest to append.
+        Returns:
+            concurrent.futures.Future: Resolves to the user's list of interests after the append, or
+                to the error raised by the operate request.
+        Raises:
+            RuntimeError: If the coalescer has been closed.
+        '''
+        future = futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Cannot add interests after the coalescer is closed')
+
+            entry = self._pending.get(user_id)
+            if entry is None:
+                entry = self._pending[user_id] = [time.monotonic(), []]
+            entry[1].append((interest, future))
+            self.submitted += 1
+
+            # Wake the flusher to start the window of a new user, or to send a full one
+            if len(entry[1]) == 1 or len(entry[1]) >= self.max_items:
+                self._condition.notify()
+
+        return future
+
+    def flush(self):
+        '''Send every pending interest and wait until they have been appended'''
+        with self._condition:
+            waiting = [future for _, items in self._pending.values() for _, future in items]
+            for entry in self._pending.values():
+                # Make every pending user due immediately
+                entry[0] = float('-inf')
+            self._condition.notify()
+
+        futures.wait(waiting)
+
+    def close(self):
+        '''Send every pending interest, then stop the background flusher'''
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._flusher.join()
+        self._executor.shutdown()
+
+    def stats(self):
+        '''Get the number of interests submitted and operate requests sent'''
+        with self._condition:
+            return {'submitted': self.submitted, 'requests': self.requests}
+
+    def _run(self):
+        with self._condition:
+            while not (self._closed and not self._pending):
+                now = time.monotonic()
+                timeout = None
+                for user_id in list(self._pending):
+                    if user_id in self._in_flight:
+                        continue
+
+                    first_submitted, items = self._pending[user_id]
+                    remaining = first_submitted + self.window - now
+                    if remaining <= 0 or len(items) >= self.max_items or self._closed:
+                        del self._pending[user_id]
+                        self._in_flight.add(user_id)
+                        self.requests += 1
+                        self._executor.submit(self._send, user_id, items)
+                    elif timeout is None or remaining < timeout:
+                        timeout = remaining
+
+                self._condition.wait(timeout)
+
+    def _send(self, user_id, items):
+        try:
+            ops = self.add_interests_and_retrieve_ops([interest for interest, _ in items])
+            response = self.client.operate_record(
+                self.namespace, self.setname, user_id, ops, recordExistsAction=constants.UPDATE_ONLY)
+            # The response contains one entry for the length of interests, the second is the new list of interests
+            interests = response['bins']['interests'][1]
+            for _, future in items:
+                future.set_result(interests)
+        except Exception as ex:
+            for _, future in items:
+                future.set_exception(ex)
+        finally:
+            with self._condition:
+                self._in_flight.discard(user_id)
+                # More interests may have been queued for the user while this request was in flight
+                self._condition.notify()
+
+    @staticmethod
+    def add_interests_and_retrieve_ops(interests):
+        '''Build a list of operations to add several interests to a user's list of interests
+
+        Args:
+            interests (list[str]): The interests to add to the users list
+        Returns:
+            list[map] : A list of operations to be passed to the ASRestClientConnector.operate_record method
+        '''
+        return [
+            {
+                constants.OPERATION_NAME: constants.LIST_APPEND_ITEMS_OP,
+                constants.OPERATION_VALUES: {
+                    'bin': 'interests',
+                    'values': interests
+                }
+            },
+            {
+                constants.OPERATION_NAME: constants.READ_OP,
+                constants.OPERATION_VALUES: {
+                    'bin': 'interests'
+                }
+            }
+        ]
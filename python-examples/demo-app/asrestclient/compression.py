@@ -0,0 +1,270 @@
+'''
+Compression of request bodies and streamed decompression of response bodies
+
+Pass a Compression as the `compression` argument of a connector to enable it. Request bodies larger
+than a threshold are compressed, responses are requested in any supported encoding, and the bytes
+saved and the CPU time spent compressing and decompressing are counted per operation.
+
+gzip and deflate are always available. zstd is available when the optional `zstandard` package is
+installed.
+'''
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import restclientconnector
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+ZSTD = 'zstd'
+
+# Preferred first, zstd decompresses faster than gzip for a similar ratio
+SUPPORTED_ENCODINGS = (ZSTD, GZIP, DEFLATE) if zstandard is not None else (GZIP, DEFLATE)
+
+# Responses to compressed requests with this status are resent uncompressed
+UNSUPPORTED_MEDIA_TYPE = 415
+
+_ZLIB_DECOMPRESSOR = type(zlib.decompressobj())
+
+_DECOMPRESSION_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+
+
+class CompressionStats(object):
+    '''
+    The compression counters of one operation. Not thread safe, callers hold a lock.
+    '''
+
+    def __init__(self):
+        self.requests_compressed = 0
+        self.request_bytes = 0
+        self.request_compressed_bytes = 0
+        self.compress_seconds = 0.0
+        self.responses_decompressed = 0
+        self.response_bytes = 0
+        self.response_compressed_bytes = 0
+        self.decompress_seconds = 0.0
+
+    def snapshot(self):
+        return {
+            'requests_compressed': self.requests_compressed,
+            'request_bytes': self.request_bytes,
+            'request_compressed_bytes': self.request_compressed_bytes,
+            'request_bytes_saved': self.request_bytes - self.request_compressed_bytes,
+            'compress_seconds': self.compress_seconds,
+            'responses_decompressed': self.responses_decompressed,
+            'response_bytes': self.response_bytes,
+            'response_compressed_bytes': self.response_compressed_bytes,
+            'response_bytes_saved': self.response_bytes - self.response_compressed_bytes,
+            'decompress_seconds': self.decompress_seconds,
+        }
+
+
+class Compression(object):
+    '''
+    The compression settings and statistics of a connector. It is thread safe.
+
+    The REST client may not accept compressed request bodies. If it rejects one with a 415
+    Unsupported Media Type, request compression is turned off and the request resent uncompressed,
+    while responses are still requested compressed.
+    '''
+
+    def __init__(self, encoding=GZIP, min_request_bytes=1024, level=None, accept_encodings=None):
+        '''constructor
+
+        Args:
+            encoding (str) optional: The encoding of compressed request bodies, `'gzip'`, `'deflate'`
+                or `'zstd'`, or `None` to only request compressed responses. Default: `'gzip'`
+            min_request_bytes (int) optional: Request bodies smaller than this are sent uncompressed,
+                as compressing them costs more than it saves. Default: `1024`
+            level (int) optional: The compression level of request bodies. Default: the encoding's
+                default, 6 for gzip and deflate and 3 for zstd.
+            accept_encodings (list[str]) optional: The encodings in which responses may be sent, in
+                order of preference. Default: every supported encoding, zstd first if available.
+        Raises:
+            ValueError: If an encoding is not supported, zstd requiring the `zstandard` package.
+        '''
+        accept_encodings = list(SUPPORTED_ENCODINGS if accept_encodings is None else accept_encodings)
+        for name in [encoding] + accept_encodings:
+            if name is not None and name not in SUPPORTED_ENCODINGS:
+                raise ValueError('Unsupported compression encoding: {}'.format(name))
+
+        self.encoding = encoding
+        self.min_request_bytes = min_request_bytes
+        self.level = level
+        self.accept_encodings = accept_encodings
+        self.accept_encoding_header = ', '.join(accept_encodings) if accept_encodings else 'identity'
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def compress(self, operation, data):
+        '''Compress a request body if it is large enough
+
+        Args:
+            operation (str): The connector method sending the body, for the statistics.
+            data (bytes): The encoded body.
+        Returns:
+            (bytes, str): The body to send, and its Content-Encoding, or None if it is not compressed.
+        '''
+        encoding = self.encoding
+        if encoding is None or len(data) < self.min_request_bytes:
+            return data, None
+
+        # CPU time rather than wall time, so time spent waiting for the GIL is not counted
+        start = time.thread_time()
+        if encoding == ZSTD:
+            # Compressors are not thread safe, so one is made per body
+            compressed = zstandard.ZstdCompressor(level=3 if self.level is None else self.level).compress(data)
+        else:
+            level = -1 if self.level is None else self.level
+            # gzip is deflate with a gzip header and trailer, deflate in HTTP has a zlib wrapper
+            window_bits = 16 + zlib.MAX_WBITS if encoding == GZIP else zlib.MAX_WBITS
+            compressor = zlib.compressobj(level, zlib.DEFLATED, window_bits)
+            compressed = compressor.compress(data) + compressor.flush()
+        elapsed = time.thread_time() - start
+
+        with self._lock:
+            stats = self._get_stats(operation)
+            stats.requests_compressed += 1
+            stats.request_bytes += len(data)
+            stats.request_compressed_bytes += len(compressed)
+            stats.compress_seconds += elapsed
+        return compressed, encoding
+
+    def reject(self, encoding):
+        '''Stop compressing request bodies, after the REST client rejected one with this encoding'''
+        with self._lock:
+            if self.encoding == encoding:
+                self.encoding = None
+
+    def decoder(self, operation, content_encoding, max_output_size=None):
+        '''Get a ResponseDecoder for a response body with the given Content-Encoding header'''
+        return ResponseDecoder(self, operation, content_encoding, max_output_size)
+
+    def stats(self):
+        '''Get the compression counters of every operation
+
+        Returns:
+            dict: Maps each operation to its requests and responses compressed, their bytes before and
+                after compression, the bytes saved, and the CPU seconds spent.
+        '''
+        with self._lock:
+            return {operation: stats.snapshot() for operation, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def _record_response(self, operation, decoded_bytes, compressed_bytes, elapsed):
+        with self._lock:
+            stats = self._get_stats(operation)
+            stats.responses_decompressed += 1
+            stats.response_bytes += decoded_bytes
+            stats.response_compressed_bytes += compressed_bytes
+            stats.decompress_seconds += elapsed
+
+    def _get_stats(self, operation):
+        stats = self._stats.get(operation)
+        if stats is None:
+            stats = self._stats[operation] = CompressionStats()
+        return stats
+
+
+class ResponseDecoder(object):
+    '''
+    Decompresses a response body chunk by chunk, so it is never held compressed and decompressed
+    as a whole at once. Bodies which are not compressed are passed through.
+    '''
+
+    def __init__(self, compression, operation, content_encoding, max_output_size=None):
+        '''constructor
+
+        Args:
+            compression (Compression): The Compression recording the statistics of the response.
+            operation (str): The connector operation the response is for.
+            content_encoding (str): The Content-Encoding header of the response.
+            max_output_size (int) optional: The largest decoded body accepted. Default: no limit
+        Raises:
+            ValueError: If the Content-Encoding is not supported.
+        '''
+        self._compression = compression
+        self._operation = operation
+        self._decompressor = _decompressor(content_encoding)
+        self._max_output_size = max_output_size
+        self._decoded_bytes = 0
+        self._compressed_bytes = 0
+        self._elapsed = 0.0
+
+    def decode(self, chunk):
+        '''Decompress the next chunk of the body
+
+        Raises:
+            ValueError: If the body is not validly compressed.
+            ResponseTooLargeError: If the decoded body is larger than max_output_size.
+        '''
+        if self._decompressor is None:
+            self._check_size(len(chunk))
+            return chunk
+
+        start = time.thread_time()
+        try:
+            if self._max_output_size is not None and isinstance(self._decompressor, _ZLIB_DECOMPRESSOR):
+                # Inflating at most one byte past the limit, so a small chunk cannot expand to a huge body
+                # before it is checked. zstd cannot bound its output, and is checked once the chunk is decoded.
+                decoded = self._decompressor.decompress(chunk, self._max_output_size - self._decoded_bytes + 1)
+            else:
+                decoded = self._decompressor.decompress(chunk)
+        except _DECOMPRESSION_ERRORS as error:
+            raise ValueError('Invalid compressed body: {}'.format(error))
+        self._elapsed += time.thread_time() - start
+        self._compressed_bytes += len(chunk)
+        self._check_size(len(decoded))
+        return decoded
+
+    def finish(self):
+        '''Get the end of the body, once every chunk has been decoded, and record the statistics'''
+        if self._decompressor is None:
+            return b''
+
+        # Older zstd decompression objects have no flush, as they return all output as soon as possible
+        flush = getattr(self._decompressor, 'flush', None)
+        remaining = flush() if flush is not None else b''
+        if getattr(self._decompressor, 'eof', True) is False:
+            raise ValueError('Truncated compressed body')
+        self._check_size(len(remaining))
+        self._compression._record_response(
+            self._operation, self._decoded_bytes, self._compressed_bytes, self._elapsed)
+        return remaining
+
+    def _check_size(self, size):
+        self._decoded_bytes += size
+        if self._max_output_size is not None and self._decoded_bytes > self._max_output_size:
+            raise restclientconnector.ResponseTooLargeError(
+                'Decompressed response body exceeds the limit of {} bytes'.format(self._max_output_size))
+
+    def iter_decoded(self, chunks):
+        '''Decode an iterable of body chunks, yielding the decoded chunks'''
+        for chunk in chunks:
+            decoded = self.decode(chunk)
+            if decoded:
+                yield decoded
+        remaining = self.finish()
+        if remaining:
+            yield remaining
+
+
+def _decompressor(content_encoding):
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == DEFLATE:
+        return zlib.decompressobj()
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unsupported Content-Encoding: {}'.format(content_encoding))
@@ -6,11 +6,27 @@ INTEGER_KEYTYPE = 'INTEGER'
 BYTES_KEYTYPE = 'BYTES'
 DIGEST_KEYTYPE = 'DIGEST'
 
+JSON_WIRE_FORMAT = 'json'
+MSGPACK_WIRE_FORMAT = 'msgpack'
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
 CREATE_ONLY = 'CREATE_ONLY'
 UPDATE_ONLY = 'UPDATE_ONLY'
+REPLACE = 'REPLACE'
 
 OPERATION_NAME = 'operation'
 OPERATION_VALUES = 'opValues'
 
 LIST_APPEND_OP = 'LIST_APPEND'
-READ_OP = 'READ'
\ No newline at end of file
+LIST_APPEND_ITEMS_OP = 'LIST_APPEND_ITEMS'
+MAP_PUT_OP = 'MAP_PUT'
+READ_OP = 'READ'
+PUT_OP = 'PUT'
+HLL_ADD_OP = 'HLL_ADD'
+HLL_GET_COUNT_OP = 'HLL_GET_COUNT'
+
+BIT_RESIZE_OP = 'BIT_RESIZE'
+BIT_OR_OP = 'BIT_OR'
+BIT_AND_OP = 'BIT_AND'
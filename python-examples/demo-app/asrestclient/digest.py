@@ -0,0 +1,173 @@
+'''
+Computation of Aerospike record digests and partition ids on the client
+
+A record is stored under the RIPEMD-160 digest of its set name and typed key, and its partition
+is given by the low 12 bits of the digest. Addressing a record by digest, with
+`keytype=DIGEST`, lets the server skip hashing the key, and knowing the partition lets the
+keys of a batch be grouped so each request touches fewer partitions.
+
+RIPEMD-160 is taken from hashlib when OpenSSL provides it. OpenSSL 3 only does with its legacy
+provider loaded, so otherwise a slower pure Python implementation is used.
+'''
+import base64
+import functools
+import hashlib
+import struct
+
+from . import constants
+
+N_PARTITIONS = 4096
+
+# The particle types of keys, which are part of the hashed value
+INTEGER_PARTICLE = 1
+STRING_PARTICLE = 3
+BLOB_PARTICLE = 4
+
+
+@functools.lru_cache(maxsize=65536)
+def compute_digest(setname, userkey, keytype=None):
+    '''Compute the digest of a key, caching it for hot keys
+
+    Args:
+        setname (str): The set of the record, `None` or `''` for no set.
+        userkey (str, int, bytes): The userkey of the record.
+        keytype (str) optional: The keytype the key would be sent with, as for the REST client:
+            `None` for a string key, `'INTEGER'`, `'BYTES'` or `'DIGEST'`. Bytes and digest keys
+            may be given as bytes, or as their URL safe base64 encoding.
+    Returns:
+        bytes: The 20 byte digest.
+    Raises:
+        ValueError: If the keytype is not supported.
+    '''
+    if keytype is None:
+        particle, key_bytes = STRING_PARTICLE, str(userkey).encode('utf-8')
+    elif keytype == constants.INTEGER_KEYTYPE:
+        particle, key_bytes = INTEGER_PARTICLE, struct.pack('>q', int(userkey))
+    elif keytype == constants.BYTES_KEYTYPE:
+        particle, key_bytes = BLOB_PARTICLE, _key_bytes(userkey)
+    elif keytype == constants.DIGEST_KEYTYPE:
+        return _key_bytes(userkey)
+    else:
+        raise ValueError('Cannot compute the digest of a key with keytype: {}'.format(keytype))
+
+    return ripemd160((setname or '').encode('utf-8') + bytes((particle,)) + key_bytes)
+
+
+def partition_id(digest):
+    '''Get the partition of a record from its digest'''
+    return (digest[0] | digest[1] << 8) % N_PARTITIONS
+
+
+def encode_digest(digest):
+    '''Encode a digest as the userkey of a request with `keytype=DIGEST`'''
+    return base64.urlsafe_b64encode(digest).decode('ascii')
+
+
+def digest_key(setname, userkey, keytype=None):
+    '''Get the userkey addressing a record by digest, see `compute_digest`'''
+    return encode_digest(compute_digest(setname, userkey, keytype))
+
+
+def group_by_partition(setname, userkeys, keytype=None):
+    '''Order the keys of a batch by partition, and address them by digest
+
+    Returns:
+        (list[int], list[str]): The positions of the keys in userkeys, in partition order, and the
+            matching digest keys, to be sent with `keytype=DIGEST`.
+    '''
+    digests = [compute_digest(setname, userkey, keytype) for userkey in userkeys]
+    order = sorted(range(len(digests)), key=lambda position: partition_id(digests[position]))
+    return order, [encode_digest(digests[position]) for position in order]
+
+
+def restore_order(results, order):
+    '''Put the results of keys ordered by `group_by_partition` back in the original order'''
+    ordered = [None] * len(results)
+    for result, position in zip(results, order):
+        ordered[position] = result
+    return ordered
+
+
+def _hashlib_ripemd160(data):
+    return hashlib.new('ripemd160', data).digest()
+
+
+# The message word selected in each of the 80 steps, and the rotation applied, of the left and right lines
+_R_LEFT = (
+    0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
+    7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+    3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12,
+    1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+    4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13)
+_R_RIGHT = (
+    5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12,
+    6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+    15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13,
+    8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+    12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11)
+_S_LEFT = (
+    11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8,
+    7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+    11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5,
+    11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+    9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6)
+_S_RIGHT = (
+    8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
+    9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+    9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5,
+    15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+    8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11)
+_K_LEFT = (0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e)
+_K_RIGHT = (0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000)
+_MASK = 0xffffffff
+
+
+def _f(round_index, x, y, z):
+    if round_index == 0:
+        return x ^ y ^ z
+    if round_index == 1:
+        return (x & y) | (~x & z)
+    if round_index == 2:
+        return (x | ~y & _MASK) ^ z
+    if round_index == 3:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z & _MASK)
+
+
+def _rotate(x, bits):
+    return ((x << bits) | (x >> (32 - bits))) & _MASK
+
+
+def _python_ripemd160(data):
+    '''RIPEMD-160, as specified by Dobbertin, Bosselaers and Preneel'''
+    # Padded with a 1 bit, zeros and the bit length, to a multiple of 64 bytes
+    message = bytes(data) + b'\x80' + bytes((55 - len(data)) % 64) + struct.pack('<Q', len(data) * 8)
+    h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+    for block in range(0, len(message), 64):
+        words = struct.unpack('<16I', message[block:block + 64])
+        al, bl, cl, dl, el = h
+        ar, br, cr, dr, er = h
+        for step in range(80):
+            round_index = step // 16
+            t = _rotate((al + _f(round_index, bl, cl, dl) + words[_R_LEFT[step]] + _K_LEFT[round_index]) & _MASK,
+                        _S_LEFT[step])
+            al, bl, cl, dl, el = el, (t + el) & _MASK, bl, _rotate(cl, 10), dl
+            t = _rotate((ar + _f(4 - round_index, br, cr, dr) + words[_R_RIGHT[step]] + _K_RIGHT[round_index])
+                        & _MASK, _S_RIGHT[step])
+            ar, br, cr, dr, er = er, (t + er) & _MASK, br, _rotate(cr, 10), dr
+        h = [(h[1] + cl + dr) & _MASK, (h[2] + dl + er) & _MASK, (h[3] + el + ar) & _MASK,
+             (h[4] + al + br) & _MASK, (h[0] + bl + cr) & _MASK]
+    return struct.pack('<5I', *h)
+
+
+try:
+    hashlib.new('ripemd160')
+    ripemd160 = _hashlib_ripemd160
+except ValueError:
+    ripemd160 = _python_ripemd160
+
+
+def _key_bytes(userkey):
+    if isinstance(userkey, str):
+        return base64.urlsafe_b64decode(userkey)
+    return bytes(userkey)
@@ -0,0 +1,495 @@
+'''
+An in process stand in for the Aerospike REST client, used to exercise and benchmark
+the connectors without an Aerospike cluster.
+
+Only the endpoints and operations used by the connectors are supported, and records
+are kept in memory.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+import base64
+import collections
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+
+import msgpack
+
+from . import compression
+from . import constants
+from . import digest
+
+RECORD_NOT_FOUND_CODE = 2
+RECORD_EXISTS_CODE = 5
+SERVER_ERROR_CODE = 1
+PARAMETER_ERROR_CODE = 4
+
+
+class FakeServerError(Exception):
+
+    def __init__(self, status, message, internal_code):
+        super(FakeServerError, self).__init__(message)
+        self.status = status
+        self.message = message
+        self.internal_code = internal_code
+
+
+class FakeRestClientServer(object):
+    '''
+    A threaded HTTP server implementing the /v1/kvs, /v1/operate, /v1/batch and /v1/scan endpoints
+    of the REST client, with optional injected latency and errors.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 compress_min_bytes=None, accept_compressed_requests=True):
+        '''constructor
+
+        Args:
+            host (str) optional: The address to listen on. Default: `'127.0.0.1'`
+            port (int) optional: The port to listen on, `0` picks a free port. Default: `0`
+            latency (float) optional: Seconds added to the handling of every request. Default: `0`
+            latency_jitter (float) optional: Up to this many extra seconds are added at random
+                to every request. Default: `0`
+            error_rate (float) optional: The fraction of requests, between 0 and 1, which fail with
+                an internal server error. Default: `0`
+            compress_min_bytes (int) optional: Response bodies of at least this size are compressed in an
+                encoding the request accepts. Default: `None` (never compressed)
+            accept_compressed_requests (bool) optional: If `False` compressed request bodies are rejected
+                with a 415 Unsupported Media Type. Default: `True`
+        '''
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.compress_min_bytes = compress_min_bytes
+        self.accept_compressed_requests = accept_compressed_requests
+        self.records = {}
+        # Maps (namespace, digest key) to the key of every record created, for requests by digest
+        self.digests = {}
+        self.lock = threading.Lock()
+
+        self._httpd = ThreadingHTTPServer((host, port), _FakeRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def base_uri(self):
+        '''The base uri to pass to a connector'''
+        host, port = self._httpd.server_address[:2]
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    def start(self):
+        '''Start serving requests on a background thread'''
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving requests and release the listening socket'''
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def inject_fault(self):
+        '''Sleep for the configured latency, and raise an error for the configured fraction of requests'''
+        delay = self.latency + random.uniform(0, self.latency_jitter) if self.latency_jitter else self.latency
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise FakeServerError(500, 'Injected failure', SERVER_ERROR_CODE)
+
+    def get_record(self, key, bin_names=None):
+        with self.lock:
+            record = self.records.get(key)
+            if record is None:
+                raise FakeServerError(404, 'Record not found', RECORD_NOT_FOUND_CODE)
+            return self._record_view(record, bin_names)
+
+    def put_record(self, key, bins, exists_action):
+        '''Store bins according to a recordExistsAction'''
+        with self.lock:
+            record = self._check_exists_action(key, exists_action)
+            if record is None or exists_action in ('REPLACE', 'REPLACE_ONLY', 'CREATE_OR_REPLACE'):
+                generation = record['generation'] + 1 if record else 1
+                record = {'bins': {}, 'generation': generation, 'ttl': -1}
+                self._insert(key, record)
+            else:
+                record['generation'] += 1
+
+            for bin_name, value in bins.items():
+                if value is None:
+                    record['bins'].pop(bin_name, None)
+                else:
+                    record['bins'][bin_name] = value
+
+    def delete_record(self, key):
+        with self.lock:
+            if self.records.pop(key, None) is None:
+                raise FakeServerError(404, 'Record not found', RECORD_NOT_FOUND_CODE)
+
+    def operate_record(self, key, operations, exists_action):
+        with self.lock:
+            record = self._check_exists_action(key, exists_action)
+            created = record is None
+            if created:
+                record = {'bins': {}, 'generation': 0, 'ttl': -1}
+
+            bins = dict(record['bins'])
+            results = collections.OrderedDict()
+            modified = False
+            for operation in operations:
+                op_name = operation[constants.OPERATION_NAME]
+                op_values = operation.get(constants.OPERATION_VALUES, {})
+                handler = _OPERATIONS.get(op_name)
+                if handler is None:
+                    raise FakeServerError(400, 'Unsupported operation: ' + op_name, PARAMETER_ERROR_CODE)
+
+                bin_name = op_values.get('bin')
+                has_result, result, writes = handler(bins, bin_name, op_values)
+                modified = modified or writes
+                if has_result:
+                    results.setdefault(bin_name, []).append(result)
+
+            if modified:
+                record['bins'] = bins
+                record['generation'] += 1
+                if created:
+                    self._insert(key, record)
+            elif created:
+                raise FakeServerError(404, 'Record not found', RECORD_NOT_FOUND_CODE)
+
+            # Several results for one bin are returned as a list, as the REST client does
+            return {
+                'bins': {name: values[0] if len(values) == 1 else values for name, values in results.items()},
+                'generation': record['generation'],
+                'ttl': record['ttl'],
+            }
+
+    def batch_get(self, batch_requests):
+        batch_records = []
+        with self.lock:
+            for batch_request in batch_requests:
+                request_key = batch_request['key']
+                key = self.resolve_key(
+                    request_key['namespace'], request_key.get('setName'), request_key['userKey'],
+                    request_key.get('keytype'))
+                record = self.records.get(key)
+                bin_names = None if batch_request.get('readAllBins', True) else batch_request.get('binNames', [])
+                batch_records.append({
+                    'key': request_key,
+                    'record': self._record_view(record, bin_names) if record is not None else None,
+                })
+        return batch_records
+
+    def scan(self, namespace, setname, max_records, token, bin_names=None):
+        '''Get a page of the records in a set. The token is the position of the page in the set.'''
+        start = int(token) if token else 0
+        with self.lock:
+            keys = [key for key in self.records if key[0] == namespace and key[1] == setname]
+            page_keys = keys[start:start + max_records]
+            records = []
+            for key in page_keys:
+                record = self._record_view(self.records[key], bin_names)
+                record['key'] = {'namespace': key[0], 'setName': key[1], 'userKey': key[2]}
+                records.append(record)
+
+        end = start + len(page_keys)
+        return {
+            'records': records,
+            'pagination': {'nextToken': str(end) if end < len(keys) else None, 'totalRecords': len(records)},
+        }
+
+    def resolve_key(self, namespace, setname, userkey, keytype=None):
+        '''Get the key a record is stored under, from the key of a request'''
+        if keytype == constants.DIGEST_KEYTYPE:
+            # A single dict lookup, so it is safe with or without the lock held
+            return self.digests.get((namespace, userkey), (namespace, setname, userkey))
+        return (namespace, setname, str(userkey))
+
+    def _insert(self, key, record):
+        # Keys are stored as strings, whatever their keytype
+        self.records[key] = record
+        self.digests[(key[0], digest.digest_key(key[1], key[2]))] = key
+
+    def _check_exists_action(self, key, exists_action):
+        record = self.records.get(key)
+        if record is not None and exists_action == constants.CREATE_ONLY:
+            raise FakeServerError(409, 'Record exists', RECORD_EXISTS_CODE)
+        if record is None and exists_action in (constants.UPDATE_ONLY, 'REPLACE_ONLY'):
+            raise FakeServerError(404, 'Record not found', RECORD_NOT_FOUND_CODE)
+        return record
+
+    @staticmethod
+    def _record_view(record, bin_names=None):
+        bins = record['bins']
+        if bin_names is not None:
+            bins = {name: bins[name] for name in bin_names if name in bins}
+        return {'bins': dict(bins), 'generation': record['generation'], 'ttl': record['ttl']}
+
+
+def _list_append(bins, bin_name, op_values):
+    # Stored values are never changed in place, so they can be encoded outside of the lock
+    values = bins.get(bin_name, []) + [op_values['value']]
+    bins[bin_name] = values
+    return True, len(values), True
+
+
+def _list_append_items(bins, bin_name, op_values):
+    values = bins.get(bin_name, []) + list(op_values['values'])
+    bins[bin_name] = values
+    return True, len(values), True
+
+
+def _map_put(bins, bin_name, op_values):
+    values = dict(bins.get(bin_name) or {})
+    values[op_values['key']] = op_values['value']
+    bins[bin_name] = values
+    return True, len(values), True
+
+
+def _read(bins, bin_name, op_values):
+    return True, bins.get(bin_name), False
+
+
+def _append(bins, bin_name, op_values):
+    bins[bin_name] = bins.get(bin_name, '') + op_values['value']
+    return False, None, True
+
+
+def _add(bins, bin_name, op_values):
+    bins[bin_name] = bins.get(bin_name, 0) + op_values['incr']
+    return False, None, True
+
+
+def _put(bins, bin_name, op_values):
+    bins[bin_name] = op_values['value']
+    return False, None, True
+
+
+def _hll_add(bins, bin_name, op_values):
+    # The fake keeps the exact distinct values rather than HLL registers
+    values = bins.get(bin_name, [])
+    added = [value for value in dict.fromkeys(op_values['values']) if value not in values]
+    bins[bin_name] = values + added
+    return True, len(added), True
+
+
+def _hll_get_count(bins, bin_name, op_values):
+    return True, len(bins.get(bin_name, [])), False
+
+
+def _bit_resize(bins, bin_name, op_values):
+    value = bins.get(bin_name, b'')
+    size = op_values['byteSize']
+    bins[bin_name] = value[:size] + bytes(max(0, size - len(value)))
+    return False, None, True
+
+
+def _bitwise(combine):
+    def operation(bins, bin_name, op_values):
+        value = bytearray(bins.get(bin_name, b''))
+        operand = op_values['value']
+        # JSON requests hold bytes as base64 strings
+        if isinstance(operand, str):
+            operand = base64.b64decode(operand)
+        if op_values['bitOffset'] % 8 or op_values['bitSize'] != len(operand) * 8:
+            raise FakeServerError(400, 'Only whole byte bit operations are supported', PARAMETER_ERROR_CODE)
+        start = op_values['bitOffset'] // 8
+        if start + len(operand) > len(value):
+            raise FakeServerError(400, 'Bit operation outside of the bin', PARAMETER_ERROR_CODE)
+        for index, byte in enumerate(operand, start):
+            value[index] = combine(value[index], byte)
+        bins[bin_name] = bytes(value)
+        return False, None, True
+    return operation
+
+
+_OPERATIONS = {
+    constants.LIST_APPEND_OP: _list_append,
+    constants.LIST_APPEND_ITEMS_OP: _list_append_items,
+    constants.MAP_PUT_OP: _map_put,
+    constants.READ_OP: _read,
+    constants.HLL_ADD_OP: _hll_add,
+    constants.HLL_GET_COUNT_OP: _hll_get_count,
+    constants.BIT_RESIZE_OP: _bit_resize,
+    constants.BIT_OR_OP: _bitwise(lambda left, right: left | right),
+    constants.BIT_AND_OP: _bitwise(lambda left, right: left & right),
+    'APPEND': _append,
+    'ADD': _add,
+    'PUT': _put,
+}
+
+
+def _encode_bytes(value):
+    # The REST client sends bytes bins as base64 strings in JSON responses
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError('Cannot encode {!r} as JSON'.format(value))
+
+
+class _FakeRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in as few segments as possible, and without waiting on delayed acks
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+
+        try:
+            body = self._read_body()
+            fake.inject_fault()
+            status, response = self._dispatch(fake, method, parts, params, body)
+        except FakeServerError as fse:
+            status, response = fse.status, {
+                'message': fse.message, 'inDoubt': False, 'internalErrorCode': fse.internal_code}
+
+        self._send(status, response)
+
+    def _dispatch(self, fake, method, parts, params, body):
+        exists_action = params.get('recordExistsAction', [None])[0]
+
+        if parts[:2] == ['v1', 'cluster'] and method == 'GET':
+            return 200, {}
+
+        if parts[:2] == ['v1', 'batch'] and method == 'POST':
+            return 200, fake.batch_get(body)
+
+        if parts[:2] == ['v1', 'scan'] and len(parts) == 4 and method == 'GET':
+            max_records = int(params.get('maxRecords', ['1000'])[0])
+            return 200, fake.scan(parts[2], parts[3], max_records, params.get('from', [None])[0], params.get('bins'))
+
+        if len(parts) != 5 or parts[0] != 'v1':
+            raise FakeServerError(404, 'Unknown endpoint', PARAMETER_ERROR_CODE)
+
+        key = fake.resolve_key(parts[2], parts[3], parts[4], params.get('keytype', [None])[0])
+        if parts[1] == 'operate' and method == 'POST':
+            return 200, fake.operate_record(key, body, exists_action)
+
+        if parts[1] != 'kvs':
+            raise FakeServerError(404, 'Unknown endpoint', PARAMETER_ERROR_CODE)
+
+        if method == 'GET':
+            return 200, fake.get_record(key, params.get('bins'))
+        if method == 'POST':
+            fake.put_record(key, body, exists_action or constants.CREATE_ONLY)
+            return 201, None
+        if method == 'PATCH':
+            fake.put_record(key, body, exists_action or constants.UPDATE_ONLY)
+            return 204, None
+        if method == 'PUT':
+            fake.put_record(key, body, exists_action or 'REPLACE_ONLY')
+            return 204, None
+        if method == 'DELETE':
+            fake.delete_record(key)
+            return 204, None
+
+        raise FakeServerError(405, 'Method not allowed', PARAMETER_ERROR_CODE)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+
+        content = self.rfile.read(length)
+        encoding = self.headers.get('Content-Encoding')
+        if encoding:
+            if not self.server.fake.accept_compressed_requests:
+                raise FakeServerError(415, 'Compressed bodies are not supported', PARAMETER_ERROR_CODE)
+            try:
+                content = _decompress(content, encoding)
+            except ValueError as ve:
+                raise FakeServerError(400, str(ve), PARAMETER_ERROR_CODE)
+
+        if self.headers.get('Content-Type', '').startswith(constants.MSGPACK_CONTENT_TYPE):
+            return msgpack.unpackb(content, raw=False, strict_map_key=False)
+        return json.loads(content.decode('utf-8'))
+
+    def _send(self, status, response):
+        if response is None:
+            content = b''
+        elif self.headers.get('Accept', '').startswith(constants.MSGPACK_CONTENT_TYPE):
+            content_type = constants.MSGPACK_CONTENT_TYPE
+            content = msgpack.packb(response, use_bin_type=True)
+        else:
+            content_type = constants.JSON_CONTENT_TYPE
+            content = json.dumps(response, default=_encode_bytes).encode('utf-8')
+
+        encoding = None
+        min_bytes = self.server.fake.compress_min_bytes
+        if min_bytes is not None and content and len(content) >= min_bytes:
+            encoding = _accepted_encoding(self.headers.get('Accept-Encoding', ''))
+            if encoding is not None:
+                content = _compress(content, encoding)
+
+        self.send_response(status)
+        if content:
+            self.send_header('Content-Type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _accepted_encoding(accept_encoding):
+    '''Get the first encoding of an Accept-Encoding header which can be produced, ignoring q values'''
+    for part in accept_encoding.split(','):
+        encoding = part.split(';')[0].strip().lower()
+        if encoding in compression.SUPPORTED_ENCODINGS:
+            return encoding
+    return None
+
+
+def _compress(content, encoding):
+    if encoding == compression.ZSTD:
+        return compression.zstandard.ZstdCompressor().compress(content)
+    if encoding == compression.GZIP:
+        return gzip.compress(content)
+    return zlib.compress(content)
+
+
+def _decompress(content, encoding):
+    encoding = encoding.strip().lower()
+    try:
+        if encoding == compression.ZSTD and compression.zstandard is not None:
+            return compression.zstandard.ZstdDecompressor().decompressobj().decompress(content)
+        if encoding == compression.GZIP:
+            return gzip.decompress(content)
+        if encoding == compression.DEFLATE:
+            return zlib.decompress(content)
+    except (OSError, EOFError, zlib.error) as error:
+        raise ValueError('Invalid {} body: {}'.format(encoding, error))
+    raise ValueError('Unsupported Content-Encoding: {}'.format(encoding))
@@ -0,0 +1,223 @@
+'''
+Client side HyperLogLog pre-aggregation, so counting unique values does not cost a request per value
+
+The aggregator keeps a local sketch for estimates between flushes, and periodically sends the
+distinct values added since the last flush to the server bin with a single HLL_ADD operation.
+The server's register encoding and hash are internal to Aerospike, so the local registers are
+not sent themselves, only used for the local estimate.
+'''
+import hashlib
+import math
+import threading
+
+from . import constants
+
+HASH_BITS = 64
+
+
+class HyperLogLog(object):
+    '''
+    A HyperLogLog sketch with `2 ** index_bit_count` registers, estimating the number of distinct
+    values added to it. Not thread safe, HLLAggregator holds a lock.
+    '''
+
+    def __init__(self, index_bit_count=8):
+        '''constructor
+
+        Args:
+            index_bit_count (int) optional: The number of hash bits selecting a register, between 4
+                and 16 as for the server's `indexBitCount`. Default: `8`
+        Raises:
+            ValueError: If the index_bit_count is out of range.
+        '''
+        if not 4 <= index_bit_count <= 16:
+            raise ValueError('index_bit_count must be between 4 and 16')
+
+        self.index_bit_count = index_bit_count
+        self.registers = bytearray(1 << index_bit_count)
+
+    def add(self, value):
+        '''Add a str, bytes or int value to the sketch'''
+        self.add_all((value,))
+
+    def add_all(self, values):
+        '''Add several values to the sketch, cheaper per value than `add`'''
+        # Bound to locals, as this is run for every value counted
+        registers = self.registers
+        index_shift = HASH_BITS - self.index_bit_count
+        rest_mask = (1 << index_shift) - 1
+        blake2b = hashlib.blake2b
+        from_bytes = int.from_bytes
+
+        for value in values:
+            hashed = from_bytes(blake2b(_to_bytes(value), digest_size=8).digest(), 'big')
+            index = hashed >> index_shift
+            # The position of the first set bit after the index bits
+            rank = index_shift - (hashed & rest_mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        '''Merge another sketch with the same index_bit_count into this one
+
+        Raises:
+            ValueError: If the sketches have a different number of registers.
+        '''
+        if other.index_bit_count != self.index_bit_count:
+            raise ValueError('Cannot merge sketches with different index_bit_count')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        '''Estimate the number of distinct values added'''
+        registers = self.registers
+        size = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        raw = alpha * size * size / sum(2.0 ** -register for register in registers)
+
+        # Linear counting is more accurate while many registers are still empty
+        empty = registers.count(0)
+        if raw <= 2.5 * size and empty:
+            return int(round(size * math.log(size / empty)))
+        return int(round(raw))
+
+
+class HLLAggregator(object):
+    '''
+    Counts distinct values into an HLL bin of a record, sending them in batches rather than one
+    request per value. Values are buffered, deduplicated, and sent with a single HLL_ADD once
+    `max_pending` distinct values are buffered, every `flush_interval` seconds, and on `close`.
+
+    `estimate` answers from a local sketch of every value added through this aggregator, without
+    a request. It does not include values added to the bin by other clients.
+    '''
+
+    def __init__(self, client, namespace, setname, userkey, bin_name, index_bit_count=8,
+                 min_hash_bit_count=0, flush_interval=1.0, max_pending=10000):
+        '''constructor
+
+        Args:
+            client (ASRestClientConnector): The connector used to send the HLL_ADD operations.
+            namespace (str): The namespace of the record.
+            setname (str): The set of the record.
+            userkey (str): The key of the record.
+            bin_name (str): The HLL bin. It is created with the given bit counts if it does not exist.
+            index_bit_count (int) optional: The server's `indexBitCount`, also used for the local
+                sketch. Default: `8`
+            min_hash_bit_count (int) optional: The server's `minHashBitCount`. Default: `0`
+            flush_interval (float) optional: The maximum number of seconds values are buffered for.
+                Default: `1.0`
+            max_pending (int) optional: The number of buffered distinct values which causes them to be
+                sent immediately. Default: `10000`
+        '''
+        self.client = client
+        self.namespace = namespace
+        self.setname = setname
+        self.userkey = userkey
+        self.bin_name = bin_name
+        self.index_bit_count = index_bit_count
+        self.min_hash_bit_count = min_hash_bit_count
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+
+        self.added = 0
+        self.flushes = 0
+
+        self._sketch = HyperLogLog(index_bit_count)
+        self._pending = set()
+        self._lock = threading.Lock()
+        # Held while sending, so flushes reach the server in order
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(target=self._run, name='hll-flusher', daemon=True)
+        self._flusher.start()
+
+    def add(self, value):
+        '''Count a str, bytes or int value'''
+        self.add_all((value,))
+
+    def add_all(self, values):
+        '''Count several values
+
+        Raises:
+            RestClientAPIError: If this fills the buffer and sending it fails.
+        '''
+        values = list(values)
+        with self._lock:
+            self._sketch.add_all(values)
+            self._pending.update(values)
+            self.added += len(values)
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self.flush()
+
+    def estimate(self):
+        '''Estimate the number of distinct values added through this aggregator'''
+        with self._lock:
+            return self._sketch.estimate()
+
+    def flush(self):
+        '''Send the buffered values to the server bin
+
+        Raises:
+            RestClientAPIError: If the operation fails. The values are buffered again, to be sent by
+                the next flush.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                values, self._pending = self._pending, set()
+            if not values:
+                return
+
+            try:
+                self.client.operate_record(
+                    self.namespace, self.setname, self.userkey, self.hll_add_ops(values))
+            except Exception:
+                with self._lock:
+                    self._pending.update(values)
+                raise
+
+            with self._lock:
+                self.flushes += 1
+
+    def close(self):
+        '''Stop the background flushes and send the buffered values'''
+        self._stopped.set()
+        self._flusher.join()
+        self.flush()
+
+    def stats(self):
+        '''Get the number of values added, buffered, and flushes sent'''
+        with self._lock:
+            return {'added': self.added, 'pending': len(self._pending), 'flushes': self.flushes}
+
+    def hll_add_ops(self, values):
+        '''Build the operations adding values to the HLL bin, creating it if needed'''
+        return [
+            {
+                constants.OPERATION_NAME: constants.HLL_ADD_OP,
+                constants.OPERATION_VALUES: {
+                    'bin': self.bin_name,
+                    'values': list(values),
+                    'indexBitCount': self.index_bit_count,
+                    'minHashBitCount': self.min_hash_bit_count,
+                }
+            }
+        ]
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # The values stay buffered for the next flush
+                pass
+
+
+def _to_bytes(value):
+    # Tagged with the type, as the server counts 1, '1' and b'1' as different values
+    if isinstance(value, str):
+        return b's' + value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b'b' + value
+    return b'i' + str(value).encode('utf-8')
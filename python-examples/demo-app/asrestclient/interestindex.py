@@ -0,0 +1,269 @@
+'''
+An inverted index from interests to the ids of the users who have them, stored in Aerospike
+
+The ids of the users with an interest are spread over `buckets` index records by a hash of the id,
+so each id always lands in the same record. An index record is keyed `<interest>:<bucket>` and holds
+the `interest`, its `bucket` and a `users` map whose keys are the ids, so an id added again is not
+repeated.
+
+Each record holds about 1/buckets of the users with its interest, so it still grows with them.
+Aerospike records are limited to 1 MiB by default, around 50,000 short ids, so `buckets` should be
+raised, and the index rebuilt, before the most common interest has that many users per bucket.
+'''
+import collections
+from concurrent import futures
+from urllib.parse import quote
+import zlib
+
+from . import constants
+from . import restclientconnector
+
+DEFAULT_BUCKETS = 16
+
+INTEREST_BIN = 'interest'
+BUCKET_BIN = 'bucket'
+USERS_BIN = 'users'
+
+
+class InterestIndex(object):
+    '''
+    Maintains the index records of a set of users.
+
+    Aerospike updates a single record atomically, so the index records cannot be updated in the same
+    transaction as the user. Ids are added to the index once the user has been written, so a user
+    whose index update fails, or who is written by another client, is only found once the index is
+    rebuilt. Lookups skip users which no longer exist or no longer have the interest.
+    '''
+
+    def __init__(self, client, namespace, setname, buckets=DEFAULT_BUCKETS):
+        '''constructor
+
+        Args:
+            client (ASRestClientConnector): The connector used to read and write the index records.
+            namespace (str): The namespace of the index records.
+            setname (str): The set of the index records, which must not be the set of the users.
+            buckets (int) optional: The number of index records per interest, which bounds the size of
+                each to the users of an interest divided by buckets. It must not change once the index
+                has been built, except by rebuilding it. Default: `16`
+        '''
+        self.client = client
+        self.namespace = namespace
+        self.setname = setname
+        self.buckets = buckets
+
+    def add(self, user_id, interests):
+        '''Add a user to the index records of each of its interests
+
+        Args:
+            user_id: The id of the user.
+            interests (list[str]): The interests of the user.
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        for key, operations in self.updates(user_id, interests):
+            self.client.operate_record(self.namespace, self.setname, key, operations)
+
+    def updates(self, user_id, interests):
+        '''Get the index record key and operations which add a user to each of its interests, for
+        callers which send them another way, such as a WriteBehindQueue
+
+        Returns:
+            list[(str, list[map])]: The key of each index record, and the operations to send to it.
+        '''
+        bucket = self.bucket(user_id)
+        return [(self._key(interest, bucket), self.add_user_ops(interest, bucket, user_id))
+                for interest in dict.fromkeys(interests or [])]
+
+    def bucket(self, user_id):
+        '''Get the index record of an interest which holds a user'''
+        return zlib.crc32(str(user_id).encode('utf-8')) % self.buckets
+
+    def read_bucket(self, interest, bucket):
+        '''Get the ids in an index record of an interest, in order
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        try:
+            record = self.client.get_record(self.namespace, self.setname, self._key(interest, bucket),
+                                            bins=[USERS_BIN])
+        except restclientconnector.RecordNotFoundError:
+            return []
+        return sorted(str(user_id) for user_id in record['bins'].get(USERS_BIN) or {})
+
+    def user_ids(self, interest, cursor=None):
+        '''Iterate over the ids of the users with an interest, reading one index record at a time
+
+        Args:
+            interest (str): The interest.
+            cursor (dict) optional: The position to start from, as yielded with an earlier id.
+        Returns:
+            iterator[(str, dict)]: Each id, and the cursor of the position after it.
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        cursor = cursor or {}
+        # The position is the last id returned rather than a count, so ids added meanwhile do not move it
+        after = cursor.get('after')
+        for bucket in range(cursor.get('bucket', 0), self.buckets):
+            for user_id in self.read_bucket(interest, bucket):
+                if after is None or user_id > after:
+                    yield user_id, {'bucket': bucket, 'after': user_id}
+            after = None
+
+    def rebuild(self, users, max_in_flight=16):
+        '''Replace the index with one built from users, such as every user of the set
+
+        The whole index is built in memory before it is written. Interests added while it is rebuilt
+        may be lost, so writes to the users should be paused until it completes.
+
+        Args:
+            users (iterable[User]): The users to index.
+            max_in_flight (int) optional: The most index records written concurrently. Default: `16`
+        Returns:
+            dict: The number of `users` indexed, index `records` written and stale records `deleted`.
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        # Maps (interest, bucket) to the users map of its index record
+        entries = collections.OrderedDict()
+        indexed = 0
+        for user in users:
+            indexed += 1
+            for interest in dict.fromkeys(user.interests or []):
+                entries.setdefault((interest, self.bucket(user.id)), {})[str(user.id)] = 1
+
+        def write(entry):
+            (interest, bucket), users = entry
+            self.client.create_record(
+                self.namespace, self.setname, self._key(interest, bucket),
+                {INTEREST_BIN: interest, BUCKET_BIN: bucket, USERS_BIN: users},
+                recordExistsAction=constants.REPLACE)
+
+        with futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            # Consumed so the first error is raised
+            list(executor.map(write, entries.items()))
+
+        # Index records of interests no user has any more, or of buckets no longer used
+        stale = [
+            record['bins'] for record in self.client.scan(
+                self.namespace, self.setname, bins=[INTEREST_BIN, BUCKET_BIN])
+            if (record['bins'].get(INTEREST_BIN), record['bins'].get(BUCKET_BIN)) not in entries
+        ]
+
+        def delete(bins):
+            try:
+                self.client.delete_record(
+                    self.namespace, self.setname, self._key(bins.get(INTEREST_BIN), bins.get(BUCKET_BIN)))
+            except restclientconnector.RecordNotFoundError:
+                pass
+
+        with futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            list(executor.map(delete, stale))
+        return {'users': indexed, 'records': len(entries), 'deleted': len(stale)}
+
+    @staticmethod
+    def add_user_ops(interest, bucket, user_id):
+        '''Build a list of operations to add a user to an index record, creating it if needed
+
+        Returns:
+            list[map] : A list of operations to be passed to the ASRestClientConnector.operate_record method
+        '''
+        return [
+            {
+                constants.OPERATION_NAME: constants.PUT_OP,
+                constants.OPERATION_VALUES: {
+                    'bin': INTEREST_BIN,
+                    'value': interest
+                }
+            },
+            {
+                constants.OPERATION_NAME: constants.PUT_OP,
+                constants.OPERATION_VALUES: {
+                    'bin': BUCKET_BIN,
+                    'value': bucket
+                }
+            },
+            {
+                # A map rather than a list, so adding an id which is already there does not repeat it
+                constants.OPERATION_NAME: constants.MAP_PUT_OP,
+                constants.OPERATION_VALUES: {
+                    'bin': USERS_BIN,
+                    'key': str(user_id),
+                    'value': 1
+                }
+            }
+        ]
+
+    @staticmethod
+    def _key(interest, bucket):
+        # The key is a segment of the record URI, so an interest holding '/', '?', '%' or '#' is escaped
+        return quote('{}:{}'.format(interest, bucket), safe='')
+
+
+class InterestUsersIterator(object):
+    '''
+    Iterates over the users with an interest, reading the index one record at a time and fetching
+    the users it lists with batch requests of up to `page_size` users.
+
+    Users which no longer exist or no longer have the interest are skipped. The position of the
+    iterator is available from `cursor`, and a new iteration started from a saved cursor continues
+    with the user after the last one returned.
+    '''
+
+    def __init__(self, index, interest, fetch_users, page_size, cursor=None):
+        '''constructor
+
+        Args:
+            index (InterestIndex): The index to read.
+            interest (str): The interest.
+            fetch_users (callable): Called with a list of ids, returns a list with the User of each id,
+                or None for those not found.
+            page_size (int): The most users fetched per request.
+            cursor (dict) optional: A cursor saved from an earlier iteration to resume from.
+        '''
+        self._interest = interest
+        self._fetch_users = fetch_users
+        self._page_size = page_size
+        self._user_ids = index.user_ids(interest, cursor)
+        self._cursor = dict(cursor or {'bucket': 0, 'after': None})
+        # The users of the current page, each with the cursor after it
+        self._page = collections.deque()
+        self._done = False
+
+    @property
+    def cursor(self):
+        '''The position of the iteration, a JSON serializable dict which may be passed to a new one'''
+        return dict(self._cursor)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._page:
+            if self._done:
+                raise StopIteration
+            self._load_page()
+
+        found, cursor = self._page.popleft()
+        self._cursor = cursor
+        return found
+
+    def _load_page(self):
+        page = []
+        for entry in self._user_ids:
+            page.append(entry)
+            if len(page) >= self._page_size:
+                break
+        else:
+            self._done = True
+        if not page:
+            return
+
+        users = self._fetch_users([user_id for user_id, _ in page])
+        for (_, cursor), found in zip(page, users):
+            if found is not None and self._interest in (found.interests or []):
+                self._page.append((found, cursor))
+        if not self._page:
+            # Every user of the page was skipped, the position still moves past them
+            self._cursor = page[-1][1]
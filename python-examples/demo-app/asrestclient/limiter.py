@@ -0,0 +1,359 @@
+'''
+Adaptive limiting of the requests a connector has in flight
+
+A REST client which is sent more requests than it can handle queues them, so latency grows well
+before any requests fail. An AdaptiveLimiter caps the requests in flight, and adjusts the cap from
+the latency and failures of completed requests: while latency stays near its lowest observed level
+the cap grows, and once latency rises or requests fail it is cut. Requests over the cap wait in the
+connector instead of in the REST client.
+
+Requests sent within `priority_lane()` are admitted before waiting background requests, and may
+use a share of the cap which background requests may not, so interactive reads are not starved
+by bulk writes.
+'''
+import asyncio
+import collections
+import contextlib
+import contextvars
+import math
+import threading
+import time
+
+from . import restclientconnector
+
+_priority = contextvars.ContextVar('asrestclient_priority', default=False)
+
+
+@contextlib.contextmanager
+def priority_lane():
+    '''Send the requests made within the block in the priority lane of any limiter'''
+    token = _priority.set(True)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Permit(object):
+    '''
+    Admission of one request, returned by `acquire` and passed back to `release`
+    '''
+
+    __slots__ = ('priority', 'queue_delay', 'admitted_at')
+
+    def __init__(self, priority, queue_delay):
+        self.priority = priority
+        self.queue_delay = queue_delay
+        self.admitted_at = time.monotonic()
+
+
+class LaneStats(object):
+    '''
+    The admissions and queueing delay of one lane. Not thread safe, callers hold a lock.
+    '''
+
+    def __init__(self):
+        self.admitted = 0
+        self.timed_out = 0
+        self.queue_delay_sum = 0.0
+        self.queue_delay_max = 0.0
+
+    def snapshot(self):
+        return {
+            'admitted': self.admitted,
+            'timed_out': self.timed_out,
+            'queue_delay_mean': self.queue_delay_sum / self.admitted if self.admitted else None,
+            'queue_delay_max': self.queue_delay_max,
+            'queue_delay_sum': self.queue_delay_sum,
+        }
+
+
+class AdaptiveLimiter(object):
+    '''
+    A limit on the requests in flight, adjusted every window from the latency and failures of the
+    requests completed in it. It is thread safe, and may be shared by several connectors.
+
+    The limit is cut by `backoff` when more than `error_threshold` of a window's requests fail,
+    and in proportion to the rise in latency when the window's mean latency is more than
+    `tolerance` times the baseline, the lowest recent window mean. Otherwise, if the window used
+    at least half of the limit, the limit grows by its square root.
+    '''
+
+    def __init__(self, initial_limit=16, min_limit=2, max_limit=256, window_seconds=0.5,
+                 min_window_samples=10, tolerance=1.5, error_threshold=0.05, backoff=0.5,
+                 priority_reserve=0.1, max_queue_delay=None):
+        '''constructor
+
+        Args:
+            initial_limit (int) optional: The limit before any requests have completed. Default: `16`
+            min_limit (int) optional: The lowest the limit may be cut to. Default: `2`
+            max_limit (int) optional: The highest the limit may grow to. Default: `256`
+            window_seconds (float) optional: The minimum duration of a window. Default: `0.5`
+            min_window_samples (int) optional: The minimum number of completed requests in a window.
+                Default: `10`
+            tolerance (float) optional: How many times the baseline latency the mean latency may be
+                before the limit is cut. Default: `1.5`
+            error_threshold (float) optional: The fraction of failed requests in a window above which
+                the limit is cut. Default: `0.05`
+            backoff (float) optional: The factor the limit is multiplied by when requests fail.
+                Default: `0.5`
+            priority_reserve (float) optional: The fraction of the limit only priority requests may use.
+                Default: `0.1`
+            max_queue_delay (float) optional: The longest a request waits to be admitted before
+                ConcurrencyLimitError is raised. Default: no limit
+        '''
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window_seconds = window_seconds
+        self.min_window_samples = min_window_samples
+        self.tolerance = tolerance
+        self.error_threshold = error_threshold
+        self.backoff = backoff
+        self.priority_reserve = priority_reserve
+        self.max_queue_delay = max_queue_delay
+
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.inflight = 0
+        self.baseline_latency = None
+        self.last_window = None
+        self.increases = 0
+        self.decreases = 0
+        self._lanes = {True: LaneStats(), False: LaneStats()}
+        # Waiters of each lane, admitted in order, the priority lane first
+        self._waiters = {True: collections.deque(), False: collections.deque()}
+        self._lock = threading.Lock()
+        self._reset_window(time.monotonic())
+
+    def acquire(self, priority=None):
+        '''Wait until a request may be sent
+
+        Args:
+            priority (bool) optional: Whether the request is in the priority lane. Default: whether it
+                is sent within `priority_lane()`.
+        Returns:
+            Permit: To pass to `release` once the request completes.
+        Raises:
+            ConcurrencyLimitError: If the request waited longer than max_queue_delay.
+        '''
+        priority = _priority.get() if priority is None else priority
+        with self._lock:
+            if self._admissible(priority):
+                return self._admit(priority, 0.0)
+            waiter = _ThreadWaiter()
+            self._waiters[priority].append(waiter)
+
+        waiter.event.wait(self.max_queue_delay)
+        return self._admitted_or_timed_out(waiter, priority)
+
+    def release(self, permit, failed=False):
+        '''Record the completion of a request, admitting any waiting requests which now fit
+
+        Args:
+            permit (Permit): The permit of the request.
+            failed (bool) optional: Whether the request failed in a way which suggests the REST client is
+                overloaded, a server error or timeout. Default: `False`
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self.inflight -= 1
+            self._window_samples += 1
+            self._window_latency += now - permit.admitted_at
+            self._window_failures += failed
+            window_ended = now - self._window_started >= self.window_seconds
+            if window_ended and self._window_samples >= self.min_window_samples:
+                self._adjust(now)
+            self._admit_waiters()
+
+    def stats(self):
+        '''Get the current limit, requests in flight and waiting, and the queueing delay of each lane
+
+        Returns:
+            dict: The limit, inflight and waiting counts, the baseline latency, the last window's
+                latency and failure rate, the number of increases and decreases of the limit, and the
+                admissions and queueing delay of the 'priority' and 'background' lanes.
+        '''
+        with self._lock:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'waiting': {'priority': len(self._waiters[True]), 'background': len(self._waiters[False])},
+                'baseline_latency': self.baseline_latency,
+                'last_window': dict(self.last_window) if self.last_window is not None else None,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'lanes': {
+                    'priority': self._lanes[True].snapshot(),
+                    'background': self._lanes[False].snapshot(),
+                },
+            }
+
+    def to_prometheus(self, prefix='asrestclient'):
+        '''Render the limit and queueing delays in the Prometheus text exposition format'''
+        stats = self.stats()
+        lines = []
+
+        def family(name, metric_type, help_text, samples):
+            lines.append('# HELP {prefix}_{name} {help}'.format(prefix=prefix, name=name, help=help_text))
+            lines.append('# TYPE {prefix}_{name} {type}'.format(prefix=prefix, name=name, type=metric_type))
+            for labels, value in samples:
+                lines.append('{prefix}_{name}{labels} {value}'.format(
+                    prefix=prefix, name=name, value=value,
+                    labels='{{lane="{}"}}'.format(labels) if labels else ''))
+
+        lanes = sorted(stats['lanes'].items())
+        family('concurrency_limit', 'gauge', 'The adaptive limit on requests in flight.',
+               [(None, stats['limit'])])
+        family('concurrency_inflight', 'gauge', 'Requests in flight.', [(None, stats['inflight'])])
+        family('concurrency_waiting', 'gauge', 'Requests waiting to be sent, by lane.',
+               sorted(stats['waiting'].items()))
+        family('concurrency_queue_delay_seconds_sum', 'counter',
+               'Seconds requests waited to be sent, by lane.',
+               [(lane, lane_stats['queue_delay_sum']) for lane, lane_stats in lanes])
+        family('concurrency_queue_delay_seconds_count', 'counter', 'Requests admitted, by lane.',
+               [(lane, lane_stats['admitted']) for lane, lane_stats in lanes])
+        family('concurrency_timeouts_total', 'counter',
+               'Requests which waited longer than the queue delay limit.',
+               [(lane, lane_stats['timed_out']) for lane, lane_stats in lanes])
+        return '\n'.join(lines) + '\n'
+
+    def _admissible(self, priority):
+        '''Whether a request of the lane may be admitted now. Callers hold the lock.'''
+        if priority:
+            return self.inflight < int(self.limit)
+        if self._waiters[True]:
+            return False
+        reserved = int(self.limit * self.priority_reserve)
+        return self.inflight < max(1, int(self.limit) - reserved)
+
+    def _admit(self, priority, queue_delay):
+        '''Admit a request. Callers hold the lock.'''
+        self.inflight += 1
+        self._window_max_inflight = max(self._window_max_inflight, self.inflight)
+        lane = self._lanes[priority]
+        lane.admitted += 1
+        lane.queue_delay_sum += queue_delay
+        lane.queue_delay_max = max(lane.queue_delay_max, queue_delay)
+        return Permit(priority, queue_delay)
+
+    def _admit_waiters(self):
+        '''Admit waiting requests in order while they fit. Callers hold the lock.'''
+        for priority in (True, False):
+            waiters = self._waiters[priority]
+            while waiters and self._admissible(priority):
+                waiter = waiters.popleft()
+                waiter.permit = self._admit(priority, time.monotonic() - waiter.queued_at)
+                waiter.wake()
+
+    def _admitted_or_timed_out(self, waiter, priority):
+        with self._lock:
+            if waiter.permit is not None:
+                return waiter.permit
+            self._waiters[priority].remove(waiter)
+            self._lanes[priority].timed_out += 1
+        raise restclientconnector.ConcurrencyLimitError(
+            'Request waited more than {:.3f}s to be sent, {} requests are in flight'.format(
+                time.monotonic() - waiter.queued_at, self.inflight))
+
+    def _adjust(self, now):
+        '''Adjust the limit from the window which just ended. Callers hold the lock.'''
+        latency = self._window_latency / self._window_samples
+        failure_rate = self._window_failures / self._window_samples
+        if self.baseline_latency is None or latency < self.baseline_latency:
+            self.baseline_latency = latency
+        else:
+            # Lets the baseline follow a lasting change in the REST client's unloaded latency
+            self.baseline_latency *= 1.01
+
+        limit = self.limit
+        if failure_rate > self.error_threshold:
+            limit *= self.backoff
+        elif latency > self.tolerance * self.baseline_latency:
+            # Cut in proportion to the rise in latency, but by no more than half
+            limit *= max(0.5, self.tolerance * self.baseline_latency / latency)
+        elif self._window_max_inflight >= limit / 2:
+            # A limit which is not being used is not raised, or an idle limiter would reach max_limit
+            limit += math.sqrt(limit)
+        limit = min(max(limit, self.min_limit), self.max_limit)
+
+        if int(limit) > int(self.limit):
+            self.increases += 1
+        elif int(limit) < int(self.limit):
+            self.decreases += 1
+        self.limit = limit
+        self.last_window = {'latency': latency, 'failure_rate': failure_rate, 'samples': self._window_samples}
+        self._reset_window(now)
+
+    def _reset_window(self, now):
+        self._window_started = now
+        self._window_samples = 0
+        self._window_latency = 0.0
+        self._window_failures = 0
+        self._window_max_inflight = self.inflight
+
+
+class AsyncAdaptiveLimiter(AdaptiveLimiter):
+    '''
+    An AdaptiveLimiter for AsyncASRestClientConnector, whose `acquire` is a coroutine. It must only
+    be used from one event loop.
+    '''
+
+    async def acquire(self, priority=None):
+        '''Wait until a request may be sent, see `AdaptiveLimiter.acquire`'''
+        priority = _priority.get() if priority is None else priority
+        with self._lock:
+            if self._admissible(priority):
+                return self._admit(priority, 0.0)
+            waiter = _AsyncWaiter(asyncio.get_running_loop().create_future())
+            self._waiters[priority].append(waiter)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_queue_delay)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # A request cancelled while waiting must not keep its place or its admission
+            permit = self._cancel(waiter, priority)
+            if permit is not None:
+                self._discard(permit)
+            raise
+        return self._admitted_or_timed_out(waiter, priority)
+
+    def _cancel(self, waiter, priority):
+        with self._lock:
+            if waiter.permit is None:
+                self._waiters[priority].remove(waiter)
+            return waiter.permit
+
+    def _discard(self, permit):
+        '''Free the slot of a permit whose request was never sent. It is not a latency sample, as a
+        near zero latency would be taken as a sign the limit can grow.'''
+        with self._lock:
+            self.inflight -= 1
+            self._admit_waiters()
+
+
+class _ThreadWaiter(object):
+
+    __slots__ = ('event', 'permit', 'queued_at')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.permit = None
+        self.queued_at = time.monotonic()
+
+    def wake(self):
+        self.event.set()
+
+
+class _AsyncWaiter(object):
+
+    __slots__ = ('future', 'permit', 'queued_at')
+
+    def __init__(self, future):
+        self.future = future
+        self.permit = None
+        self.queued_at = time.monotonic()
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
@@ -0,0 +1,214 @@
+'''
+Per operation metrics for the connectors, with snapshot, Prometheus text and callback exports
+'''
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+NOT_FOUND_ERROR = 'not_found'
+EXISTS_ERROR = 'exists'
+OTHER_ERROR = 'other'
+
+
+class Histogram(object):
+    '''
+    A fixed bucket histogram. Not thread safe, callers hold a lock.
+    '''
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is for observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        '''Estimate a percentile as the upper bound of the bucket it falls in
+
+        Returns:
+            float, None: The estimate, infinity if it is above the largest bucket, or None
+                if there are no observations.
+        '''
+        if not self.count:
+            return None
+
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(0.50),
+            'p99': self.percentile(0.99),
+        }
+
+
+class OperationStats(object):
+    '''
+    Counters for one operation on one namespace and set. Not thread safe, callers hold a lock.
+    '''
+
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.status_counts = {}
+        self.errors = {NOT_FOUND_ERROR: 0, EXISTS_ERROR: 0, OTHER_ERROR: 0}
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def snapshot(self):
+        return {
+            'requests': self.latency.count,
+            'status_counts': dict(self.status_counts),
+            'errors': dict(self.errors),
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class ConnectorMetrics(object):
+    '''
+    Collects request counts, bytes, status codes, errors and latencies for each
+    (operation, namespace, setname) sent by a connector. It is thread safe.
+
+    Pass an instance as the `metrics` argument of a connector to enable instrumentation.
+    '''
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS, hooks=None):
+        '''constructor
+
+        Args:
+            buckets (list[float]) optional: Upper bounds of the latency histogram buckets in seconds.
+            hooks (list[callable]) optional: Callbacks invoked after every request with the arguments
+                (operation, namespace, setname, status, latency, request_bytes, response_bytes).
+                `status` is 0 if no response was received. Hooks run on the calling thread, so they
+                should be quick, and must not raise.
+        '''
+        self.buckets = tuple(buckets)
+        self.hooks = list(hooks or [])
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        '''Add a callback invoked after every request, see the constructor'''
+        self.hooks.append(hook)
+
+    def record(self, operation, namespace, setname, status, latency, request_bytes=0, response_bytes=0):
+        '''Record the outcome of a request
+
+        Args:
+            operation (str): The connector method which sent the request, e.g. `'get_record'`.
+            namespace (str): The namespace of the request.
+            setname (str): The set of the request.
+            status (int): The HTTP status code, or 0 if no response was received.
+            latency (float): The time taken in seconds.
+            request_bytes (int) optional: The size of the request body.
+            response_bytes (int) optional: The size of the response body.
+        '''
+        labels = (operation, namespace, setname)
+        with self._lock:
+            stats = self._stats.get(labels)
+            if stats is None:
+                stats = self._stats[labels] = OperationStats(self.buckets)
+
+            stats.latency.observe(latency)
+            stats.status_counts[status] = stats.status_counts.get(status, 0) + 1
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            if status == 404:
+                stats.errors[NOT_FOUND_ERROR] += 1
+            elif status == 409:
+                stats.errors[EXISTS_ERROR] += 1
+            elif not status or status >= 400:
+                stats.errors[OTHER_ERROR] += 1
+
+        for hook in self.hooks:
+            hook(operation, namespace, setname, status, latency, request_bytes, response_bytes)
+
+    def snapshot(self):
+        '''Get a copy of all metrics
+
+        Returns:
+            dict: Maps (operation, namespace, setname) to a dict of the requests, status_counts,
+                errors, request_bytes, response_bytes and latency histogram.
+        '''
+        with self._lock:
+            return {labels: stats.snapshot() for labels, stats in self._stats.items()}
+
+    def reset(self):
+        '''Drop all collected metrics'''
+        with self._lock:
+            self._stats = {}
+
+    def to_prometheus(self, prefix='asrestclient'):
+        '''Render the metrics in the Prometheus text exposition format
+
+        Returns:
+            str: The metrics, suitable for serving from a /metrics endpoint.
+        '''
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, metric_type, help_text):
+            lines.append('# HELP {prefix}_{name} {help}'.format(prefix=prefix, name=name, help=help_text))
+            lines.append('# TYPE {prefix}_{name} {type}'.format(prefix=prefix, name=name, type=metric_type))
+
+        def sample(name, labels, value, **extra):
+            all_labels = {'operation': labels[0], 'namespace': labels[1], 'set': labels[2]}
+            all_labels.update(extra)
+            lines.append('{prefix}_{name}{{{labels}}} {value}'.format(
+                prefix=prefix, name=name, value=value,
+                labels=','.join('{}="{}"'.format(key, _escape(val)) for key, val in sorted(all_labels.items()))))
+
+        family('requests_total', 'counter', 'Requests sent to the REST client by status code.')
+        for labels, stats in sorted(snapshot.items(), key=_sort_key):
+            for status, count in sorted(stats['status_counts'].items()):
+                sample('requests_total', labels, count, status=status)
+
+        family('errors_total', 'counter', 'Failed requests by kind of error.')
+        for labels, stats in sorted(snapshot.items(), key=_sort_key):
+            for kind, count in sorted(stats['errors'].items()):
+                sample('errors_total', labels, count, kind=kind)
+
+        family('request_bytes_total', 'counter', 'Bytes of request bodies sent.')
+        for labels, stats in sorted(snapshot.items(), key=_sort_key):
+            sample('request_bytes_total', labels, stats['request_bytes'])
+
+        family('response_bytes_total', 'counter', 'Bytes of response bodies received.')
+        for labels, stats in sorted(snapshot.items(), key=_sort_key):
+            sample('response_bytes_total', labels, stats['response_bytes'])
+
+        family('request_duration_seconds', 'histogram', 'Request latency in seconds.')
+        for labels, stats in sorted(snapshot.items(), key=_sort_key):
+            latency = stats['latency']
+            cumulative = 0
+            for bound in [str(bound) for bound in self.buckets] + ['+Inf']:
+                cumulative += latency['buckets'][bound]
+                sample('request_duration_seconds_bucket', labels, cumulative, le=bound)
+            sample('request_duration_seconds_sum', labels, latency['sum'])
+            sample('request_duration_seconds_count', labels, latency['count'])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _sort_key(item):
+    return tuple(str(label) for label in item[0])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,201 @@
+'''
+Caches of keys recently found to be missing, so lookups of them can skip the request
+
+Two implementations share the same interface:
+
+- NegativeCache is an exact set of keys, each kept for `ttl` seconds, and capped at `max_entries`.
+- BloomNegativeCache holds many more keys in fixed memory, at the cost of sometimes reporting a
+  key as missing when it was never added, at the configured false positive rate.
+
+Both are thread safe.
+'''
+import collections
+import hashlib
+import math
+import threading
+import time
+
+
+class NegativeCache(object):
+    '''
+    An exact set of missing keys, each expiring `ttl` seconds after it was added. When
+    `max_entries` keys are held, the oldest is dropped to make room.
+    '''
+
+    def __init__(self, ttl=60.0, max_entries=100000):
+        '''constructor
+
+        Args:
+            ttl (float) optional: The number of seconds a key is remembered as missing. Default: `60.0`
+            max_entries (int) optional: The maximum number of keys held. Default: `100000`
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Maps key to expiry time, in insertion order so the oldest keys are first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        '''Remember a key as missing'''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.monotonic() + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def contains(self, key):
+        '''Check whether a key is known to be missing, counting a hit or a miss'''
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                expires = None
+
+            if expires is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def discard(self, key):
+        '''Forget a key, as it may have been written'''
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''Get the hits, misses, invalidations and number of keys held'''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self._entries)}
+
+
+class BloomNegativeCache(object):
+    '''
+    Missing keys held in two Bloom filters, the current one receiving new keys. Every `ttl / 2`
+    seconds, or once the current filter holds `capacity` keys, the older filter is dropped and a
+    new current one started, so a key is remembered for between `ttl / 2` and `ttl` seconds and
+    the false positive rate stays at most `false_positive_rate` per filter.
+
+    Keys cannot be removed from a Bloom filter, so discarded keys are held exactly until the
+    filters they may be in have been dropped.
+    '''
+
+    def __init__(self, ttl=60.0, capacity=1000000, false_positive_rate=0.001):
+        '''constructor
+
+        Args:
+            ttl (float) optional: The maximum number of seconds a key is remembered as missing.
+                Default: `60.0`
+            capacity (int) optional: The number of keys per filter. With the false positive rate it
+                sets the memory used, see `memory_bytes`. Default: `1000000`
+            false_positive_rate (float) optional: The probability of a key which was not added being
+                reported as missing, once a filter is full. Default: `0.001`
+        '''
+        self.ttl = ttl
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        # The optimal number of bits and hash functions for the capacity and false positive rate
+        self.bit_count = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.rotations = 0
+        self._current = bytearray((self.bit_count + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._current_count = 0
+        self._rotated_at = time.monotonic()
+        # Maps discarded keys to the rotation they were discarded in
+        self._discarded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def memory_bytes(self):
+        '''The memory used by the filters'''
+        return 2 * len(self._current)
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            self._maybe_rotate()
+            self._discarded.pop(key, None)
+            for position in positions:
+                self._current[position >> 3] |= 1 << (position & 7)
+            self._current_count += 1
+
+    def contains(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            self._maybe_rotate()
+            found = key not in self._discarded and (
+                self._all_set(self._current, positions) or self._all_set(self._previous, positions))
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found
+
+    def discard(self, key):
+        with self._lock:
+            # The key may be in either filter, both of which are dropped by the next two rotations
+            self._discarded[key] = self.rotations
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._current = bytearray(len(self._current))
+            self._previous = bytearray(len(self._current))
+            self._current_count = 0
+            self._discarded.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'rotations': self.rotations, 'entries': self._current_count,
+                    'memory_bytes': self.memory_bytes}
+
+    def _positions(self, key):
+        # Double hashing, the positions are first + i * second for each hash function
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.bit_count for index in range(self.hash_count)]
+
+    def _maybe_rotate(self):
+        now = time.monotonic()
+        if now - self._rotated_at < self.ttl / 2 and self._current_count < self.capacity:
+            return
+
+        expired = now - self._rotated_at >= self.ttl
+        self._current_count = 0
+        self._rotated_at = now
+        self.rotations += 1
+        if expired:
+            # Every key in both filters has expired, so neither is kept, nor are the discards
+            self._current[:] = bytes(len(self._current))
+            self._previous[:] = bytes(len(self._previous))
+            self._discarded.clear()
+            return
+
+        self._previous, self._current = self._current, self._previous
+        self._current[:] = bytes(len(self._current))
+        # A key discarded in rotation r may be in the filter which became the previous one in
+        # rotation r + 1, which is only dropped in rotation r + 2
+        self._discarded = {
+            key: rotation for key, rotation in self._discarded.items() if self.rotations - rotation < 2}
+
+    @staticmethod
+    def _all_set(bits, positions):
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
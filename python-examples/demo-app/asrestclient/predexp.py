@@ -0,0 +1,148 @@
+'''
+Builder for REST client predicate expression filters
+
+Expressions are built from bins and record metadata and combined with `&`, `|` and `~`:
+
+    exp = (predexp.digest_modulo(3, '==', 1) | predexp.last_update('>=', 1577880000)
+           | (predexp.Bin('c') >= 11) & ~(predexp.Bin('c') < 20))
+    client.get_record('test', 'foo', 'bar', predexp=exp)
+
+The base64 encoded form sent to the REST client is computed once per expression and reused,
+so an expression may be built once and passed to any number of single, batch and scan reads.
+'''
+import base64
+import functools
+
+PREDEXP_PARAM = 'predexp'
+
+
+class PredExp(object):
+    '''
+    A predicate expression. Instances are immutable and may be shared between threads.
+    '''
+
+    __slots__ = ('expression', '_encoded')
+
+    def __init__(self, expression):
+        '''constructor
+
+        Args:
+            expression (str): The expression in the REST client's predicate expression syntax.
+        '''
+        self.expression = expression
+        self._encoded = None
+
+    @property
+    def encoded(self):
+        '''The base64 encoded expression, as sent in the `predexp` query param'''
+        if self._encoded is None:
+            self._encoded = encode(self.expression)
+        return self._encoded
+
+    def __and__(self, other):
+        return PredExp('({left} and {right})'.format(left=self.expression, right=_expression(other)))
+
+    def __or__(self, other):
+        return PredExp('({left} or {right})'.format(left=self.expression, right=_expression(other)))
+
+    def __invert__(self):
+        return PredExp('not ({})'.format(self.expression))
+
+    def __str__(self):
+        return self.expression
+
+    def __repr__(self):
+        return 'PredExp({!r})'.format(self.expression)
+
+
+class Bin(object):
+    '''
+    A bin in a predicate expression, compared to a value with the usual comparison operators.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def _compare(self, operator, value):
+        return PredExp('{name} {op} {value}'.format(name=self.name, op=operator, value=_literal(value)))
+
+    def __eq__(self, value):
+        return self._compare('==', value)
+
+    def __ne__(self, value):
+        return self._compare('!=', value)
+
+    def __gt__(self, value):
+        return self._compare('>', value)
+
+    def __ge__(self, value):
+        return self._compare('>=', value)
+
+    def __lt__(self, value):
+        return self._compare('<', value)
+
+    def __le__(self, value):
+        return self._compare('<=', value)
+
+    __hash__ = object.__hash__
+
+
+def digest_modulo(modulo, operator, value):
+    '''Compare the record digest modulo `modulo` to value'''
+    return PredExp('DIGEST_MODULO({modulo}, {op}, {value})'.format(modulo=modulo, op=operator, value=value))
+
+
+def last_update(operator, timestamp):
+    '''Compare the time the record was last updated, in seconds since the epoch, to timestamp'''
+    return PredExp('LAST_UPDATE({op}, {ts})'.format(op=operator, ts=timestamp))
+
+
+def void_time(operator, timestamp):
+    '''Compare the time the record expires, in seconds since the epoch, to timestamp'''
+    return PredExp('VOID_TIME({op}, {ts})'.format(op=operator, ts=timestamp))
+
+
+@functools.lru_cache(maxsize=1024)
+def encode(expression):
+    '''Base64 encode an expression string, caching the result for repeated expressions'''
+    return base64.b64encode(expression.encode('utf-8')).decode('ascii')
+
+
+class EncodedParam(str):
+    '''A `predexp` query param value which has been encoded, so it is not encoded again'''
+    __slots__ = ()
+
+
+def encode_param(value):
+    '''Get the value of the `predexp` query param for a PredExp, an expression string or
+    an already encoded expression (bytes or an EncodedParam)'''
+    if isinstance(value, EncodedParam):
+        return value
+    if isinstance(value, PredExp):
+        return EncodedParam(value.encoded)
+    if isinstance(value, str):
+        return EncodedParam(encode(value))
+    return value
+
+
+def encode_params(query_params):
+    '''Get a copy of a connector method's query params with any `predexp` encoded, leaving the
+    caller's dict unchanged'''
+    query_params = dict(query_params)
+    if PREDEXP_PARAM in query_params:
+        query_params[PREDEXP_PARAM] = encode_param(query_params[PREDEXP_PARAM])
+    return query_params
+
+
+def _expression(value):
+    if isinstance(value, PredExp):
+        return value.expression
+    return str(value)
+
+
+def _literal(value):
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
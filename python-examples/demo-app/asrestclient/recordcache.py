@@ -0,0 +1,174 @@
+'''
+In process cache of records read through the ASRestClientConnector
+'''
+import collections
+import threading
+import time
+
+
+class _CacheEntry(object):
+
+    __slots__ = ('content', 'generation', 'expires')
+
+    def __init__(self, content, generation, expires):
+        self.content = content
+        self.generation = generation
+        self.expires = expires
+
+
+class RecordCache(object):
+    '''
+    A thread safe LRU cache of encoded records, bounded by entry count and by bytes.
+
+    Entries expire when the record's ttl runs out, or after `max_staleness` seconds, whichever
+    comes first. Local writes invalidate entries, and a read which was started before an
+    invalidation, or which returns an older generation than one already seen, is not cached.
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, max_staleness=60):
+        '''constructor
+
+        Args:
+            max_entries (int) optional: The maximum number of cached records. Default: `10000`
+            max_bytes (int) optional: The maximum total size of the cached records. Default: 64 MiB
+            max_staleness (float) optional: The maximum number of seconds a record is served from the
+                cache, `None` to rely on the record ttl only. Default: `60`
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_staleness = max_staleness
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # Keys which were recently invalidated, mapped to (sequence, generation). Bounded like
+        # the entries themselves, they stop late reads from re-populating stale records.
+        self._floors = collections.OrderedDict()
+        self._sequence = 0
+        # Reads started before this sequence can no longer be checked against their key's floor
+        self._forgotten_sequence = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Get the encoded record cached for key
+
+        Args:
+            key (tuple): The (namespace, setname, digest) of the record.
+        Returns:
+            bytes, None: The encoded record, None if it is not cached or has expired.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.content
+
+    def sequence(self):
+        '''Get a token to be passed to `put` for a read which is about to be sent.'''
+        with self._lock:
+            return self._sequence
+
+    def put(self, key, content, generation, ttl, sequence):
+        '''Cache an encoded record
+
+        Args:
+            key (tuple): The (namespace, setname, digest) of the record.
+            content (bytes): The encoded record.
+            generation (int): The generation of the record.
+            ttl (int): The remaining time to live of the record in seconds, -1 or 0 if it never expires.
+            sequence (int): The value returned by `sequence` before the record was read.
+        '''
+        if len(content) > self.max_bytes:
+            return
+
+        now = time.monotonic()
+        expires = now + ttl if ttl is not None and ttl > 0 else None
+        if self.max_staleness is not None:
+            expires = min(expires, now + self.max_staleness) if expires is not None else now + self.max_staleness
+
+        with self._lock:
+            if sequence < self._forgotten_sequence:
+                return
+
+            floor = self._floors.get(key)
+            if floor is not None:
+                floor_sequence, floor_generation = floor
+                if sequence < floor_sequence:
+                    return
+                if floor_generation is not None and generation is not None and generation < floor_generation:
+                    return
+
+            current = self._entries.get(key)
+            if current is not None:
+                if current.generation is not None and generation is not None and generation < current.generation:
+                    return
+                self._remove(key)
+
+            self._entries[key] = _CacheEntry(content, generation, expires)
+            self._bytes += len(content)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, key, generation=None):
+        '''Drop the record cached for key after a local write
+
+        Args:
+            key (tuple): The (namespace, setname, digest) of the record.
+            generation (int) optional: The generation of the record after the write, if known. Reads
+                returning an older generation will not be cached.
+        '''
+        with self._lock:
+            self._sequence += 1
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+            self._floors[key] = (self._sequence, generation)
+            self._floors.move_to_end(key)
+            while len(self._floors) > self.max_entries:
+                _, (floor_sequence, _) = self._floors.popitem(last=False)
+                self._forgotten_sequence = max(self._forgotten_sequence, floor_sequence)
+
+    def clear(self):
+        '''Drop every cached record'''
+        with self._lock:
+            self._sequence += 1
+            self._forgotten_sequence = self._sequence
+            self._entries.clear()
+            self._floors.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''Get the cache counters
+
+        Returns:
+            dict: The hits, misses, evictions and invalidations, along with the current entry count and size.
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.content)
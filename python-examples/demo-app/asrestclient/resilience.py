@@ -0,0 +1,185 @@
+'''
+Retries with backoff, hedged reads and per endpoint circuit breakers for the connector
+'''
+import random
+import threading
+import time
+
+from . import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Statuses returned by an unhealthy or overloaded REST tier, rather than for the request itself
+DEFAULT_RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class CircuitBreaker(object):
+    '''
+    Tracks the health of one endpoint. After `failure_threshold` consecutive failures the
+    breaker opens and requests are rejected without being sent. After `reset_timeout` seconds
+    a single trial request is let through, which closes the breaker if it succeeds and opens
+    it again if it fails. It is thread safe.
+    '''
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.trips = 0
+        self.rejections = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''Check whether a request may be sent, counting it as a rejection if not'''
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+            self.rejections += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def cancel_trial(self):
+        '''Give back the trial slot of a request which was allowed but not sent, leaving the state unchanged'''
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+                self.trips += 1
+
+
+class Resilience(object):
+    '''
+    Settings and state for the resilience features of a connector. Pass an instance as the
+    `resilience` argument of an ASRestClientConnector to enable them:
+
+    - Retries: reads and retry safe writes (replace and update) which fail to connect, or get
+      one of `retry_statuses`, are retried up to `max_attempts` times in total. The delay before
+      each retry is drawn uniformly from zero to an exponentially growing bound (full jitter),
+      so clients which failed together do not retry together.
+    - Hedging: if a read has not completed after the `hedge_percentile` latency of its endpoint,
+      a second identical request is sent and the first response to arrive is used. Hedging only
+      starts once `hedge_min_samples` requests to the endpoint have completed.
+    - Circuit breaking: each endpoint (kvs, operate, batch, scan ...) has a CircuitBreaker, and
+      requests to an endpoint whose breaker is open fail immediately with CircuitOpenError.
+    '''
+
+    def __init__(self, max_attempts=3, backoff_base=0.05, backoff_max=1.0,
+                 retry_statuses=DEFAULT_RETRY_STATUSES, hedge=True, hedge_percentile=0.95,
+                 hedge_min_delay=0.001, hedge_min_samples=100, failure_threshold=5, reset_timeout=30.0):
+        '''constructor
+
+        Args:
+            max_attempts (int) optional: The maximum number of attempts of a retryable request,
+                `1` disables retries. Default: `3`
+            backoff_base (float) optional: The bound in seconds of the delay before the first retry,
+                doubled for each further retry. Default: `0.05`
+            backoff_max (float) optional: The largest bound in seconds of a retry delay. Default: `1.0`
+            retry_statuses (tuple[int]) optional: The HTTP statuses which are retried and counted as
+                failures by the circuit breakers. Default: `(500, 502, 503, 504)`
+            hedge (bool) optional: Whether to send hedged requests for reads. Default: `True`
+            hedge_percentile (float) optional: The latency percentile of an endpoint after which a
+                hedged request is sent. Default: `0.95`
+            hedge_min_delay (float) optional: The smallest delay in seconds before a hedged request.
+                Default: `0.001`
+            hedge_min_samples (int) optional: The number of completed requests to an endpoint needed
+                before hedging its reads. Default: `100`
+            failure_threshold (int) optional: The number of consecutive failures which opens an
+                endpoint's circuit breaker. Default: `5`
+            reset_timeout (float) optional: The number of seconds a breaker stays open before a trial
+                request is allowed. Default: `30.0`
+        '''
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = frozenset(retry_statuses)
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        '''Get the circuit breaker of an endpoint'''
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = self._breakers[endpoint] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def backoff(self, retry):
+        '''Get the delay in seconds before a retry, the first retry being 0'''
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    def hedge_delay(self, endpoint):
+        '''Get the delay in seconds before hedging a read to an endpoint, or None not to hedge it'''
+        if not self.hedge:
+            return None
+        with self._lock:
+            latency = self._latencies.get(endpoint)
+            if latency is None or latency.count < self.hedge_min_samples:
+                return None
+            delay = latency.percentile(self.hedge_percentile)
+        # A percentile in the overflow bucket is no basis for a hedge
+        if delay == float('inf'):
+            return None
+        return max(delay, self.hedge_min_delay)
+
+    def observe(self, endpoint, latency):
+        '''Record the latency of a completed request to an endpoint'''
+        with self._lock:
+            histogram = self._latencies.get(endpoint)
+            if histogram is None:
+                histogram = self._latencies[endpoint] = metrics.Histogram()
+            histogram.observe(latency)
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        '''Get the retry, hedge and circuit breaker counters
+
+        Returns:
+            dict: The number of `retries`, `hedges` sent, `hedge_wins` where the hedged request
+                answered first, and per endpoint `breakers` with their state, trips and rejections.
+        '''
+        with self._lock:
+            breakers = dict(self._breakers)
+            stats = {'retries': self.retries, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
+        stats['breakers'] = {
+            endpoint: {'state': breaker.state, 'trips': breaker.trips, 'rejections': breaker.rejections}
+            for endpoint, breaker in breakers.items()
+        }
+        return stats
@@ -1,5 +1,21 @@
-import requests
+from concurrent import futures
 import base64
+import contextvars
+import threading
+import time
+
+import requests
+import requests.adapters
+import urllib3
+
+from . import compression
+from . import constants
+from . import digest
+from . import predexp
+from . import routing
+from . import scan
+from . import streaming
+from . import wireformat
 
 class RestClientAPIError(Exception):
     pass
@@ -13,48 +29,255 @@ class RecordExistsError(RestClientAPIError):
     pass
 
 
+class CircuitOpenError(RestClientAPIError):
+    pass
+
+
+class ConcurrencyLimitError(RestClientAPIError):
+    pass
+
+
+class SpoolFullError(RestClientAPIError):
+    pass
+
+
+class ResponseTooLargeError(RestClientAPIError):
+    pass
+
+
+class BulkWriteResult(object):
+    '''
+    Summary of a bulk write. Only the keys and errors of failed writes are kept.
+    '''
+
+    def __init__(self, max_failures=1000):
+        '''constructor
+
+        Args:
+            max_failures (int) optional: The maximum number of failures to keep details for.
+                Failures beyond this are only counted. Default: `1000`
+        '''
+        self.successes = 0
+        self.existing = 0
+        self.failed = 0
+        self.failures = []
+        self.max_failures = max_failures
+
+    def add_failure(self, userkey, error):
+        self.failed += 1
+        if len(self.failures) < self.max_failures:
+            self.failures.append((userkey, error))
+
+    def __repr__(self):
+        return 'BulkWriteResult(successes={successes}, existing={existing}, failed={failed})'.format(
+            successes=self.successes, existing=self.existing, failed=self.failed)
+
+
 class ASRestClientConnector(object):
     '''
     Class used to talk to Aerospike Rest Client
     '''
 
-    def __init__(self, base_uri='http://localhost:8080'):
+    def __init__(self, base_uri='http://localhost:8080', pool_connections=10, pool_maxsize=10,
+                 pool_block=False, connect_timeout=None, read_timeout=None, warm_up=0,
+                 max_batch_size=1000, wire_format=constants.JSON_WIRE_FORMAT, cache=None, metrics=None,
+                 resilience=None, routing_policy=routing.POWER_OF_TWO_CHOICES, key_affinity=False,
+                 health_check_interval=5.0, max_body_bytes=None, max_bin_bytes=None, compression=None,
+                 limiter=None):
         '''constructor
            The constructor builds a base endpoint for RestClient operations of the form:
            base_uri/v1
+           All operations share a single pooled session, so connections to the REST client are
+           kept alive and reused instead of being re-established for every record operation.
+           The connector is safe to share between threads.
+           Given several REST client addresses, each request is routed to one of them.
         Args:
-            base_uri (str) optional: The address on which the Rest client is listening.
+            base_uri (str, list[str]) optional: The address on which the Rest client is listening, or
+                the addresses of several REST client instances to spread requests over.
                 Default: `'http://localhost:8080'`
+            pool_connections (int) optional: The number of distinct host connection pools to cache.
+                Default: `10`
+            pool_maxsize (int) optional: The maximum number of keep-alive connections kept per host.
+                Default: `10`
+            pool_block (bool) optional: If `True` a request waits for a free connection when
+                `pool_maxsize` connections are in use, instead of opening a throwaway connection.
+                Default: `False`
+            connect_timeout (float) optional: Seconds to wait when establishing a connection.
+                Default: `None` (wait forever)
+            read_timeout (float) optional: Seconds to wait for the REST client to send a response.
+                Default: `None` (wait forever)
+            warm_up (int) optional: The number of connections to open at construction time.
+                Default: `0`
+            max_batch_size (int) optional: The maximum number of keys sent in a single batch
+                request. Larger batches are split and the parts are sent concurrently.
+                Default: `1000`
+            wire_format (str) optional: The encoding of request and response bodies, either `'json'` or
+                `'msgpack'`. MessagePack is cheaper to encode and decode, sends bytes bins without
+                base64 encoding them and preserves non string map keys. Default: `'json'`
+            cache (RecordCache) optional: A cache used to serve `get_record` calls without query params.
+                Writes made through this connector invalidate its entries. Default: `None`
+            metrics (ConnectorMetrics) optional: Collects latency, byte, status code and error
+                metrics for every request. Default: `None`
+            resilience (Resilience) optional: Enables retries with backoff for reads and retry safe
+                writes, hedged reads, and per endpoint circuit breakers. Default: `None`
+            routing_policy (str) optional: With several addresses, how the instance for a request is
+                chosen, `'p2c'` (power of two choices) or `'least_outstanding'`, see Router.
+                Default: `'p2c'`
+            key_affinity (bool) optional: With several addresses, route the requests for a record to the
+                same instance. Batch and scan requests are not affected. Default: `False`
+            health_check_interval (float) optional: With several addresses, the number of seconds between
+                background health checks of the instances. Default: `5.0`
+            max_body_bytes (int) optional: The largest response body read by a streamed request, see
+                `get_record`, or decompressed when compression is enabled. Default: no limit
+            max_bin_bytes (int) optional: The largest encoded bin decoded from a streamed MessagePack
+                response. Default: no limit
+            compression (Compression) optional: Compresses large request bodies, and requests compressed
+                responses which are decompressed as they are read, counting the bytes saved and the CPU
+                time spent. Default: `None`
+            limiter (AdaptiveLimiter) optional: Limits the requests in flight, adapting the limit to the
+                REST client's latency and failures. Every request, including each retry and hedge, waits
+                for the limiter, and requests sent within `limiter.priority_lane()` are admitted first. A
+                streamed request holds its permit until its response is closed. Requests the limiter
+                rejects are neither retried nor counted as failures of the REST client. Default: `None`
+        Raises:
+            ValueError: If the wire_format or routing_policy is not supported, or no address is given.
         '''
 
+        # Requests are built against the first address, and sent to the address chosen by the router
+        base_uris = None
+        if not isinstance(base_uri, str):
+            base_uris = list(base_uri)
+            if not base_uris:
+                raise ValueError('At least one REST client address is required')
+            base_uri = base_uris[0]
+
         # Build the base rest endpoint: base_uri/v1
         base_uri = base_uri + '/' if base_uri[-1] != '/' else base_uri
         self.rest_endpoint = base_uri + 'v1'
         self.kvs_endpoint = self.rest_endpoint + '/kvs'
         self.operate_endpoint = self.rest_endpoint + '/operate'
+        self.batch_endpoint = self.rest_endpoint + '/batch'
+        self.scan_endpoint = self.rest_endpoint + '/scan'
+
+        self.max_batch_size = max_batch_size
+        self.wire_format = wire_format
+        self._headers = wireformat.get_headers(wire_format)
+        self.compression = compression
+        if compression is not None:
+            self._headers['Accept-Encoding'] = compression.accept_encoding_header
+        self.cache = cache
+        self.metrics = metrics
+        self.resilience = resilience
+        self.limiter = limiter
+        self.max_body_bytes = max_body_bytes
+        self.max_bin_bytes = max_bin_bytes
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._executor = None
+        self._hedge_executor = None
+        self._executor_lock = threading.Lock()
+
+        self.router = None
+        if base_uris is not None:
+            self.router = routing.Router(
+                base_uris, check=self._check_health, policy=routing_policy, key_affinity=key_affinity,
+                health_check_interval=health_check_interval)
+
+        if warm_up:
+            self.warm_up(warm_up)
+
+    def warm_up(self, connections):
+        '''Open connections to the REST client ahead of the first record operation.
 
-    def get_record(self, namespace, setname, userkey, **query_params):
+        Args:
+            connections (int): The number of connections to establish. It is capped at the
+                pool's per host size, as any extra connections would be discarded.
+        Raises:
+            RestClientAPIError: If the REST client could not be reached.
+        '''
+        connections = min(connections, self.pool_maxsize)
+        cluster_uri = self.rest_endpoint + '/cluster'
+
+        # The requests have to be in flight at the same time, otherwise a single connection
+        # would be reused for all of them.
+        with futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            for response in executor.map(
+                    lambda _: self._request('GET', cluster_uri), range(connections)):
+                response.close()
+
+    def close(self):
+        '''Close all pooled connections and worker threads held by the connector.'''
+        if self.router is not None:
+            self.router.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown()
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_record(self, namespace, setname, userkey, bins=None, stream=False, **query_params):
         '''Retrieve a map representation of a record stored in aerospike
 
         Args:
             namespace (str): The namespace for the record.
             setname (str, int): The setname for the record.
             userkey (str) optional: The userkey of the record.
-            query_params (Map[str:str]) optional: A Map of query params.
+            bins (list[str]) optional: The names of the bins to retrieve. Default: all bins.
+            stream (bool) optional: If `True` the response is read incrementally, failing once it is
+                larger than `max_body_bytes`. With the MessagePack wire format the record's bins are
+                decoded lazily, see LazyRecord. Streamed reads are not cached. Default: `False`
+            query_params (Map[str:str]) optional: A Map of query params. A `predexp` may be
+                given as a PredExp or an expression string, it is encoded by the connector.
         Returns:
             dict: A dictionary containing entries for 'bins', 'generation' and 'ttl'
                 example: {'bins': {'a': 1, 'b': 'c'}, 'generation': 2, 'ttl': 1234}
         Raises:
             RecordNotFoundError: If the specified record does not exist.
+            ResponseTooLargeError: If a streamed response is larger than the connector's limits.
             RestClientAPIError: If an error is encountered communicating with the Endpoint.
         '''
-        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
-        response = requests.get(record_uri, params=query_params)
+        query_params = predexp.encode_params(query_params)
+        # Query params may change what is returned, so only plain reads are cached
+        cache = self.cache if not set(query_params) - {'keytype'} and bins is None and not stream else None
+        if cache is not None:
+            cache_key = self._cache_key(namespace, setname, userkey, query_params.get('keytype'))
+            content = cache.get(cache_key)
+            if content is not None:
+                return wireformat.decode(self.wire_format, content)
+            sequence = cache.sequence()
+
+        if bins is not None:
+            query_params['bins'] = list(bins)
 
-        if response.ok:
-            return response.json()
-
-        self.raise_from_response(response, msg='Get record failed: ')
+        record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
+        response = self._request(
+            'GET', record_uri, labels=('get_record', namespace, setname), retry=True, hedge=not stream,
+            affinity_key=userkey, stream=stream, params=query_params)
+
+        try:
+            if response.ok:
+                record = self._decode_stream(response, 'get_record') if stream else self._decode(response)
+                if cache is not None:
+                    cache.put(cache_key, self._body(response), record.get('generation'), record.get('ttl'), sequence)
+                return record
+
+            self.raise_from_response(response, msg='Get record failed: ')
+        finally:
+            if stream:
+                # Ends the request, releasing its limiter permit
+                response.close()
 
     def create_record(self, namespace, setname, userkey, bins, **query_params):
         '''Store a new record in the Aerospike database.
@@ -69,8 +292,10 @@ class ASRestClientConnector(object):
             RecordExistsError: If the specified record already exists.
             RestClientAPIError: If an error is encountered communicating with the Endpoint.
         '''
+        query_params = predexp.encode_params(query_params)
         record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
-        response = requests.post(record_uri, json=bins, params=query_params)
+        response = self._write_request(
+            'create_record', namespace, setname, userkey, 'POST', record_uri, body=bins, params=query_params)
 
         if response.ok:
             return
@@ -90,8 +315,11 @@ class ASRestClientConnector(object):
             RecordNotFoundError: If the specified record does not exist.
             RestClientAPIError: If an error is encountered communicating with the Endpoint.
         '''
+        query_params = predexp.encode_params(query_params)
         record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
-        response = requests.patch(record_uri, json=bins, params=query_params)
+        response = self._write_request(
+            'update_record', namespace, setname, userkey, 'PATCH', record_uri, body=bins, retry=True,
+            params=query_params)
 
         if response.ok:
             return
@@ -111,8 +339,11 @@ class ASRestClientConnector(object):
             RecordNotFoundError: If the specified record does not yet exist.
             RestClientAPIError: If an error is encountered communicating with the Endpoint.
         '''
+        query_params = predexp.encode_params(query_params)
         record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
-        response = requests.put(record_uri, json=bins, params=query_params)
+        response = self._write_request(
+            'replace_record', namespace, setname, userkey, 'PUT', record_uri, body=bins, retry=True,
+            params=query_params)
 
         if response.ok:
             return
@@ -131,15 +362,17 @@ class ASRestClientConnector(object):
             RecordNotFoundError: If the specified record does not exist.
             RestClientAPIError: If an error is encountered communicating with the Endpoint.
         '''
+        query_params = predexp.encode_params(query_params)
         record_uri = self._get_record_uri(self.kvs_endpoint, namespace, setname, userkey)
-        response = requests.delete(record_uri, params=query_params)
+        response = self._write_request(
+            'delete_record', namespace, setname, userkey, 'DELETE', record_uri, params=query_params)
 
         if response.ok:
             return
 
         self.raise_from_response(response, msg='Delete record failed: ')
 
-    def operate_record(self, namespace, setname, userkey, operations, **query_params):
+    def operate_record(self, namespace, setname, userkey, operations, stream=False, **query_params):
         '''Perform a series of operations on the specified record.
 
         Args:
@@ -147,6 +380,8 @@ class ASRestClientConnector(object):
             setname (str, int): The setname for the record.
             userkey (str) optional: The userkey of the record.
             operations (list[dict[str:any]]): A list of operation dicts.
+            stream (bool) optional: If `True` the response is read incrementally and decoded lazily,
+                as for `get_record`. Default: `False`
             query_params (Map[str:str]) optional: A Map of query params.
         Example:
             ops = [{'operation': 'READ', 'opValues': {'bin': 'b1'}}]
@@ -157,13 +392,510 @@ class ASRestClientConnector(object):
         Raises:
             RestClientAPIError: If an error is encountered when performing the operations
         '''
+        query_params = predexp.encode_params(query_params)
+        # Only reads are safe to send more than once
+        read_only = all(operation.get(constants.OPERATION_NAME) == constants.READ_OP for operation in operations)
         operate_uri = self._get_record_uri(self.operate_endpoint, namespace, setname, userkey)
-        response = requests.post(operate_uri, json=operations, params=query_params)
+        record = None
+        try:
+            response = self._request(
+                'POST', operate_uri, body=operations, labels=('operate_record', namespace, setname),
+                retry=read_only, hedge=read_only and not stream, affinity_key=userkey, stream=stream,
+                params=query_params)
+            try:
+                if response.ok:
+                    record = self._decode_stream(response, 'operate_record') if stream else self._decode(response)
+                    return record
+
+                self.raise_from_response(response, msg='Operate on record failed: ')
+            finally:
+                if stream:
+                    response.close()
+        finally:
+            # Reads leave any cached copy valid. A write is invalidated once it is done, with the
+            # generation it returned, so reads racing with it cannot cache an older one.
+            if not read_only and self.cache is not None:
+                self.cache.invalidate(self._cache_key(namespace, setname, userkey, query_params.get('keytype')),
+                                      record.get('generation') if record is not None else None)
+
+    def create_records(self, namespace, setname, records, errror_if_exists=True, max_in_flight=None,
+                       after_write=None, **query_params):
+        '''Store many new records in the Aerospike database, with several writes in flight at once.
+
+        The records are consumed lazily, so they may be produced by a generator. At most
+        `max_in_flight` of them are held in memory at a time.
+
+        Args:
+            namespace (str): The namespace for the records.
+            setname (str, int): The setname for the records.
+            records (iterable[(str, dict[str:any])]): Pairs of userkey and the bins to store
+                in the record with that key.
+            errror_if_exists (bool) optional: A flag indicating whether a record which already exists
+                should be reported as a failure. If `False` it is only counted as existing. Default: `True`
+            max_in_flight (int) optional: The maximum number of concurrent writes.
+                Default: the connection pool size.
+            after_write (callable) optional: Called by the worker after each write as
+                `after_write(userkey, bins, error)`, error being None if the record was created.
+            query_params (Map[str:str]) optional: A Map of query params.
+        Returns:
+            BulkWriteResult: The number of records written, already existing and failed, along with
+                the keys and errors of the failed writes.
+        '''
+        query_params = predexp.encode_params(query_params)
+        max_in_flight = max_in_flight or self.pool_maxsize
+        result = BulkWriteResult()
+        result_lock = threading.Lock()
+
+        def create(record):
+            userkey, bins = record
+            error = None
+            try:
+                self.create_record(namespace, setname, userkey, bins, **query_params)
+            except RecordExistsError as ree:
+                error = ree
+                with result_lock:
+                    if errror_if_exists:
+                        result.add_failure(userkey, ree)
+                    else:
+                        result.existing += 1
+            except RestClientAPIError as rce:
+                error = rce
+                with result_lock:
+                    result.add_failure(userkey, rce)
+            else:
+                with result_lock:
+                    result.successes += 1
+            if after_write is not None:
+                after_write(userkey, bins, error)
+
+        self._run_bounded(create, records, max_in_flight)
+        return result
+
+    @staticmethod
+    def _run_bounded(func, items, max_in_flight):
+        '''Call func on every item using max_in_flight threads, consuming items lazily'''
+        items = iter(items)
+        items_lock = threading.Lock()
+        exhausted = object()
+
+        def worker():
+            # The workers share the iterator, so each item is handed to exactly one of them
+            while True:
+                with items_lock:
+                    item = next(items, exhausted)
+                if item is exhausted:
+                    return
+                func(item)
+
+        with futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            workers = [executor.submit(worker) for _ in range(max_in_flight)]
+        for finished in workers:
+            finished.result()
+
+    def get_records(self, namespace, setname, userkeys, bins=None, group_by_partition=False, **query_params):
+        '''Retrieve several records stored in aerospike using the batch endpoint.
+
+        If there are more than `max_batch_size` keys, they are split into several batch requests
+        which are sent concurrently.
+
+        Args:
+            namespace (str): The namespace for the records.
+            setname (str, int): The setname for the records.
+            userkeys (list[str]): The userkeys of the records.
+            bins (list[str]) optional: The names of the bins to retrieve. Default: all bins.
+            group_by_partition (bool) optional: If `True` the keys are sent by digest, ordered by
+                partition, so each batch request covers fewer partitions. Default: `False`
+            query_params (Map[str:str]) optional: A Map of query params. A `keytype` entry is
+                applied to every key in the batch. A `predexp` filters the records server side.
+        Example:
+            records = client.get_records('test', 'demo', ['1', '2'], bins=['b1'])
+        Returns:
+            list[dict, None]: One entry per userkey, in the same order. Each entry is a dictionary
+                containing entries for 'bins', 'generation' and 'ttl', or None if the record
+                does not exist.
+        Raises:
+            RestClientAPIError: If an error is encountered communicating with the Endpoint.
+        '''
+        query_params = predexp.encode_params(query_params)
+        keytype = query_params.pop('keytype', None)
+        if group_by_partition:
+            order, userkeys = digest.group_by_partition(setname, userkeys, keytype)
+            keytype = constants.DIGEST_KEYTYPE
+        batch_requests = self._build_batch_requests(namespace, setname, userkeys, bins, keytype)
+
+        sub_batches = [
+            batch_requests[start:start + self.max_batch_size]
+            for start in range(0, len(batch_requests), self.max_batch_size)
+        ]
+
+        if len(sub_batches) <= 1:
+            batch_results = [
+                self._get_batch(namespace, setname, sub_batch, query_params) for sub_batch in sub_batches]
+        else:
+            batch_results = self._get_executor().map(
+                lambda sub_batch: self._get_batch(namespace, setname, sub_batch, query_params), sub_batches)
+
+        records = [batch_record['record'] for batch_result in batch_results for batch_record in batch_result]
+        if group_by_partition:
+            return digest.restore_order(records, order)
+        return records
+
+    def scan(self, namespace, setname, bins=None, page_size=1000, cursor=None, record_factory=None,
+             **query_params):
+        '''Iterate over every record in a set.
+
+        Records are fetched a page at a time from the scan endpoint, and the next page is fetched in
+        the background while the current one is consumed, so memory use does not grow with the size
+        of the set.
+
+        Args:
+            namespace (str): The namespace to scan.
+            setname (str): The set to scan.
+            bins (list[str]) optional: The names of the bins to retrieve. Default: all bins.
+            page_size (int) optional: The maximum number of records fetched per request. Default: `1000`
+            cursor (dict) optional: The `cursor` of an earlier scan, to resume after the last record
+                it returned.
+            record_factory (callable) optional: Applied to every record before it is returned.
+            query_params (Map[str:str]) optional: A Map of query params.
+        Example:
+            records = client.scan('test', 'demo', page_size=100)
+            for record in records:
+                checkpoint(records.cursor)
+        Returns:
+            ScanIterator: An iterator of dictionaries containing entries for 'bins', 'generation',
+                'ttl' and 'key'.
+        Raises:
+            RestClientAPIError: If an error is encountered communicating with the Endpoint. Errors
+                fetching a page are raised when that page is reached.
+        '''
+        query_params = predexp.encode_params(query_params)
+        scan_uri = '{endpoint}/{ns}/{setname}'.format(endpoint=self.scan_endpoint, ns=namespace, setname=setname)
+
+        def fetch_page(token, page_size):
+            params = dict(query_params)
+            params[scan.MAX_RECORDS_PARAM] = page_size
+            if token:
+                params[scan.FROM_TOKEN_PARAM] = token
+            if bins is not None:
+                params['bins'] = list(bins)
+
+            response = self._request(
+                'GET', scan_uri, labels=('scan', namespace, setname), retry=True, hedge=True, params=params)
+
+            if response.ok:
+                return self._decode(response)
+
+            self.raise_from_response(response, msg='Scan failed: ')
+
+        return scan.ScanIterator(
+            fetch_page, self._get_executor(), page_size, cursor=cursor, record_factory=record_factory)
+
+    def _get_batch(self, namespace, setname, batch_requests, query_params):
+        response = self._request(
+            'POST', self.batch_endpoint, body=batch_requests, labels=('get_records', namespace, setname),
+            retry=True, hedge=True, params=query_params)
 
         if response.ok:
-            return response.json()
+            return self._decode(response)
+
+        self.raise_from_response(response, msg='Get records failed: ')
+
+    @staticmethod
+    def _build_batch_requests(namespace, setname, userkeys, bins=None, keytype=None):
+        '''Build the body of a batch read request, one entry per userkey'''
+        batch_requests = []
+        for userkey in userkeys:
+            key = {'namespace': namespace, 'setName': setname, 'userKey': str(userkey)}
+            if keytype:
+                key['keytype'] = keytype
+
+            batch_request = {'key': key, 'readAllBins': bins is None}
+            if bins is not None:
+                batch_request['binNames'] = list(bins)
+            batch_requests.append(batch_request)
+
+        return batch_requests
+
+    def _get_executor(self):
+        '''Lazily create the thread pool used to dispatch concurrent requests'''
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(max_workers=self.pool_maxsize)
+            return self._executor
+
+    def _get_hedge_executor(self):
+        '''Lazily create the thread pool used to send hedged requests. It is separate from the
+        dispatch pool, whose threads may themselves be waiting on hedged requests.'''
+        with self._executor_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = futures.ThreadPoolExecutor(max_workers=2 * self.pool_maxsize)
+            return self._hedge_executor
+
+    def _write_request(self, operation, namespace, setname, userkey, method, uri, **kwargs):
+        '''Send a request which may modify a record, invalidating any cached copy of it'''
+        try:
+            return self._request(
+                method, uri, labels=(operation, namespace, setname), affinity_key=userkey, **kwargs)
+        finally:
+            # Invalidate once the write is done, so reads racing with it are not cached
+            if self.cache is not None:
+                self.cache.invalidate(self._cache_key(namespace, setname, userkey, kwargs['params'].get('keytype')))
 
-        self.raise_from_response(response, msg='Operate on record failed: ')
+    @staticmethod
+    def _cache_key(namespace, setname, userkey, keytype=None):
+        '''Get the key a record is cached under, built from its digest so that requests addressing it
+        with different keytypes share one entry'''
+        try:
+            return namespace, setname, digest.digest_key(setname, userkey, keytype)
+        except ValueError:
+            # A keytype or key the REST client will reject, whose record cannot have been cached
+            return namespace, setname, str(userkey), keytype
+
+    def _request(self, method, uri, body=None, labels=None, retry=False, hedge=False, affinity_key=None,
+                 **kwargs):
+        '''Send a request over the pooled session, wrapping connection failures.
+
+        The body is encoded, and the response is requested, in the connector's wire format.
+        If metrics are enabled the request is recorded under labels, an
+        (operation, namespace, setname) tuple. If resilience is enabled the request may be
+        retried when retry is `True`, and hedged when hedge is `True`, so both must only be
+        set for requests which are safe to send more than once. With several REST client
+        instances, affinity_key is the key of the record the request is for.
+        '''
+        content_encoding = None
+        if body is not None:
+            data = kwargs['data'] = wireformat.encode(self.wire_format, body)
+            if self.compression is not None:
+                kwargs['data'], content_encoding = self.compression.compress(labels and labels[0], data)
+                if content_encoding is not None:
+                    kwargs['headers'] = dict(self._headers, **{'Content-Encoding': content_encoding})
+        kwargs.setdefault('headers', self._headers)
+        kwargs.setdefault('timeout', self.timeout)
+
+        response = self._send_request(method, uri, labels, kwargs, retry, hedge, affinity_key)
+        if content_encoding is not None and response.status_code == compression.UNSUPPORTED_MEDIA_TYPE:
+            # The REST client does not accept compressed bodies, so they are no longer compressed
+            response.close()
+            self.compression.reject(content_encoding)
+            kwargs.update(data=data, headers=self._headers)
+            response = self._send_request(method, uri, labels, kwargs, retry, hedge, affinity_key)
+        return response
+
+    def _send_request(self, method, uri, labels, kwargs, retry, hedge, affinity_key):
+        if self.resilience is None:
+            return self._send(method, uri, labels, kwargs, affinity_key)
+        return self._resilient_send(method, uri, labels, kwargs, retry, hedge, affinity_key)
+
+    def _resilient_send(self, method, uri, labels, kwargs, retry, hedge, affinity_key):
+        '''Send a request through the circuit breaker of its endpoint, retrying and hedging it'''
+        resilience = self.resilience
+        # The first path segment after /v1, e.g. 'kvs' or 'batch'
+        endpoint = uri[len(self.rest_endpoint):].split('/')[1]
+        breaker = resilience.breaker(endpoint)
+        attempts = resilience.max_attempts if retry else 1
+
+        for attempt in range(attempts):
+            if attempt:
+                resilience.count('retries')
+                time.sleep(resilience.backoff(attempt - 1))
+
+            if not breaker.allow():
+                raise CircuitOpenError('Request to {uri} failed: the circuit breaker for {endpoint} is open'.format(
+                    uri=uri, endpoint=endpoint))
+
+            try:
+                if hedge:
+                    response = self._hedged_send(endpoint, method, uri, labels, kwargs, affinity_key)
+                else:
+                    response = self._timed_send(endpoint, method, uri, labels, kwargs, affinity_key)
+            except ConcurrencyLimitError:
+                # Rejected by the local limiter without being sent, so not a failure of the endpoint,
+                # but a half open breaker's trial slot must be given back for another request to use
+                breaker.cancel_trial()
+                raise
+            except RestClientAPIError:
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+                continue
+
+            if response.status_code not in resilience.retry_statuses:
+                breaker.record_success()
+                return response
+
+            breaker.record_failure()
+            if attempt + 1 == attempts:
+                return response
+            # Release the connection of a streamed response which will not be read
+            response.close()
+
+    def _hedged_send(self, endpoint, method, uri, labels, kwargs, affinity_key):
+        '''Send a request, and a second copy of it if the first is slower than usual for the endpoint.
+        The first successful response is returned.'''
+        delay = self.resilience.hedge_delay(endpoint)
+        if delay is None:
+            return self._timed_send(endpoint, method, uri, labels, kwargs, affinity_key)
+
+        executor = self._get_hedge_executor()
+        # Run in copies of the caller's context, so the requests stay in the caller's limiter lane
+        primary = executor.submit(
+            contextvars.copy_context().run, self._timed_send, endpoint, method, uri, labels, kwargs, affinity_key)
+        done, _ = futures.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self.resilience.count('hedges')
+        hedged = executor.submit(
+            contextvars.copy_context().run, self._timed_send, endpoint, method, uri, labels, kwargs, affinity_key)
+        pending = {primary, hedged}
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                if succeeded[0] is hedged:
+                    self.resilience.count('hedge_wins')
+                return succeeded[0].result()
+        # A failure of one request is only raised if the other fails too
+        return primary.result()
+
+    def _timed_send(self, endpoint, method, uri, labels, kwargs, affinity_key):
+        '''Send a request, recording its latency for the hedging delay of the endpoint'''
+        start = time.perf_counter()
+        response = self._send(method, uri, labels, kwargs, affinity_key)
+        self.resilience.observe(endpoint, time.perf_counter() - start)
+        return response
+
+    def _send(self, method, uri, labels, kwargs, affinity_key=None):
+        '''Send a single request to the instance chosen by the router'''
+        if self.router is None:
+            return self._send_to(method, uri, labels, kwargs)
+
+        node = self.router.acquire(affinity_key)
+        failed = True
+        try:
+            response = self._send_to(method, node.rest_endpoint + uri[len(self.rest_endpoint):], labels, kwargs)
+            failed = False
+            return response
+        except ConcurrencyLimitError:
+            # Rejected by the local limiter without reaching the node
+            failed = False
+            raise
+        finally:
+            self.router.release(node, failed)
+
+    def _send_to(self, method, uri, labels, kwargs):
+        '''Send a single request, recording it in the metrics'''
+        if self.metrics is None or labels is None:
+            try:
+                return self._session_request(method, uri, labels, kwargs)
+            except requests.RequestException as rex:
+                raise RestClientAPIError('Request to {uri} failed: {err}'.format(uri=uri, err=rex))
+
+        start = time.perf_counter()
+        request_bytes = len(kwargs.get('data') or b'')
+        try:
+            response = self._session_request(method, uri, labels, kwargs)
+        except requests.RequestException as rex:
+            self.metrics.record(*labels, status=0, latency=time.perf_counter() - start,
+                                request_bytes=request_bytes)
+            raise RestClientAPIError('Request to {uri} failed: {err}'.format(uri=uri, err=rex))
+
+        # Reading the content of a streamed response here would defeat streaming it
+        if kwargs.get('stream'):
+            response_bytes = int(response.headers.get('Content-Length') or 0)
+        else:
+            response_bytes = len(self._body(response))
+        self.metrics.record(*labels, status=response.status_code, latency=time.perf_counter() - start,
+                            request_bytes=request_bytes, response_bytes=response_bytes)
+        return response
+
+    def _session_request(self, method, uri, labels, kwargs):
+        if self.limiter is None:
+            return self._read_response(method, uri, labels, kwargs)
+
+        permit = self.limiter.acquire()
+        # A request which fails without a response, e.g. by timing out, is a sign of overload too
+        failed = True
+        response = None
+        try:
+            response = self._read_response(method, uri, labels, kwargs)
+            failed = response.status_code >= 500
+            if kwargs.get('stream'):
+                # The body of a streamed response is yet to be read, the request is in flight until it is closed
+                self._release_on_close(response, permit, failed)
+            return response
+        finally:
+            if response is None or not kwargs.get('stream'):
+                self.limiter.release(permit, failed)
+
+    def _release_on_close(self, response, permit, failed):
+        '''Release a limiter permit when a streamed response is closed'''
+        close = response.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.limiter.release(permit, failed)
+
+        response.close = close_and_release
+
+    def _read_response(self, method, uri, labels, kwargs):
+        if self.compression is None:
+            return self._session.request(method, uri, **kwargs)
+
+        # The body is read by the connector rather than by requests, to decompress it with the compression
+        response = self._session.request(method, uri, **dict(kwargs, stream=True))
+        if not kwargs.get('stream'):
+            # Kept by the connector, as requests would read the already consumed raw body for its content
+            response.decoded_body = bytes(streaming.read_body(
+                response, self.max_body_bytes, self._decompressed_chunks(response, labels and labels[0])))
+        return response
+
+    def _decompressed_chunks(self, response, operation):
+        '''Read the raw body of a streamed response, decompressing it as it is read'''
+        try:
+            decoder = self.compression.decoder(
+                operation, response.headers.get('Content-Encoding'), max_output_size=self.max_body_bytes)
+            yield from decoder.iter_decoded(response.raw.stream(streaming.CHUNK_SIZE, decode_content=False))
+        except ResponseTooLargeError:
+            response.close()
+            raise
+        except (urllib3.exceptions.HTTPError, OSError, ValueError) as err:
+            response.close()
+            raise RestClientAPIError('Reading the response from {uri} failed: {err}'.format(
+                uri=response.url, err=err))
+
+    def _check_health(self, node):
+        '''Check whether a REST client instance responds to a cluster info request'''
+        try:
+            # A node which does not answer within an interval is unhealthy, whatever the request timeouts
+            response = self._session.get(
+                node.rest_endpoint + '/cluster', timeout=self.router.health_check_interval)
+        except requests.RequestException:
+            return False
+        return response.ok
+
+    def _decode(self, response):
+        return wireformat.decode(self.wire_format, self._body(response))
+
+    @staticmethod
+    def _body(response):
+        '''Get the body of a response which was not streamed, as decompressed by the connector if compression
+        is enabled'''
+        body = getattr(response, 'decoded_body', None)
+        return response.content if body is None else body
+
+    def _decode_stream(self, response, operation):
+        chunks = self._decompressed_chunks(response, operation) if self.compression is not None else None
+        content = streaming.read_body(response, self.max_body_bytes, chunks)
+        if self.wire_format == constants.MSGPACK_WIRE_FORMAT:
+            return streaming.LazyRecord(content, self.max_bin_bytes)
+        # JSON has to be parsed as a whole, only the size of the body is bounded
+        return wireformat.decode(self.wire_format, content)
 
     @staticmethod
     def _get_record_uri(endpoint, namespace, setname, userkey):
@@ -175,13 +907,23 @@ class ASRestClientConnector(object):
     @staticmethod
     def raise_from_response(response, msg=''):
 
+        body = getattr(response, 'decoded_body', None)
+        text = response.text if body is None else body.decode(response.encoding or 'utf-8', 'replace')
+
         if response.status_code == 404:
-            raise RecordNotFound(msg + response.text)
+            raise RecordNotFoundError(msg + text)
 
         if response.status_code == 409:
-            raise RecordExistsError(response.text)
+            raise RecordExistsError(msg + text)
+
+        raise RestClientAPIError(msg + text)
 
-        raise RestClientAPIError(msg + response.text)
+    @staticmethod
+    def digest_key(setname, userkey, keytype=None):
+        '''Get the userkey addressing a record by its digest, computed locally. It is sent with
+        `keytype=DIGEST`, e.g. `client.get_record(ns, setname, client.digest_key(setname, key), keytype='DIGEST')`
+        '''
+        return digest.digest_key(setname, userkey, keytype)
 
     @staticmethod
     def encode_bytes_key(bytes_key):
@@ -0,0 +1,160 @@
+'''
+Routing of requests across several REST client instances, with background health checks
+'''
+import hashlib
+import random
+import threading
+
+LEAST_OUTSTANDING = 'least_outstanding'
+POWER_OF_TWO_CHOICES = 'p2c'
+
+
+class Node(object):
+    '''
+    A REST client instance, with the number of requests in flight to it and its health.
+    '''
+
+    def __init__(self, base_uri):
+        base_uri = base_uri + '/' if base_uri[-1] != '/' else base_uri
+        self.base_uri = base_uri
+        self.rest_endpoint = base_uri + 'v1'
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        # Fixed per node, so the nodes' rendezvous scores can be computed from a key alone
+        self.hash_prefix = hashlib.blake2b(base_uri.encode('utf-8'), digest_size=8).digest()
+
+    def __repr__(self):
+        return 'Node({!r}, healthy={}, outstanding={})'.format(self.base_uri, self.healthy, self.outstanding)
+
+
+class Router(object):
+    '''
+    Chooses the node each request is sent to. It is thread safe.
+
+    Requests go to the node with the fewest requests in flight, either out of every node
+    (`'least_outstanding'`) or out of two nodes picked at random (`'p2c'`), which is nearly as
+    well balanced and does not make every client pile onto the same idle node.
+
+    With key affinity, requests for a record always go to the same healthy node, chosen by
+    rendezvous hashing, so the record stays in that node's caches and a node leaving the
+    rotation only moves its own keys.
+
+    A node is taken out of the rotation after `max_failures` consecutive requests to it fail to
+    get a response, or a health check fails, and is put back once a health check succeeds. If no
+    node is healthy, requests are spread over all of them.
+    '''
+
+    def __init__(self, base_uris, check=None, policy=POWER_OF_TWO_CHOICES, key_affinity=False,
+                 health_check_interval=5.0, max_failures=3):
+        '''constructor
+
+        Args:
+            base_uris (list[str]): The addresses of the REST client instances.
+            check (callable) optional: Called with a Node by the health checks, returns whether it is
+                healthy. Default: no background health checks.
+            policy (str) optional: `'p2c'` or `'least_outstanding'`. Default: `'p2c'`
+            key_affinity (bool) optional: Whether to route requests for a record to the same node.
+                Default: `False`
+            health_check_interval (float) optional: Seconds between health checks of all nodes.
+                Default: `5.0`
+            max_failures (int) optional: The number of consecutive failed requests which takes a node
+                out of the rotation. Default: `3`
+        Raises:
+            ValueError: If there are no base_uris or the policy is not supported.
+        '''
+        if not base_uris:
+            raise ValueError('At least one REST client address is required')
+        if policy not in (LEAST_OUTSTANDING, POWER_OF_TWO_CHOICES):
+            raise ValueError('Unsupported routing policy: {}'.format(policy))
+
+        self.nodes = [Node(base_uri) for base_uri in base_uris]
+        self.policy = policy
+        self.key_affinity = key_affinity
+        self.health_check_interval = health_check_interval
+        self.max_failures = max_failures
+        self._check = check
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._health_checker = None
+
+        if check is not None:
+            self._health_checker = threading.Thread(
+                target=self._run_health_checks, name='rest-client-health-checks', daemon=True)
+            self._health_checker.start()
+
+    def acquire(self, key=None):
+        '''Choose the node for a request, counting the request as in flight until `release`
+
+        Args:
+            key (str) optional: The key of the record the request is for, used for key affinity.
+        Returns:
+            Node: The node to send the request to.
+        '''
+        with self._lock:
+            candidates = [node for node in self.nodes if node.healthy] or self.nodes
+
+            if self.key_affinity and key is not None:
+                node = self._rendezvous(candidates, key)
+            elif len(candidates) == 1:
+                node = candidates[0]
+            elif self.policy == POWER_OF_TWO_CHOICES:
+                first, second = random.sample(candidates, 2)
+                node = first if first.outstanding <= second.outstanding else second
+            else:
+                fewest = min(node.outstanding for node in candidates)
+                node = random.choice([node for node in candidates if node.outstanding == fewest])
+
+            node.outstanding += 1
+            return node
+
+    def release(self, node, failed=False):
+        '''Record the end of a request to a node
+
+        Args:
+            node (Node): The node returned by `acquire`.
+            failed (bool) optional: Whether the request failed to get a response. Default: `False`
+        '''
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                if node.failures >= self.max_failures:
+                    node.healthy = False
+            else:
+                node.failures = 0
+
+    def check_health(self):
+        '''Run the health check against every node, updating whether they are in the rotation'''
+        for node in self.nodes:
+            try:
+                healthy = bool(self._check(node))
+            except Exception:
+                healthy = False
+
+            with self._lock:
+                node.healthy = healthy
+                if healthy:
+                    node.failures = 0
+
+    def stats(self):
+        '''Get the health and requests in flight of every node'''
+        with self._lock:
+            return {node.base_uri: {'healthy': node.healthy, 'outstanding': node.outstanding}
+                    for node in self.nodes}
+
+    def close(self):
+        '''Stop the background health checks'''
+        self._stopped.set()
+        if self._health_checker is not None:
+            self._health_checker.join()
+
+    def _run_health_checks(self):
+        while not self._stopped.wait(self.health_check_interval):
+            self.check_health()
+
+    @staticmethod
+    def _rendezvous(nodes, key):
+        '''Get the node with the highest hash of itself and the key'''
+        key = str(key).encode('utf-8')
+        return max(nodes, key=lambda node: hashlib.blake2b(node.hash_prefix + key, digest_size=8).digest())
@@ -0,0 +1,103 @@
+'''
+Paged iteration over every record in a set, using the REST client's scan endpoint
+'''
+
+# Names of the scan endpoint's query params
+MAX_RECORDS_PARAM = 'maxRecords'
+FROM_TOKEN_PARAM = 'from'
+
+
+class ScanIterator(object):
+    '''
+    Iterates over the records of a set one page at a time, fetching the next page in the
+    background while the current one is consumed. At most two pages are held in memory.
+
+    The position of the iterator is available from `cursor`, and a new scan started from a
+    saved cursor continues with the record after the last one returned.
+    '''
+
+    def __init__(self, fetch_page, executor, page_size, cursor=None, record_factory=None):
+        '''constructor
+
+        Args:
+            fetch_page (callable): Called with the token of a page, or None for the first page,
+                and the page size. Returns the decoded scan response.
+            executor (concurrent.futures.Executor): Runs the background page fetches.
+            page_size (int): The maximum number of records per page.
+            cursor (dict) optional: A cursor saved from an earlier scan to resume from.
+            record_factory (callable) optional: Applied to each record before it is returned.
+        '''
+        self._fetch_page = fetch_page
+        self._executor = executor
+        self._page_size = page_size
+        self._record_factory = record_factory
+
+        cursor = cursor or {}
+        # The token of the page being consumed, and the number of its records already returned
+        self._page_token = cursor.get('token')
+        self._offset = cursor.get('offset', 0)
+        self._skip = self._offset
+
+        self._records = []
+        self._index = 0
+        self._next_token = None
+        self._pending = self._executor.submit(self._fetch_page, self._page_token, self._page_size)
+        self._done = False
+
+    @property
+    def cursor(self):
+        '''The position of the scan, a JSON serializable dict which may be passed to a new scan'''
+        return {'token': self._page_token, 'offset': self._offset}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._index >= len(self._records):
+            if self._pending is None:
+                self._done = True
+            if self._done:
+                raise StopIteration
+            self._load_pending_page()
+
+        record = self._records[self._index]
+        # Drop the reference so records are released as they are consumed
+        self._records[self._index] = None
+        self._index += 1
+        self._offset += 1
+
+        if self._record_factory is not None:
+            return self._record_factory(record)
+        return record
+
+    def close(self):
+        '''Stop the scan, discarding any page being prefetched'''
+        self._done = True
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._records = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load_pending_page(self):
+        page = self._pending.result()
+        self._pending = None
+
+        if self._records:
+            # Moving on from a fully consumed page
+            self._page_token = self._next_token
+            self._offset = 0
+
+        self._records = page.get('records') or []
+        self._index = min(self._skip, len(self._records))
+        self._skip = 0
+        self._next_token = (page.get('pagination') or {}).get('nextToken')
+
+        # Prefetch the following page while this one is consumed
+        if self._next_token and self._records:
+            self._pending = self._executor.submit(self._fetch_page, self._next_token, self._page_size)
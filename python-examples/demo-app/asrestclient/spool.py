@@ -0,0 +1,253 @@
+'''
+An append only, memory mapped file of pending writes, which survives restarts
+
+Entries are appended at the end of the file and committed, in order, once they have been written
+to the REST client. Positions in the spool are logical offsets, which keep increasing as the file
+is compacted, so an offset identifies an entry for the life of the spool.
+
+The file starts with two header slots, written alternately and each with a checksum, so a crash
+while updating one leaves the other intact. Each entry is its length, a CRC32 checksum and its
+payload, and on opening the spool the entries after the committed offset are checked, stopping at
+the first damaged one.
+'''
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import restclientconnector
+
+MAGIC = b'ASRCSPL1'
+# seq, base, committed, end, then the CRC32 of those
+_HEADER_SLOT = struct.Struct('<QQQQI')
+_HEADER_SLOT_SIZE = 64
+_DATA_START = len(MAGIC) + 2 * _HEADER_SLOT_SIZE
+# length, then the CRC32 of the payload
+_ENTRY_HEADER = struct.Struct('<II')
+
+
+class Spool(object):
+    '''
+    A memory mapped spool file. It is thread safe, and only one Spool may have a file open at a time.
+
+    The region of the file before the committed offset is reclaimed once every entry has been
+    committed, or once it is larger than the entries left after it, by moving them to the start of
+    the file. The file grows, doubling, up to `max_size` when an entry does not fit.
+    '''
+
+    def __init__(self, path, initial_size=1024 * 1024, max_size=1024 * 1024 * 1024, sync_interval=0.0):
+        '''constructor
+
+        Args:
+            path (str): The spool file, created if it does not exist.
+            initial_size (int) optional: The size a new file is created with. Default: 1 MiB
+            max_size (int) optional: The largest the file may grow to. Default: 1 GiB
+            sync_interval (float) optional: The most seconds an appended entry may wait before being
+                synced to disk. `0` syncs every entry before `append` returns, `None` leaves syncing
+                to the OS, so entries survive the process crashing but not the machine. Default: `0`
+        Raises:
+            RestClientAPIError: If the file is not a spool, or is open in another Spool.
+        '''
+        self.path = path
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._synced_at = time.monotonic()
+
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._file.close()
+                raise restclientconnector.RestClientAPIError('Spool {} is in use by another process'.format(path))
+
+        if not exists:
+            self._file.truncate(max(initial_size, _DATA_START + 4096))
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+        if exists:
+            self._load()
+        else:
+            self._map[:len(MAGIC)] = MAGIC
+            self._header_seq = 0
+            self.base = self.committed = self.end = 0
+            self._write_header()
+            self._map.flush()
+
+    @property
+    def size(self):
+        '''The size of the file'''
+        return len(self._map)
+
+    def append(self, payload):
+        '''Append an entry
+
+        Args:
+            payload (bytes): The entry.
+        Returns:
+            int: The offset after the entry, which is committed once the entry has been written.
+        Raises:
+            SpoolFullError: If the spool is at its maximum size and the entry does not fit.
+        '''
+        length = _ENTRY_HEADER.size + len(payload)
+        with self._lock:
+            if self._position(self.end) + length > len(self._map):
+                self._make_room(length)
+
+            position = self._position(self.end)
+            _ENTRY_HEADER.pack_into(self._map, position, len(payload), zlib.crc32(payload))
+            self._map[position + _ENTRY_HEADER.size:position + length] = payload
+            self.end += length
+            self._write_header()
+            self._maybe_sync()
+            return self.end
+
+    def read(self, offset, max_entries):
+        '''Read the entries from offset
+
+        Args:
+            offset (int): The offset of the first entry to read, an offset returned by `append`, or
+                the committed offset.
+            max_entries (int): The most entries to return.
+        Returns:
+            list[(int, bytes)]: The offset after each entry, and its payload.
+        '''
+        entries = []
+        with self._lock:
+            offset = max(offset, self.committed)
+            while offset < self.end and len(entries) < max_entries:
+                position = self._position(offset)
+                length, _ = _ENTRY_HEADER.unpack_from(self._map, position)
+                start = position + _ENTRY_HEADER.size
+                offset += _ENTRY_HEADER.size + length
+                entries.append((offset, self._map[start:start + length]))
+        return entries
+
+    def commit(self, offset):
+        '''Mark the entries before offset as written, reclaiming their space when worthwhile'''
+        with self._lock:
+            if offset <= self.committed:
+                return
+            self.committed = min(offset, self.end)
+            self._write_header()
+            if self._compactable():
+                self._compact()
+            self._maybe_sync()
+
+    def sync(self):
+        '''Write every appended entry and the committed offset to disk'''
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._map.closed:
+                return
+            self._sync()
+            self._map.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _position(self, offset):
+        return _DATA_START + offset - self.base
+
+    def _make_room(self, length):
+        '''Compact or grow the file so an entry of length bytes fits. Callers hold the lock.'''
+        if self._compactable():
+            self._compact()
+            if self._position(self.end) + length <= len(self._map):
+                return
+
+        needed = self._position(self.end) + length
+        if needed > self.max_size:
+            raise restclientconnector.SpoolFullError(
+                'Spool {path} cannot hold another {length} bytes, {live} bytes are waiting to be written'.format(
+                    path=self.path, length=length, live=self.end - self.committed))
+
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        # The doubling may overshoot the largest size, which is still enough
+        size = min(size, self.max_size)
+
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _compactable(self):
+        '''Whether the committed entries take at least as much space as the uncommitted ones, so
+        the uncommitted ones can be moved over them. Callers hold the lock.'''
+        reclaimable = self.committed - self.base
+        return reclaimable > 0 and self.end - self.committed <= reclaimable
+
+    def _compact(self):
+        '''Move the uncommitted entries to the start of the file. Callers hold the lock, and check
+        `_compactable` first, so the entries are not overwritten while the header points at them.'''
+        live = self.end - self.committed
+        source = self._position(self.committed)
+        if live:
+            self._map[_DATA_START:_DATA_START + live] = self._map[source:source + live]
+            # The moved entries must be on disk before the header which points at them
+            if self.sync_interval is not None:
+                self._map.flush()
+        self.base = self.committed
+        self._write_header()
+
+    def _write_header(self):
+        '''Write the offsets to the older header slot. Callers hold the lock.'''
+        self._header_seq += 1
+        slot = len(MAGIC) + (self._header_seq % 2) * _HEADER_SLOT_SIZE
+        fields = (self._header_seq, self.base, self.committed, self.end)
+        _HEADER_SLOT.pack_into(self._map, slot, *(fields + (zlib.crc32(struct.pack('<QQQQ', *fields)),)))
+
+    def _load(self):
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            self._file.close()
+            raise restclientconnector.RestClientAPIError('{} is not a spool file'.format(self.path))
+
+        slots = []
+        for index in range(2):
+            fields = _HEADER_SLOT.unpack_from(self._map, len(MAGIC) + index * _HEADER_SLOT_SIZE)
+            if zlib.crc32(struct.pack('<QQQQ', *fields[:4])) == fields[4]:
+                slots.append(fields[:4])
+        if not slots:
+            self._map.close()
+            self._file.close()
+            raise restclientconnector.RestClientAPIError('The headers of spool {} are damaged'.format(self.path))
+        self._header_seq, self.base, self.committed, recorded_end = max(slots)
+
+        # Entries past the recorded end, or damaged by a crash while being written, are dropped
+        self.end = self.committed
+        while self.end < recorded_end:
+            position = self._position(self.end)
+            if position + _ENTRY_HEADER.size > len(self._map):
+                break
+            length, crc = _ENTRY_HEADER.unpack_from(self._map, position)
+            start = position + _ENTRY_HEADER.size
+            if start + length > len(self._map) or zlib.crc32(self._map[start:start + length]) != crc:
+                break
+            self.end += _ENTRY_HEADER.size + length
+        self._write_header()
+
+    def _maybe_sync(self):
+        if self.sync_interval is not None and time.monotonic() - self._synced_at >= self.sync_interval:
+            self._sync()
+
+    def _sync(self):
+        self._map.flush()
+        self._synced_at = time.monotonic()
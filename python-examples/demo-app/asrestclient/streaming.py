@@ -0,0 +1,218 @@
+'''
+Bounded reading of response bodies, and lazy decoding of the bins of MessagePack records
+
+Reading a large record normally decodes every bin, so a multi MB list or blob bin is held twice,
+as encoded bytes and as Python objects. A LazyRecord keeps the encoded body and only decodes the
+bins which are accessed, and returns bytes bins as views into the body rather than copies.
+'''
+import collections.abc
+import struct
+
+import msgpack
+
+from . import restclientconnector
+
+CHUNK_SIZE = 64 * 1024
+
+# The MessagePack type bytes of bin 8/16/32 values, and the size of their headers
+_BIN_HEADER_SIZES = {0xc4: 2, 0xc5: 3, 0xc6: 5}
+
+
+def read_body(response, max_body_bytes=None, chunks=None):
+    '''Read the body of a streamed response, failing as soon as it exceeds max_body_bytes
+
+    Args:
+        response (requests.Response): A response requested with `stream=True`.
+        max_body_bytes (int) optional: The largest body accepted. Default: no limit.
+        chunks (iterable[bytes]) optional: The decoded chunks of the body, when it is not decoded by
+            requests. Default: the response's content.
+    Returns:
+        bytearray: The body.
+    Raises:
+        ResponseTooLargeError: If the body is larger than max_body_bytes. The connection is closed
+            without reading the rest of the body.
+    '''
+    # A compressed body's length is not its decoded length, so it is only checked as it is read
+    length = response.headers.get('Content-Length')
+    length = int(length) if length is not None and not response.headers.get('Content-Encoding') else None
+    if max_body_bytes is not None and length is not None and length > max_body_bytes:
+        response.close()
+        raise _too_large('Response body of {} bytes'.format(length), max_body_bytes)
+
+    # Filling a body of known length in place avoids the copies made by growing it
+    body = bytearray(length or 0)
+    size = 0
+    for chunk in response.iter_content(CHUNK_SIZE) if chunks is None else chunks:
+        body[size:size + len(chunk)] = chunk
+        size += len(chunk)
+        if max_body_bytes is not None and size > max_body_bytes:
+            response.close()
+            raise _too_large('Response body of more than {} bytes'.format(size), max_body_bytes)
+    del body[size:]
+    return body
+
+
+class LazyRecord(collections.abc.Mapping):
+    '''
+    A record decoded from a MessagePack body, with the same entries as the records returned by
+    `get_record`. The body is scanned once to find where each bin is, and `record['bins']` is a
+    mapping which decodes a bin the first time it is accessed. Bytes bins are returned as
+    read only memoryviews of the body.
+    '''
+
+    def __init__(self, content, max_bin_bytes=None):
+        '''constructor
+
+        Args:
+            content (bytes, bytearray): The MessagePack encoded record.
+            max_bin_bytes (int) optional: The largest encoded bin which may be accessed. Default: no limit.
+        '''
+        self._fields = {}
+        buffer = memoryview(content).toreadonly()
+
+        position, items = _map_header(buffer, 0)
+        for _ in range(items):
+            field, position = _unpack_at(buffer, position)
+            if field != 'bins' or buffer[position] == 0xc0:
+                # Only the bins may be large, the other fields are decoded as they are, and nil bins are None
+                self._fields[field], position = _unpack_at(buffer, position)
+                continue
+
+            offsets = collections.OrderedDict()
+            position, bin_count = _map_header(buffer, position)
+            for _ in range(bin_count):
+                bin_name, position = _unpack_at(buffer, position)
+                end = _skip(buffer, position)
+                offsets[bin_name] = (position, end)
+                position = end
+            self._fields[field] = LazyBins(buffer, offsets, max_bin_bytes)
+
+    def __getitem__(self, field):
+        return self._fields[field]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+
+class LazyBins(collections.abc.Mapping):
+    '''
+    The bins of a LazyRecord, each decoded when first accessed. Not thread safe.
+    '''
+
+    def __init__(self, buffer, offsets, max_bin_bytes=None):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._max_bin_bytes = max_bin_bytes
+        self._decoded = {}
+
+    def encoded_size(self, bin_name):
+        '''Get the size of the encoded bin, without decoding it'''
+        start, end = self._offsets[bin_name]
+        return end - start
+
+    def __getitem__(self, bin_name):
+        if bin_name in self._decoded:
+            return self._decoded[bin_name]
+
+        start, end = self._offsets[bin_name]
+        if self._max_bin_bytes is not None and end - start > self._max_bin_bytes:
+            raise _too_large('Bin {!r} of {} bytes'.format(bin_name, end - start), self._max_bin_bytes)
+
+        encoded = self._buffer[start:end]
+        header_size = _BIN_HEADER_SIZES.get(encoded[0])
+        if header_size is not None:
+            value = encoded[header_size:]
+        else:
+            value = msgpack.unpackb(encoded, raw=False, strict_map_key=False)
+        self._decoded[bin_name] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, bin_name):
+        return bin_name in self._offsets
+
+
+def _unpack_at(buffer, position):
+    '''Decode the value at position, returning it and the position after it'''
+    end = _skip(buffer, position)
+    return msgpack.unpackb(buffer[position:end], raw=False, strict_map_key=False), end
+
+
+def _map_header(buffer, position):
+    '''Get the position of the first entry of the map at position, and its number of entries'''
+    size, items = _header(buffer, position)
+    if not 0x80 <= buffer[position] <= 0x8f and buffer[position] not in (0xde, 0xdf):
+        raise ValueError('Expected a MessagePack map at {}'.format(position))
+    return position + size, items // 2
+
+
+def _skip(buffer, position):
+    '''Get the position after the value at position, reading only the headers of its contents, so
+    skipping a large bin neither decodes nor copies it'''
+    remaining = 1
+    while remaining:
+        size, items = _header(buffer, position)
+        position += size
+        remaining += items - 1
+    return position
+
+
+def _header(buffer, position):
+    '''Get the size of the value at position excluding the values it contains, and the number of
+    values it contains'''
+    first = buffer[position]
+    if first <= 0x7f or first >= 0xe0 or first in (0xc0, 0xc2, 0xc3):
+        return 1, 0
+    if first <= 0x8f:
+        return 1, 2 * (first & 0x0f)
+    if first <= 0x9f:
+        return 1, first & 0x0f
+    if first <= 0xbf:
+        return 1 + (first & 0x1f), 0
+
+    fixed_size = _FIXED_SIZES.get(first)
+    if fixed_size is not None:
+        return fixed_size, 0
+
+    length_format, extra, kind = _SIZED_TYPES[first]
+    length = struct.unpack_from(length_format, buffer, position + 1)[0]
+    header_size = 1 + struct.calcsize(length_format)
+    if kind == _ARRAY:
+        return header_size, length
+    if kind == _MAP:
+        return header_size, 2 * length
+    return header_size + extra + length, 0
+
+
+# Sizes of the types whose size is given by their type byte
+_FIXED_SIZES = {
+    0xca: 5, 0xcb: 9,
+    0xcc: 2, 0xcd: 3, 0xce: 5, 0xcf: 9,
+    0xd0: 2, 0xd1: 3, 0xd2: 5, 0xd3: 9,
+    0xd4: 3, 0xd5: 4, 0xd6: 6, 0xd7: 10, 0xd8: 18,
+}
+
+_BYTES, _ARRAY, _MAP = 'bytes', 'array', 'map'
+
+# The format of the length of the types whose size follows their type byte, the size of any
+# extra header fields, and whether the length counts bytes or contained values
+_SIZED_TYPES = {
+    0xc4: ('>B', 0, _BYTES), 0xc5: ('>H', 0, _BYTES), 0xc6: ('>I', 0, _BYTES),
+    0xc7: ('>B', 1, _BYTES), 0xc8: ('>H', 1, _BYTES), 0xc9: ('>I', 1, _BYTES),
+    0xd9: ('>B', 0, _BYTES), 0xda: ('>H', 0, _BYTES), 0xdb: ('>I', 0, _BYTES),
+    0xdc: ('>H', 0, _ARRAY), 0xdd: ('>I', 0, _ARRAY),
+    0xde: ('>H', 0, _MAP), 0xdf: ('>I', 0, _MAP),
+}
+
+
+def _too_large(what, limit):
+    return restclientconnector.ResponseTooLargeError(
+        '{what} exceeds the limit of {limit} bytes'.format(what=what, limit=limit))
@@ -3,6 +3,10 @@ class User(object):
     '''
     A basic class representing a user
     '''
+
+    # Without a per instance __dict__, millions of users take a fraction of the memory
+    __slots__ = ('id', 'name', 'email', 'interests')
+
     def __init__(self, id, name, email, interests=None):
 
         interests = [] if not interests else interests
@@ -19,3 +23,97 @@ class User(object):
             email=repr(self.email),
             interests=('[' + ', '.join([repr(interest) for interest in self.interests]) + ']')
         )
+
+
+class UserView(object):
+    '''
+    A read only view of a stored user record, with the fields of a User. A field is only read
+    from the record's bins when it is accessed, so with a lazily decoded record the bins which are
+    never accessed are never decoded. The record's generation and ttl are available without
+    touching the bins.
+    '''
+
+    __slots__ = ('_record',)
+
+    def __init__(self, record):
+        '''constructor
+
+        Args:
+            record (Mapping): A record returned by the connector, with 'bins', 'generation' and 'ttl'.
+        '''
+        self._record = record
+
+    @property
+    def id(self):
+        return self._record['bins']['id']
+
+    @property
+    def name(self):
+        return self._record['bins'].get('name')
+
+    @property
+    def email(self):
+        return self._record['bins'].get('email')
+
+    @property
+    def interests(self):
+        return self._record['bins'].get('interests') or []
+
+    @property
+    def generation(self):
+        return self._record.get('generation')
+
+    @property
+    def ttl(self):
+        return self._record.get('ttl')
+
+    def to_user(self):
+        '''Copy the fields into a User'''
+        return User(self.id, self.name, self.email, list(self.interests))
+
+    def __repr__(self):
+        return 'UserView(id={id}, generation={generation})'.format(id=repr(self.id), generation=self.generation)
+
+
+class UserColumns(object):
+    '''
+    Users stored column by column, one list per field, for consumers which process fields in
+    bulk and never need a User per row. Missing users are skipped.
+    '''
+
+    __slots__ = ('ids', 'names', 'emails', 'interests', 'generations')
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.emails = []
+        self.interests = []
+        self.generations = []
+
+    @classmethod
+    def from_records(cls, records):
+        '''Build the columns from records returned by the connector, None records are skipped'''
+        columns = cls()
+        # Bound to locals, as this is run for every user of a bulk read
+        add_id, add_name, add_email = columns.ids.append, columns.names.append, columns.emails.append
+        add_interests, add_generation = columns.interests.append, columns.generations.append
+        for record in records:
+            if record is None:
+                continue
+            bins = record['bins']
+            add_id(bins['id'])
+            add_name(bins.get('name'))
+            add_email(bins.get('email'))
+            add_interests(bins.get('interests') or [])
+            add_generation(record.get('generation'))
+        return columns
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, index):
+        '''Build the User of a row'''
+        return User(self.ids[index], self.names[index], self.emails[index], self.interests[index])
+
+    def __repr__(self):
+        return 'UserColumns({} users)'.format(len(self.ids))
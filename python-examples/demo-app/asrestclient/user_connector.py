@@ -1,3 +1,8 @@
+from concurrent import futures
+
+from . import coalescing
+from . import interestindex
+from . import limiter
 from . import restclientconnector
 from . import user
 from . import constants
@@ -9,7 +14,8 @@ class UserConnector(object):
     User objects into the aerospike database
     '''
 
-    def __init__(self, client, namespace, setname):
+    def __init__(self, client, namespace, setname, coalesce_interests=False, coalesce_window=0.01,
+                 coalesce_max_items=100, negative_cache=None, write_behind=None, interest_index=None):
         '''constructor
 
         Args:
@@ -17,10 +23,43 @@ class UserConnector(object):
             setname (String): The Aerospike Set to be used to store users
             client (ASRestClientConnector): A connector instance which will be utilized to perform
                 REST operations.
+            coalesce_interests (bool): If `True`, interests added to the same user at around the same time
+                are appended with a single request. `close` must be called to send any pending interests.
+                Default: `False`
+            coalesce_window (float): The maximum number of seconds an interest is buffered before being sent.
+                Default: `0.01`
+            coalesce_max_items (int): The number of buffered interests for a user which causes them to be
+                sent immediately. Default: `100`
+            negative_cache (NegativeCache, BloomNegativeCache): A cache of ids recently found to be missing,
+                for which `get_user` returns None without a request. Users created through this connector
+                are removed from it, but users created by other clients are reported missing until the
+                cache's ttl expires. Default: no cache.
+            write_behind (WriteBehindQueue): If given, `add_interest` queues the interest in the queue's
+                spool and returns without waiting for the write. It takes precedence over interest
+                coalescing. The queue is not closed by `close`, its owner must close it to send any queued
+                interests. Default: interests are written before `add_interest` returns.
+            interest_index (InterestIndex): An index of the users with each interest, updated by `create_user`,
+                `create_users` and `add_interest` and read by `find_users_by_interest`. Users written by other
+                clients are only found once the index is rebuilt. Default: no index.
         '''
         self.namespace = namespace
         self.setname = setname
         self.client = client
+        self.negative_cache = negative_cache
+        self.write_behind = write_behind
+        self.interest_index = interest_index
+        self.interest_coalescer = None
+        if coalesce_interests:
+            self.interest_coalescer = coalescing.InterestCoalescer(
+                client, namespace, setname, window=coalesce_window, max_items=coalesce_max_items)
+
+    def close(self):
+        '''
+        Description
+            Send any buffered interests and stop the background work of the connector.
+        '''
+        if self.interest_coalescer is not None:
+            self.interest_coalescer.close()
     
     def create_user(self, user, errror_if_exists=True):
         '''
@@ -37,27 +76,50 @@ class UserConnector(object):
         '''
 
         userkey = user.id
-        bins = {
-            'id': user.id,
-            'name': user.name,
-            'email': user.email,
-            'interests': user.interests,
-        }
+        bins = self._user_to_bins(user)
 
         try:
             self.client.create_record(self.namespace, self.setname, userkey, bins)
         except restclientconnector.RecordExistsError as ree:
             if errror_if_exists:
                 raise ree
+        else:
+            self._index_interests(userkey, user.interests)
+        finally:
+            # Even a failed write may have stored the user
+            self._forget_missing(userkey)
+
+    def create_users(self, users, errror_if_exists=True, max_in_flight=None):
+        '''
+        Description:
+            Store many users into the aerospike database, with several writes in flight at once. It will not
+            update existing users.
+        Args:
+            users (iterable[User]): The users to be stored into the Aerospike database. They are consumed
+                lazily, so this may be a generator.
+            error_if_exists (bool): A flag indicating whether a user with a matching id already existing in
+                the Database should be reported as a failure. Default: `True`
+            max_in_flight (int): The maximum number of concurrent writes. Default: the connector's pool size.
+        Returns:
+            BulkWriteResult: A summary of the created, existing and failed users.
+        '''
+        records = ((user.id, self._user_to_bins(user)) for user in users)
+        return self.client.create_records(
+            self.namespace, self.setname, records, errror_if_exists=errror_if_exists,
+            max_in_flight=max_in_flight, after_write=self._after_create)
 
-    def get_user(self, user_id):
+    def get_user(self, user_id, bins=None, predexp=None):
         '''
         Description
             Retrieves a User instance populated with information stored in the Aerospike Database. If
-            a user is not found None will be returned.
+            a user is not found None will be returned. The read is sent in the priority lane of the
+            connector's limiter, ahead of any bulk requests.
         Args:
             user_id: A unique id for a user. It will be converted to a String before being used to look up
                 a user.
+            bins (list[str]): The user fields to retrieve, e.g. `['name', 'email']`. The other fields of the
+                returned User are None. Default: all fields.
+            predexp (PredExp): A filter evaluated by the server against the stored user.
         Returns:
             User, None: Returns a new User instance if the user is found in Aerospike, else None
 
@@ -65,14 +127,129 @@ class UserConnector(object):
             RestClientAPIError: If an error occurs when speaking to the API.
         '''
 
+        if self._known_missing(user_id):
+            return None
         try:
-            user_details = self.client.get_record(self.namespace, self.setname, user_id)['bins']
-            return user.User(
-                user_details['id'], user_details['name'],
-                user_details['name'], user_details['interests'])
+            query_params = self._filter_params(predexp)
+            with limiter.priority_lane():
+                user_details = self.client.get_record(
+                    self.namespace, self.setname, user_id, bins=self._projection(bins), **query_params)['bins']
+            return self._user_from_bins(user_details)
         except restclientconnector.RecordNotFoundError as ree:
+            self._remember_missing(user_id, predexp)
             return None
 
+    def get_user_view(self, user_id, bins=None, predexp=None):
+        '''
+        Description
+            Retrieves a lazy view of a user stored in the Aerospike Database, without copying it into a User.
+            The response is streamed, and with the MessagePack wire format only the fields which are
+            accessed are decoded. If a user is not found None will be returned. The read is sent in the
+            priority lane of the connector's limiter.
+        Args:
+            user_id: A unique id for a user. It will be converted to a String before being used to look up
+                a user.
+            bins (list[str]): The user fields to retrieve, e.g. `['name', 'email']`. Default: all fields.
+            predexp (PredExp): A filter evaluated by the server against the stored user.
+        Returns:
+            UserView, None: A view of the user's fields and its generation and ttl, else None
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        if self._known_missing(user_id):
+            return None
+        try:
+            query_params = self._filter_params(predexp)
+            with limiter.priority_lane():
+                record = self.client.get_record(
+                    self.namespace, self.setname, user_id, bins=self._projection(bins), stream=True,
+                    **query_params)
+            return user.UserView(record)
+        except restclientconnector.RecordNotFoundError:
+            self._remember_missing(user_id, predexp)
+            return None
+
+    def get_users(self, user_ids, bins=None, predexp=None, group_by_partition=False):
+        '''
+        Description
+            Retrieves several users with batch requests, rather than one request per user.
+        Args:
+            user_ids (list): Unique ids for the users. They will be converted to Strings before being used
+                to look up the users.
+            bins (list[str]): The user fields to retrieve, e.g. `['name', 'email']`. The other fields of the
+                returned Users are None. Default: all fields.
+            predexp (PredExp): A filter evaluated by the server, users which do not match it are None.
+            group_by_partition (bool): If `True` the ids are sent by digest, ordered by partition, so each
+                batch request covers fewer partitions. Default: `False`
+        Returns:
+            list[User, None]: One entry per id, in the same order. Each entry is a new User instance if
+                the user is found in Aerospike, else None
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        user_ids = list(user_ids)
+        # Only the ids not known to be missing are requested
+        lookups = [position for position, user_id in enumerate(user_ids) if not self._known_missing(user_id)]
+
+        query_params = self._filter_params(predexp)
+        records = self.client.get_records(
+            self.namespace, self.setname, [user_ids[position] for position in lookups],
+            bins=self._projection(bins), group_by_partition=group_by_partition, **query_params)
+
+        users = [None] * len(user_ids)
+        for position, record in zip(lookups, records):
+            if record:
+                users[position] = self._user_from_bins(record['bins'])
+            else:
+                self._remember_missing(user_ids[position], predexp)
+        return users
+
+    def get_users_columnar(self, user_ids, bins=None, predexp=None, group_by_partition=False):
+        '''
+        Description
+            Retrieves several users with batch requests into columns, one list per field, rather than one
+            User per user.
+        Args:
+            user_ids (list): Unique ids for the users.
+            bins (list[str]): The user fields to retrieve, the other columns hold None. Default: all fields.
+            predexp (PredExp): A filter evaluated by the server, users which do not match it are skipped.
+            group_by_partition (bool): If `True` the ids are sent by digest, ordered by partition.
+                Default: `False`
+        Returns:
+            UserColumns: The found users, in the order of user_ids. Users which are not found are skipped.
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        query_params = self._filter_params(predexp)
+        records = self.client.get_records(
+            self.namespace, self.setname, user_ids, bins=self._projection(bins),
+            group_by_partition=group_by_partition, **query_params)
+        return user.UserColumns.from_records(records)
+
+    def iter_users(self, page_size=1000, cursor=None, bins=None, predexp=None):
+        '''
+        Description
+            Iterates over every user stored in the set, fetching them a page at a time.
+        Args:
+            page_size (int): The maximum number of users fetched per request. Default: `1000`
+            cursor (dict): The `cursor` of an earlier iteration, to resume after the last user it returned.
+            bins (list[str]): The user fields to retrieve, e.g. `['name', 'email']`. The other fields of the
+                returned Users are None. Default: all fields.
+            predexp (PredExp): A filter evaluated by the server, only matching users are returned.
+        Returns:
+            ScanIterator: An iterator of User instances. Its `cursor` may be saved to resume the iteration.
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+        '''
+        query_params = self._filter_params(predexp)
+        return self.client.scan(
+            self.namespace, self.setname, bins=self._projection(bins), page_size=page_size, cursor=cursor,
+            record_factory=lambda record: self._user_from_bins(record['bins']), **query_params)
+
     def add_interest(self, user_id, interest):
         '''
         Description
@@ -83,21 +260,185 @@ class UserConnector(object):
                 a user.
             interest (string): An interest to append to the list of interestss for the user
         Returns:
-            list[string]: The updated list of interests for the user.
+            list[string], None: The updated list of interests for the user, or None with write-behind, as
+                the interest has only been queued.
 
         Raises:
             RestClientAPIError: If an error occurs when speaking to the API.
+            SpoolFullError: If write-behind is enabled and its spool is full.
         '''
+        if self.write_behind is not None:
+            # Only the append is queued, as the updated interests are not known until it is sent
+            self.write_behind.operate_record(
+                self.namespace, self.setname, user_id, self._add_interest_and_retrieve_ops(interest)[:1],
+                recordExistsAction=constants.UPDATE_ONLY)
+            self._index_interests(user_id, [interest])
+            return None
+
+        if self.interest_coalescer is not None:
+            return self.submit_interest(user_id, interest).result()
+
         add_interest_ops = self._add_interest_and_retrieve_ops(interest)
 
         # Add update only to prevent creation of a new user
         response = self.client.operate_record(
             self.namespace, self.setname, user_id,
             add_interest_ops, recordExistsAction=constants.UPDATE_ONLY)
+        self._index_interests(user_id, [interest])
         new_interests = response['bins']['interests']
         # The response contains one entry for the length of interests, the second is the new list of interests
         return new_interests[1]
 
+    def find_users_by_interest(self, interest, page_size=100, cursor=None, bins=None):
+        '''
+        Description
+            Iterates over the users with an interest, reading the interest index one record at a time and
+            fetching the users it lists with batch requests.
+        Args:
+            interest (string): The interest.
+            page_size (int): The maximum number of users fetched per request. Default: `100`
+            cursor (dict): The `cursor` of an earlier iteration, to resume after the last user it returned.
+            bins (list[str]): The user fields to retrieve, `interests` is always retrieved. Default: all fields.
+        Returns:
+            InterestUsersIterator: An iterator of User instances. Its `cursor` may be saved to resume the
+                iteration.
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+            RuntimeError: If the connector has no interest index.
+        '''
+        if self.interest_index is None:
+            raise RuntimeError('Finding users by interest requires an interest index')
+
+        # The interests are needed to skip users which no longer have the interest
+        if bins is not None and 'interests' not in bins:
+            bins = list(bins) + ['interests']
+        return interestindex.InterestUsersIterator(
+            self.interest_index, interest, lambda user_ids: self.get_users(user_ids, bins=bins), page_size,
+            cursor=cursor)
+
+    def rebuild_interest_index(self, page_size=1000, max_in_flight=16):
+        '''
+        Description
+            Replaces the interest index with one built from every user in the set. Interests added while it
+            is rebuilt may be missing from it, so writes to the users should be paused until it completes.
+        Args:
+            page_size (int): The maximum number of users fetched per scan request. Default: `1000`
+            max_in_flight (int): The maximum number of index records written concurrently. Default: `16`
+        Returns:
+            dict: The number of `users` indexed, index `records` written and stale records `deleted`.
+
+        Raises:
+            RestClientAPIError: If an error occurs when speaking to the API.
+            RuntimeError: If the connector has no interest index.
+        '''
+        if self.interest_index is None:
+            raise RuntimeError('Rebuilding the interest index requires an interest index')
+
+        with self.iter_users(page_size=page_size, bins=['id', 'interests']) as users:
+            return self.interest_index.rebuild(users, max_in_flight=max_in_flight)
+
+    def submit_interest(self, user_id, interest):
+        '''
+        Description
+            Adds an interest to the list of interests for a User stored in the database without waiting
+            for the write. With interest coalescing enabled, interests submitted for a user within the
+            coalescing window are appended together.
+        Args:
+            user_id: A unique id for a user. It will be converted to a String before being used to look up
+                a user.
+            interest (string): An interest to append to the list of interests for the user
+        Returns:
+            concurrent.futures.Future: Resolves to the updated list of interests for the user.
+        '''
+        if self.interest_coalescer is not None:
+            return self._indexed(self.interest_coalescer.submit(user_id, interest), user_id, interest)
+
+        future = futures.Future()
+        try:
+            future.set_result(self.add_interest(user_id, interest))
+        except restclientconnector.RestClientAPIError as rce:
+            future.set_exception(rce)
+        return future
+
+    def _index_interests(self, user_id, interests):
+        if self.interest_index is None or not interests:
+            return
+        if self.write_behind is None:
+            self.interest_index.add(user_id, interests)
+            return
+
+        index = self.interest_index
+        for key, operations in index.updates(user_id, interests):
+            self.write_behind.operate_record(index.namespace, index.setname, key, operations)
+
+    def _indexed(self, written, user_id, interest):
+        '''Get a future which resolves like written, once the interest has also been indexed'''
+        if self.interest_index is None:
+            return written
+
+        indexed = futures.Future()
+
+        def index(_):
+            try:
+                interests = written.result()
+                self._index_interests(user_id, [interest])
+            except Exception as ex:
+                indexed.set_exception(ex)
+            else:
+                indexed.set_result(interests)
+
+        written.add_done_callback(index)
+        return indexed
+
+    def _after_create(self, user_id, bins, error):
+        # Even a failed write may have stored the user
+        self._forget_missing(user_id)
+        # Only users which were written are indexed, in the worker so index writes run concurrently
+        if error is None:
+            self._index_interests(user_id, bins.get('interests'))
+
+    def _known_missing(self, user_id):
+        return self.negative_cache is not None and self.negative_cache.contains(str(user_id))
+
+    def _remember_missing(self, user_id, predexp):
+        # A user filtered out by a predexp may exist
+        if self.negative_cache is not None and predexp is None:
+            self.negative_cache.add(str(user_id))
+
+    def _forget_missing(self, user_id):
+        '''Remove a user which may have been written from the negative cache'''
+        if self.negative_cache is not None:
+            self.negative_cache.discard(str(user_id))
+
+    @staticmethod
+    def _user_to_bins(user):
+        '''Build the bins used to store a user in the Aerospike Database'''
+        return {
+            'id': user.id,
+            'name': user.name,
+            'email': user.email,
+            'interests': user.interests,
+        }
+
+    @staticmethod
+    def _user_from_bins(user_details):
+        '''Build a User instance from the bins of a stored user record, which may hold only some of them'''
+        return user.User(
+            user_details['id'], user_details.get('name'),
+            user_details.get('email'), user_details.get('interests'))
+
+    @staticmethod
+    def _filter_params(predexp):
+        return {'predexp': predexp} if predexp is not None else {}
+
+    @staticmethod
+    def _projection(bins):
+        '''Get the bins to read for a list of User fields, the id is always read'''
+        if bins is None:
+            return None
+        return ['id'] + [bin_name for bin_name in bins if bin_name != 'id']
+
     @staticmethod
     def _add_interest_and_retrieve_ops(interest):
         '''Build a list of operations to add an interest to a user's list of interests in the Aerospike Database
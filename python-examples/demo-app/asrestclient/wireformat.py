@@ -0,0 +1,39 @@
+'''
+Encoding and decoding of REST client request and response bodies
+'''
+import json
+
+import msgpack
+
+from . import constants
+
+
+def get_headers(wire_format):
+    '''Get the Content-Type and Accept headers for a wire format
+
+    Raises:
+        ValueError: If the wire_format is not supported.
+    '''
+    if wire_format == constants.JSON_WIRE_FORMAT:
+        content_type = constants.JSON_CONTENT_TYPE
+    elif wire_format == constants.MSGPACK_WIRE_FORMAT:
+        content_type = constants.MSGPACK_CONTENT_TYPE
+    else:
+        raise ValueError('Unsupported wire format: {}'.format(wire_format))
+
+    return {'Content-Type': content_type, 'Accept': content_type}
+
+
+def encode(wire_format, body):
+    '''Encode a request body'''
+    if wire_format == constants.MSGPACK_WIRE_FORMAT:
+        return msgpack.packb(body, use_bin_type=True)
+    return json.dumps(body).encode('utf-8')
+
+
+def decode(wire_format, content):
+    '''Decode a response body'''
+    if wire_format == constants.MSGPACK_WIRE_FORMAT:
+        # Aerospike map keys are not always strings, so keep integer keys as they are
+        return msgpack.unpackb(content, raw=False, strict_map_key=False)
+    return json.loads(content.decode('utf-8'))
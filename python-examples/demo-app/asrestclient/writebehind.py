@@ -0,0 +1,318 @@
+'''
+Write-behind of record mutations through a durable local spool
+
+Writes made through a WriteBehindQueue are appended to a Spool and acknowledged as soon as they
+are on disk, and a background flusher sends them to the REST client. Writes which could not be
+sent before the process stopped are sent when a queue is next opened on the same spool file.
+'''
+import collections
+from concurrent import futures
+import threading
+import time
+
+import msgpack
+
+from . import restclientconnector
+from . import spool
+
+# The REST client answered, and sending the write again would fail the same way
+_PERMANENT_ERRORS = (restclientconnector.RecordNotFoundError, restclientconnector.RecordExistsError)
+
+
+class WriteBehindQueue(object):
+    '''
+    Queues record mutations in a spool file and writes them to the REST client in the background.
+
+    The flusher reads up to `batch_size` pending writes at a time and sends the writes of different
+    records concurrently, and the writes of each record one at a time in the order they were
+    queued. A write which fails with a connection error or server error is retried, with an
+    exponential backoff, before any later write of the same record is sent. A write rejected because
+    its record does or does not exist is dropped and passed to `on_error`.
+
+    Writes are committed in the spool once they and every write queued before them have been sent.
+    After a crash the writes after the committed offset are sent again, so a write may be applied
+    more than once, and should be idempotent where that matters.
+
+    Reads through the connector do not see queued writes until they have been flushed.
+    '''
+
+    def __init__(self, client, path, batch_size=100, max_in_flight=8, flush_interval=0.05, retry_backoff=0.5,
+                 max_retry_backoff=10.0, max_attempts=None, on_error=None, initial_size=1024 * 1024,
+                 max_size=1024 * 1024 * 1024, sync_interval=0.0):
+        '''constructor
+
+        Args:
+            client (ASRestClientConnector): The connector used to send the writes.
+            path (str): The spool file. Writes left in it by an earlier queue are sent first.
+            batch_size (int) optional: The most writes read from the spool and sent at once. Default: `100`
+            max_in_flight (int) optional: The most records written concurrently. Default: `8`
+            flush_interval (float) optional: The most seconds a write waits for others to be queued
+                before its batch is sent. Default: `0.05`
+            retry_backoff (float) optional: The seconds to wait before the first retry of a failed
+                batch, doubled for each further failure. Default: `0.5`
+            max_retry_backoff (float) optional: The most seconds to wait between retries. Default: `10.0`
+            max_attempts (int) optional: The number of times a write is sent before it is dropped and
+                passed to `on_error`. Default: retried until it succeeds.
+            on_error (callable) optional: Called from the flusher as `on_error(method, key, error)`
+                with each dropped write's connector method name, `(namespace, setname, userkey)` and
+                exception. Default: dropped writes are only counted.
+            initial_size (int) optional: The size a new spool file is created with. Default: 1 MiB
+            max_size (int) optional: The largest the spool file may grow to. Default: 1 GiB
+            sync_interval (float) optional: The most seconds a queued write may wait before being
+                synced to disk, `None` to leave syncing to the OS. Default: `0`, every write is synced
+                before it is acknowledged.
+        Raises:
+            RestClientAPIError: If the spool file cannot be opened.
+        '''
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.max_attempts = max_attempts
+        self.on_error = on_error
+
+        self.queued = 0
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+
+        self._spool = spool.Spool(path, initial_size=initial_size, max_size=max_size, sync_interval=sync_interval)
+        # The offsets after writes which have been sent, but not committed as an earlier write has not
+        self._done = set()
+        # Maps the offset after each write which has failed to the number of times it was sent
+        self._attempts = {}
+        # Writes queued since the flusher last read the spool
+        self._unread = 1 if self._spool.end > self._spool.committed else 0
+        self._flushing = 0
+        self._closed = False
+        self._final_spool_stats = None
+        self._condition = threading.Condition()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self._flusher = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._flusher.start()
+
+    def create_record(self, namespace, setname, userkey, bins, **query_params):
+        '''Queue the creation of a record, see ASRestClientConnector.create_record
+
+        Returns:
+            int: The spool offset of the write.
+        Raises:
+            SpoolFullError: If the spool is full of writes which have not been sent.
+        '''
+        return self._queue('create_record', namespace, setname, userkey, bins, query_params)
+
+    def update_record(self, namespace, setname, userkey, bins, **query_params):
+        '''Queue an update of a record, see ASRestClientConnector.update_record
+
+        Returns:
+            int: The spool offset of the write.
+        Raises:
+            SpoolFullError: If the spool is full of writes which have not been sent.
+        '''
+        return self._queue('update_record', namespace, setname, userkey, bins, query_params)
+
+    def replace_record(self, namespace, setname, userkey, bins, **query_params):
+        '''Queue the replacement of a record, see ASRestClientConnector.replace_record
+
+        Returns:
+            int: The spool offset of the write.
+        Raises:
+            SpoolFullError: If the spool is full of writes which have not been sent.
+        '''
+        return self._queue('replace_record', namespace, setname, userkey, bins, query_params)
+
+    def delete_record(self, namespace, setname, userkey, **query_params):
+        '''Queue the deletion of a record, see ASRestClientConnector.delete_record
+
+        Returns:
+            int: The spool offset of the write.
+        Raises:
+            SpoolFullError: If the spool is full of writes which have not been sent.
+        '''
+        return self._queue('delete_record', namespace, setname, userkey, None, query_params)
+
+    def operate_record(self, namespace, setname, userkey, operations, **query_params):
+        '''Queue operations on a record, see ASRestClientConnector.operate_record. Their result is
+        discarded, so read operations are only useful in a later request.
+
+        Returns:
+            int: The spool offset of the write.
+        Raises:
+            SpoolFullError: If the spool is full of writes which have not been sent.
+        '''
+        return self._queue('operate_record', namespace, setname, userkey, operations, query_params)
+
+    def flush(self, timeout=None):
+        '''Wait until every write queued so far has been sent or dropped
+
+        Args:
+            timeout (float) optional: The most seconds to wait. Default: no limit
+        Returns:
+            bool: `True` if every write was sent or dropped, `False` if the timeout expired first.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            target = self._spool.end
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                while self._spool.committed < target and not self._closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                return self._spool.committed >= target
+            finally:
+                self._flushing -= 1
+
+    def close(self, flush=True, timeout=None):
+        '''Stop the background flusher and close the spool. Writes which have not been sent are
+        kept in the spool, and sent by the next queue opened on it.
+
+        Args:
+            flush (bool) optional: Whether to wait for the queued writes to be sent first. Default: `True`
+            timeout (float) optional: The most seconds to wait for them. Default: no limit
+        Returns:
+            bool: `True` if every queued write was sent or dropped.
+        '''
+        flushed = self.flush(timeout) if flush else False
+        with self._condition:
+            if self._closed:
+                return flushed
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join()
+        self._executor.shutdown()
+        with self._condition:
+            # The spool cannot be read once closed, so its final sizes are kept for stats
+            self._final_spool_stats = self._spool_stats()
+            self._spool.close()
+        return flushed
+
+    def stats(self):
+        '''Get the number of writes queued, written and dropped, the number of retries, and the
+        bytes of the spool waiting to be sent'''
+        with self._condition:
+            stats = {
+                'queued': self.queued,
+                'written': self.written,
+                'failed': self.failed,
+                'retries': self.retries,
+            }
+            stats.update(self._final_spool_stats or self._spool_stats())
+            return stats
+
+    def _spool_stats(self):
+        return {'pending_bytes': self._spool.end - self._spool.committed, 'spool_bytes': self._spool.size}
+
+    def _queue(self, method, namespace, setname, userkey, data, query_params):
+        payload = msgpack.packb([method, namespace, setname, userkey, data, query_params], use_bin_type=True)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Cannot queue writes after the write-behind queue is closed')
+            offset = self._spool.append(payload)
+            self.queued += 1
+            self._unread += 1
+            # Wake the flusher to start the interval of a new batch, or to send a full one
+            if self._unread == 1 or self._unread >= self.batch_size:
+                self._condition.notify_all()
+        return offset
+
+    def _run(self):
+        backoff = self.retry_backoff
+        while True:
+            with self._condition:
+                if not self._wait_for_batch():
+                    return
+                # Writes already sent are skipped, so each batch has up to batch_size to send
+                limit = self.batch_size + len(self._done)
+                entries = self._spool.read(self._spool.committed, limit)
+                # A backlog left after a full batch is sent without waiting
+                self._unread = self.batch_size if len(entries) == limit else 0
+
+            retry = self._send_batch(entries)
+
+            with self._condition:
+                self._commit(entries)
+                self._condition.notify_all()
+                if not retry:
+                    backoff = self.retry_backoff
+                    continue
+                self.retries += 1
+                self._condition.wait_for(lambda: self._closed, backoff)
+                backoff = min(backoff * 2, self.max_retry_backoff)
+
+    def _wait_for_batch(self):
+        '''Wait until there are writes to send, and a full batch or the flush interval has passed.
+        Returns `False` once the queue is closed. Callers hold the condition.'''
+        while self._spool.end <= self._spool.committed:
+            if self._closed:
+                return False
+            self._condition.wait()
+
+        deadline = time.monotonic() + self.flush_interval
+        while self._unread < self.batch_size and not self._flushing and not self._closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+        return not self._closed
+
+    def _send_batch(self, entries):
+        '''Send the writes of each record in order, concurrently across records. Returns whether
+        any write must be retried.'''
+        # Maps each record to its writes, in the order they were queued
+        records = collections.OrderedDict()
+        for offset, payload in entries:
+            if offset in self._done:
+                continue
+            method, namespace, setname, userkey, data, query_params = msgpack.unpackb(
+                payload, raw=False, strict_map_key=False)
+            records.setdefault((namespace, setname, userkey), []).append((offset, method, data, query_params))
+
+        pending = [self._executor.submit(self._send_record, key, writes) for key, writes in records.items()]
+        return any([future.result() for future in pending])
+
+    def _send_record(self, key, writes):
+        '''Send the writes of one record in order, stopping at the first which must be retried'''
+        namespace, setname, userkey = key
+        for offset, method, data, query_params in writes:
+            args = (namespace, setname, userkey) if data is None else (namespace, setname, userkey, data)
+            try:
+                getattr(self.client, method)(*args, **query_params)
+            except _PERMANENT_ERRORS as error:
+                self._drop(offset, method, key, error)
+            except restclientconnector.RestClientAPIError as error:
+                with self._condition:
+                    attempts = self._attempts[offset] = self._attempts.get(offset, 0) + 1
+                if self.max_attempts is None or attempts < self.max_attempts:
+                    return True
+                self._drop(offset, method, key, error)
+            except Exception as error:
+                # Such as a write queued with arguments the connector does not accept
+                self._drop(offset, method, key, error)
+            else:
+                with self._condition:
+                    self.written += 1
+                    self._done.add(offset)
+        return False
+
+    def _drop(self, offset, method, key, error):
+        with self._condition:
+            self.failed += 1
+            self._done.add(offset)
+        if self.on_error is not None:
+            self.on_error(method, key, error)
+
+    def _commit(self, entries):
+        '''Commit the writes which have been sent, up to the first which has not. Callers hold the condition.'''
+        committed = None
+        for offset, _ in entries:
+            if offset not in self._done:
+                break
+            self._done.discard(offset)
+            self._attempts.pop(offset, None)
+            committed = offset
+        if committed is not None:
+            self._spool.commit(committed)
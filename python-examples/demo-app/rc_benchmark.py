@@ -0,0 +1,267 @@
+'''
+Benchmark the ASRestClientConnector and UserConnector methods.
+
+By default the benchmark runs against an in process FakeRestClientServer, pass --base-uri
+to run it against a real REST client instead. Every method is run for each combination of
+payload size and concurrency, and the throughput and latency percentiles are printed, and
+optionally written as JSON with --output so runs can be compared over time.
+
+Example:
+    python rc_benchmark.py --payload-sizes 100,10000 --concurrency 1,16 --output run.json
+'''
+import argparse
+from concurrent import futures
+import itertools
+import json
+import platform
+import sys
+import threading
+import time
+
+from asrestclient import constants
+from asrestclient.fakeserver import FakeRestClientServer
+from asrestclient.restclientconnector import ASRestClientConnector
+from asrestclient.user_connector import UserConnector
+from asrestclient.user import User
+
+NAMESPACE = 'test'
+
+
+class BenchmarkContext(object):
+    '''
+    The state shared by the operations of one benchmark run
+    '''
+
+    def __init__(self, client, setname, payload_size, batch_size, run_id):
+        self.client = client
+        self.setname = setname
+        self.users = UserConnector(client, NAMESPACE, setname)
+        self.payload_size = payload_size
+        self.batch_size = batch_size
+        self.run_id = run_id
+
+    def key(self, index):
+        return '{run}-{index}'.format(run=self.run_id, index=index)
+
+    def bins(self, index):
+        return {'index': index, 'payload': 'x' * self.payload_size}
+
+    def user(self, index):
+        # Each interest is about 10 characters long
+        interests = ['interest{:02d}'.format(i % 100) for i in range(max(1, self.payload_size // 10))]
+        return User(self.key(index), 'User {}'.format(index), 'user{}@example.com'.format(index), interests)
+
+    def preload_records(self, count):
+        self.client.create_records(
+            NAMESPACE, self.setname, ((self.key(index), self.bins(index)) for index in range(count)))
+
+    def preload_users(self, count):
+        self.users.create_users(self.user(index) for index in range(count))
+
+
+def _batch_keys(ctx, index):
+    start = index * ctx.batch_size
+    return [ctx.key(key_index) for key_index in range(start, start + ctx.batch_size)]
+
+
+# Each benchmark is (setup, operation). setup(ctx, operations) prepares any records the
+# operations rely on, operation(ctx, index) performs the index'th timed call.
+BENCHMARKS = {
+    'get_record': (
+        lambda ctx, ops: ctx.preload_records(ops),
+        lambda ctx, i: ctx.client.get_record(NAMESPACE, ctx.setname, ctx.key(i))),
+    'create_record': (
+        None,
+        lambda ctx, i: ctx.client.create_record(NAMESPACE, ctx.setname, ctx.key(i), ctx.bins(i))),
+    'update_record': (
+        lambda ctx, ops: ctx.preload_records(ops),
+        lambda ctx, i: ctx.client.update_record(NAMESPACE, ctx.setname, ctx.key(i), {'index': -i})),
+    'replace_record': (
+        lambda ctx, ops: ctx.preload_records(ops),
+        lambda ctx, i: ctx.client.replace_record(NAMESPACE, ctx.setname, ctx.key(i), ctx.bins(i))),
+    'delete_record': (
+        lambda ctx, ops: ctx.preload_records(ops),
+        lambda ctx, i: ctx.client.delete_record(NAMESPACE, ctx.setname, ctx.key(i))),
+    'operate_record': (
+        lambda ctx, ops: ctx.preload_records(ops),
+        lambda ctx, i: ctx.client.operate_record(NAMESPACE, ctx.setname, ctx.key(i), [
+            {constants.OPERATION_NAME: 'ADD', constants.OPERATION_VALUES: {'bin': 'index', 'incr': 1}},
+            {constants.OPERATION_NAME: constants.READ_OP, constants.OPERATION_VALUES: {'bin': 'index'}},
+        ])),
+    'get_records': (
+        lambda ctx, ops: ctx.preload_records(ops * ctx.batch_size),
+        lambda ctx, i: ctx.client.get_records(NAMESPACE, ctx.setname, _batch_keys(ctx, i))),
+    'create_user': (
+        None,
+        lambda ctx, i: ctx.users.create_user(ctx.user(i))),
+    'create_users': (
+        None,
+        lambda ctx, i: ctx.users.create_users(
+            ctx.user(index) for index in range(i * ctx.batch_size, (i + 1) * ctx.batch_size))),
+    'get_user': (
+        lambda ctx, ops: ctx.preload_users(ops),
+        lambda ctx, i: ctx.users.get_user(ctx.key(i))),
+    'get_users': (
+        lambda ctx, ops: ctx.preload_users(ops * ctx.batch_size),
+        lambda ctx, i: ctx.users.get_users(_batch_keys(ctx, i))),
+    'add_interest': (
+        lambda ctx, ops: ctx.preload_users(ops),
+        lambda ctx, i: ctx.users.add_interest(ctx.key(i), 'benchmarking')),
+}
+
+
+def percentile(sorted_values, fraction):
+    '''Get the value below which `fraction` of the sorted values fall'''
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_benchmark(ctx, operation, operations, concurrency):
+    '''Run operation `operations` times on `concurrency` threads
+
+    Returns:
+        dict: The throughput, error count and latency percentiles in milliseconds.
+    '''
+    counter = itertools.count()
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        local_latencies = []
+        local_errors = 0
+        while True:
+            with counter_lock:
+                index = next(counter)
+            if index >= operations:
+                break
+            start = time.perf_counter()
+            try:
+                operation(ctx, index)
+            except Exception:
+                local_errors += 1
+            local_latencies.append(time.perf_counter() - start)
+
+        with counter_lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'operations': operations,
+        'errors': errors[0],
+        'elapsed_s': elapsed,
+        'throughput_ops': operations / elapsed if elapsed else None,
+        'latency_ms': {
+            'mean': 1000 * sum(latencies) / len(latencies) if latencies else None,
+            'p50': 1000 * percentile(latencies, 0.50) if latencies else None,
+            'p99': 1000 * percentile(latencies, 0.99) if latencies else None,
+            'p999': 1000 * percentile(latencies, 0.999) if latencies else None,
+            'max': 1000 * latencies[-1] if latencies else None,
+        },
+    }
+
+
+def parse_int_list(value):
+    return [int(part) for part in value.split(',') if part]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the Aerospike REST client connectors.')
+    parser.add_argument('--base-uri', help='REST client address, or comma separated addresses of several '
+                        'instances to spread requests over. By default an in process fake server is used')
+    parser.add_argument('--set', dest='setname', default='bench', help='The set to store benchmark records in')
+    parser.add_argument('--methods', default=','.join(sorted(BENCHMARKS)),
+                        help='Comma separated methods to benchmark. Default: all')
+    parser.add_argument('--payload-sizes', type=parse_int_list, default=[100, 1000, 10000],
+                        help='Comma separated payload sizes in bytes. Default: 100,1000,10000')
+    parser.add_argument('--concurrency', type=parse_int_list, default=[1, 8, 32],
+                        help='Comma separated numbers of concurrent callers. Default: 1,8,32')
+    parser.add_argument('--operations', type=int, default=1000,
+                        help='Timed calls per method, payload size and concurrency. Default: 1000')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='Keys per call for the batch methods. Default: 50')
+    parser.add_argument('--wire-format', default=constants.JSON_WIRE_FORMAT,
+                        choices=[constants.JSON_WIRE_FORMAT, constants.MSGPACK_WIRE_FORMAT])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency injected by the fake server. Default: 0')
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help='Seconds of random extra latency injected by the fake server. Default: 0')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests failed by the fake server. Default: 0')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    methods = [method for method in args.methods.split(',') if method]
+    unknown = set(methods) - set(BENCHMARKS)
+    if unknown:
+        sys.exit('Unknown methods: ' + ', '.join(sorted(unknown)))
+
+    server = None
+    base_uri = args.base_uri
+    if base_uri is not None and ',' in base_uri:
+        base_uri = [uri for uri in base_uri.split(',') if uri]
+    if base_uri is None:
+        server = FakeRestClientServer(
+            latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate).start()
+        base_uri = server.base_uri
+
+    results = []
+    run_id = int(time.time())
+    pool_size = max(args.concurrency)
+    try:
+        with ASRestClientConnector(base_uri, pool_maxsize=pool_size, wire_format=args.wire_format) as client:
+            for method, payload_size, concurrency in itertools.product(
+                    methods, args.payload_sizes, args.concurrency):
+                ctx = BenchmarkContext(
+                    client, args.setname, payload_size, args.batch_size,
+                    '{run}-{method}-{size}-{concurrency}'.format(
+                        run=run_id, method=method, size=payload_size, concurrency=concurrency))
+                setup, operation = BENCHMARKS[method]
+                if setup is not None:
+                    setup(ctx, args.operations)
+
+                result = run_benchmark(ctx, operation, args.operations, concurrency)
+                result.update({'method': method, 'payload_size': payload_size, 'concurrency': concurrency})
+                results.append(result)
+                print('{method:<15} size={payload_size:<7} conc={concurrency:<4} {throughput:>9.1f} ops/s '
+                      'p50={p50:.2f}ms p99={p99:.2f}ms p999={p999:.2f}ms errors={errors}'.format(
+                          method=method, payload_size=payload_size, concurrency=concurrency,
+                          throughput=result['throughput_ops'], errors=result['errors'],
+                          **result['latency_ms']))
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.output:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'base_uri': args.base_uri or 'fake',
+            'config': {
+                'wire_format': args.wire_format,
+                'operations': args.operations,
+                'batch_size': args.batch_size,
+                'latency': args.latency,
+                'latency_jitter': args.latency_jitter,
+                'error_rate': args.error_rate,
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
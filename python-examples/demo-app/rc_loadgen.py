@@ -0,0 +1,525 @@
+'''
+Generate a sustained mix of user operations, to reproduce a production traffic shape.
+
+Each operation is a read (`get_user`), create (`create_user`), update (`update_record` of a user's
+name) or add_interest, picked at random with the weights of --mix. Reads, updates and interests
+address users chosen from a keyspace of --keyspace preloaded users with a uniform, zipfian or
+hotspot distribution, and creates add new users.
+
+By default --concurrency workers send operations back to back (a closed loop). With --rate the
+operations are instead scheduled at a fixed rate (an open loop), and each latency is measured from
+when the operation was scheduled rather than when it was sent, so a slow endpoint shows up as
+queueing in the latencies instead of as a lower request rate.
+
+Operations during the first --warmup seconds are not measured. Every --report-interval seconds the
+throughput and latency percentiles of the interval are printed, and at the end a summary is printed
+and optionally written as JSON with --output.
+
+By default the load is sent to an in process FakeRestClientServer, pass --base-uri to send it to a
+real REST client instead.
+
+Example:
+    python rc_loadgen.py --mix read=80,update=15,create=5 --distribution zipfian --rate 2000 --duration 60
+'''
+import argparse
+import bisect
+import itertools
+import json
+import math
+import platform
+import random
+import sys
+import threading
+import time
+
+from asrestclient import constants
+from asrestclient.fakeserver import FakeRestClientServer
+from asrestclient.restclientconnector import ASRestClientConnector
+from asrestclient.restclientconnector import RestClientAPIError
+from asrestclient.user_connector import UserConnector
+from asrestclient.user import User
+
+READ = 'read'
+CREATE = 'create'
+UPDATE = 'update'
+ADD_INTEREST = 'add_interest'
+OPERATIONS = (READ, CREATE, UPDATE, ADD_INTEREST)
+
+UNIFORM = 'uniform'
+ZIPFIAN = 'zipfian'
+HOTSPOT = 'hotspot'
+
+REPORTED_PERCENTILES = (('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('p999', 0.999), ('p9999', 0.9999))
+
+
+class LatencyHistogram(object):
+    '''
+    A histogram of latencies in microseconds, with buckets in the manner of an HdrHistogram: each
+    power of two range is split into 64 linear buckets, so any recorded value is reported within
+    about 1.5% of its true value however large it is. Not thread safe, callers hold a lock.
+    '''
+
+    # Values below 2 ** SUB_BUCKET_BITS are counted exactly
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+
+    def __init__(self):
+        # Sparse, as a run typically touches a few hundred buckets
+        self.counts = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1000000))
+        magnitude = max(0, value.bit_length() - self.SUB_BUCKET_BITS)
+        index = magnitude * self.SUB_BUCKET_HALF + (value >> magnitude)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, fraction):
+        '''Get the largest value of the bucket a percentile falls in, in microseconds, or None if
+        no values were recorded'''
+        if not self.count:
+            return None
+
+        target = max(1, int(math.ceil(fraction * self.count)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        '''Get the count, and the mean, min, max and percentiles in milliseconds'''
+        latencies = {name: _to_ms(self.percentile(fraction)) for name, fraction in REPORTED_PERCENTILES}
+        latencies.update({
+            'mean': _to_ms(self.sum / self.count) if self.count else None,
+            'min': _to_ms(self.min),
+            'max': _to_ms(self.max),
+        })
+        return {'count': self.count, 'latency_ms': latencies}
+
+    def _highest_value(self, index):
+        if index < 2 * self.SUB_BUCKET_HALF:
+            return index
+        magnitude = index // self.SUB_BUCKET_HALF - 1
+        sub_bucket = index - magnitude * self.SUB_BUCKET_HALF
+        return ((sub_bucket + 1) << magnitude) - 1
+
+
+class OperationStats(object):
+    '''
+    The latencies and outcomes of one kind of operation, for the current report interval and for
+    the whole measured run. It is thread safe.
+    '''
+
+    def __init__(self):
+        self.total = LatencyHistogram()
+        self.interval = LatencyHistogram()
+        self.errors = 0
+        self.not_found = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=False, not_found=False):
+        with self._lock:
+            self.interval.record(latency)
+            self.errors += error
+            self.not_found += not_found
+
+    def take_interval(self):
+        '''Get the histogram of the current interval, adding it to the totals, and start a new interval'''
+        with self._lock:
+            interval, self.interval = self.interval, LatencyHistogram()
+            self.total.merge(interval)
+        return interval
+
+    def reset(self):
+        with self._lock:
+            self.total = LatencyHistogram()
+            self.interval = LatencyHistogram()
+            self.errors = 0
+            self.not_found = 0
+
+
+class UniformKeys(object):
+    '''Every key of the keyspace is equally likely'''
+
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+
+    def next(self, rng):
+        return rng.randrange(self.keyspace)
+
+
+class ZipfianKeys(object):
+    '''
+    Key `i` is chosen with probability proportional to `1 / (i + 1) ** theta`, using the method of
+    Gray et al. "Quickly Generating Billion-Record Synthetic Databases", as YCSB does. Hot keys
+    are spread over the keyspace by hashing, so they are not all among the lowest ids.
+    '''
+
+    def __init__(self, keyspace, theta=0.99):
+        self.keyspace = keyspace
+        self.theta = theta
+        # Computing zeta is linear in the keyspace, but done once
+        zeta_n = math.fsum(1.0 / (index ** theta) for index in range(1, keyspace + 1))
+        zeta_2 = 1.0 + 0.5 ** theta
+        self._alpha = 1.0 / (1.0 - theta)
+        self._zeta_n = zeta_n
+        # With two keys or fewer every rank is chosen by comparing with zeta_n, and eta is unused
+        self._eta = (1.0 - (2.0 / keyspace) ** (1.0 - theta)) / (1.0 - zeta_2 / zeta_n) if keyspace > 2 else 0.0
+        self._half_pow_theta = 1.0 + 0.5 ** theta
+
+    def next(self, rng):
+        u = rng.random()
+        uz = u * self._zeta_n
+        if uz < 1.0:
+            rank = 0
+        elif uz < self._half_pow_theta:
+            rank = 1
+        else:
+            rank = min(self.keyspace - 1, int(self.keyspace * (self._eta * u - self._eta + 1.0) ** self._alpha))
+        return _scramble(rank) % self.keyspace
+
+
+class HotspotKeys(object):
+    '''
+    A fraction `hot_access` of the operations address the `hot_fraction` of keys at the start of the
+    keyspace, the others address the remaining keys, each set being chosen from uniformly.
+    '''
+
+    def __init__(self, keyspace, hot_fraction=0.2, hot_access=0.8):
+        self.keyspace = keyspace
+        self.hot_keys = min(keyspace, max(1, int(keyspace * hot_fraction)))
+        self.hot_access = hot_access
+
+    def next(self, rng):
+        if self.hot_keys == self.keyspace or rng.random() < self.hot_access:
+            return rng.randrange(self.hot_keys)
+        return rng.randrange(self.hot_keys, self.keyspace)
+
+
+class OperationMix(object):
+    '''Picks operations at random in proportion to their weights'''
+
+    def __init__(self, weights):
+        self.operations = [operation for operation in OPERATIONS if weights.get(operation)]
+        if not self.operations:
+            raise ValueError('The mix has no operations with a positive weight')
+        self.cumulative = list(itertools.accumulate(weights[operation] for operation in self.operations))
+
+    def next(self, rng):
+        return self.operations[bisect.bisect_right(self.cumulative, rng.random() * self.cumulative[-1])]
+
+
+class LoadGenerator(object):
+    '''
+    Runs the workload and collects its statistics
+    '''
+
+    def __init__(self, client, users, mix, keys, key_prefix, concurrency, rate=None, seed=None):
+        self.client = client
+        self.users = users
+        self.mix = mix
+        self.keys = keys
+        self.key_prefix = key_prefix
+        self.concurrency = concurrency
+        self.rate = rate
+        self.seed = seed
+        self.run_id = int(time.time())
+        self.stats = {operation: OperationStats() for operation in mix.operations}
+        self._created = itertools.count()
+        self._scheduled = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def key(self, index):
+        return '{prefix}{index}'.format(prefix=self.key_prefix, index=index)
+
+    def user(self, key):
+        return User(key, 'User {}'.format(key), '{}@example.com'.format(key), ['loadgen'])
+
+    def preload(self, keyspace):
+        '''Create the users of the keyspace, keeping any which already exist'''
+        return self.users.create_users(
+            (self.user(self.key(index)) for index in range(keyspace)), errror_if_exists=False,
+            max_in_flight=self.concurrency)
+
+    def run(self, warmup, duration, report_interval, report):
+        '''Send the workload for warmup + duration seconds
+
+        Args:
+            report (callable): Called every report_interval seconds of the measured duration with the
+                seconds measured so far, the seconds since the last call, and a LatencyHistogram per
+                operation for the operations completed since the last call.
+        Returns:
+            float: The seconds measured, up to when the last operation completed.
+        '''
+        self._started_at = time.monotonic()
+        workers = [threading.Thread(target=self._worker, args=(worker,), daemon=True)
+                   for worker in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            if warmup > 0:
+                time.sleep(warmup)
+            for stats in self.stats.values():
+                stats.reset()
+
+            measured_from = reported_at = time.monotonic()
+            end = measured_from + duration
+            while reported_at < end:
+                time.sleep(min(report_interval, end - reported_at))
+                now = time.monotonic()
+                report(now - measured_from, now - reported_at, self._take_intervals())
+                reported_at = now
+        finally:
+            self._stop.set()
+            for worker in workers:
+                worker.join()
+        # Adds the operations in flight when the duration ended to the totals
+        self._take_intervals()
+        return time.monotonic() - measured_from
+
+    def _take_intervals(self):
+        return {operation: stats.take_interval() for operation, stats in self.stats.items()}
+
+    def _worker(self, worker):
+        rng = random.Random(None if self.seed is None else self.seed + worker)
+        while not self._stop.is_set():
+            started_at = time.monotonic()
+            if self.rate:
+                with self._lock:
+                    scheduled = next(self._scheduled)
+                started_at = self._started_at + scheduled / self.rate
+                delay = started_at - time.monotonic()
+                if delay > 0 and self._stop.wait(delay):
+                    break
+
+            operation = self.mix.next(rng)
+            error = not_found = False
+            try:
+                not_found = self._send(operation, rng)
+            except RestClientAPIError:
+                error = True
+            self.stats[operation].record(time.monotonic() - started_at, error=error, not_found=not_found)
+
+    def _send(self, operation, rng):
+        '''Send one operation, returning whether the user was not found'''
+        if operation == CREATE:
+            with self._lock:
+                index = next(self._created)
+            key = '{prefix}new-{run}-{index}'.format(prefix=self.key_prefix, run=self.run_id, index=index)
+            self.users.create_user(self.user(key))
+            return False
+
+        key = self.key(self.keys.next(rng))
+        if operation == READ:
+            return self.users.get_user(key) is None
+        if operation == UPDATE:
+            self.client.update_record(self.users.namespace, self.users.setname, key,
+                                      {'name': 'User {} {}'.format(key, rng.randrange(1000000))})
+        else:
+            self.users.add_interest(key, 'interest{:02d}'.format(rng.randrange(100)))
+        return False
+
+
+def _scramble(value):
+    '''Hash a rank with 64 bit FNV-1a, so consecutive ranks map to unrelated keys'''
+    hashed = 0xcbf29ce484222325
+    for _ in range(8):
+        hashed = ((hashed ^ (value & 0xff)) * 0x100000001b3) & 0xffffffffffffffff
+        value >>= 8
+    return hashed
+
+
+def _to_ms(microseconds):
+    return None if microseconds is None else microseconds / 1000.0
+
+
+def _format_ms(value):
+    return '-' if value is None else '{:.2f}'.format(value)
+
+
+def print_interval(elapsed, interval_seconds, intervals, stream=sys.stdout):
+    for operation, histogram in sorted(intervals.items()):
+        latency = histogram.snapshot()['latency_ms']
+        print('[{elapsed:7.1f}s] {operation:<12} {rate:>9.1f} ops/s p50={p50}ms p99={p99}ms '
+              'p999={p999}ms max={max}ms'.format(
+                  elapsed=elapsed, operation=operation, rate=histogram.count / interval_seconds,
+                  p50=_format_ms(latency['p50']), p99=_format_ms(latency['p99']),
+                  p999=_format_ms(latency['p999']), max=_format_ms(latency['max'])), file=stream)
+
+
+def summarize(generator, elapsed):
+    results = {}
+    for operation, stats in sorted(generator.stats.items()):
+        snapshot = stats.total.snapshot()
+        snapshot.update({
+            'throughput_ops': snapshot['count'] / elapsed if elapsed else None,
+            'errors': stats.errors,
+            'not_found': stats.not_found,
+        })
+        results[operation] = snapshot
+    return results
+
+
+def parse_mix(value):
+    '''Parse a mix such as `read=80,update=20` into weights'''
+    weights = {}
+    for part in value.split(','):
+        if not part:
+            continue
+        operation, _, weight = part.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation {!r}, expected one of {}'.format(
+                operation, ', '.join(OPERATIONS)))
+        try:
+            weights[operation] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Invalid weight for {}: {!r}'.format(operation, weight))
+    return weights
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Generate load against the Aerospike REST client.')
+    parser.add_argument('--base-uri', help='REST client address, or comma separated addresses of several '
+                        'instances to spread requests over. By default an in process fake server is used')
+    parser.add_argument('--namespace', default='test', help='Default: test')
+    parser.add_argument('--set', dest='setname', default='loadgen', help='Default: loadgen')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('read=70,update=20,create=5,add_interest=5'),
+                        help='Comma separated operation weights. Default: read=70,update=20,create=5,add_interest=5')
+    parser.add_argument('--distribution', default=UNIFORM, choices=[UNIFORM, ZIPFIAN, HOTSPOT],
+                        help='How the users of reads, updates and interests are chosen. Default: uniform')
+    parser.add_argument('--zipfian-theta', type=float, default=0.99,
+                        help='The skew of the zipfian distribution, below 1. Default: 0.99')
+    parser.add_argument('--hot-fraction', type=float, default=0.2,
+                        help='The fraction of users which are hot, for the hotspot distribution. Default: 0.2')
+    parser.add_argument('--hot-access', type=float, default=0.8,
+                        help='The fraction of operations on hot users, for the hotspot distribution. Default: 0.8')
+    parser.add_argument('--keyspace', type=int, default=10000, help='The number of existing users. Default: 10000')
+    parser.add_argument('--key-prefix', default='loadgen-', help='The prefix of user ids. Default: loadgen-')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='Do not create the users of the keyspace before the run')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Concurrent workers, the most operations in flight. Default: 16')
+    parser.add_argument('--rate', type=float,
+                        help='Operations per second to schedule. Default: as fast as the workers allow')
+    parser.add_argument('--warmup', type=float, default=5.0, help='Seconds before measuring starts. Default: 5')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds measured. Default: 30')
+    parser.add_argument('--report-interval', type=float, default=5.0,
+                        help='Seconds between interval reports. Default: 5')
+    parser.add_argument('--seed', type=int, help='Seed the random choices, for repeatable workloads')
+    parser.add_argument('--wire-format', default=constants.JSON_WIRE_FORMAT,
+                        choices=[constants.JSON_WIRE_FORMAT, constants.MSGPACK_WIRE_FORMAT])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency injected by the fake server. Default: 0')
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help='Seconds of random extra latency injected by the fake server. Default: 0')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests failed by the fake server. Default: 0')
+    parser.add_argument('--output', help='Write the final report as JSON to this file')
+    return parser.parse_args(argv)
+
+
+def build_keys(args):
+    if args.distribution == ZIPFIAN:
+        return ZipfianKeys(args.keyspace, args.zipfian_theta)
+    if args.distribution == HOTSPOT:
+        return HotspotKeys(args.keyspace, args.hot_fraction, args.hot_access)
+    return UniformKeys(args.keyspace)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        mix = OperationMix(args.mix)
+    except ValueError as ve:
+        sys.exit(str(ve))
+    if args.distribution == ZIPFIAN and not 0 < args.zipfian_theta < 1:
+        sys.exit('--zipfian-theta must be between 0 and 1')
+
+    server = None
+    base_uri = args.base_uri
+    if base_uri is not None and ',' in base_uri:
+        base_uri = [uri for uri in base_uri.split(',') if uri]
+    if base_uri is None:
+        server = FakeRestClientServer(
+            latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate).start()
+        base_uri = server.base_uri
+
+    try:
+        with ASRestClientConnector(base_uri, pool_maxsize=args.concurrency, wire_format=args.wire_format) as client:
+            users = UserConnector(client, args.namespace, args.setname)
+            generator = LoadGenerator(client, users, mix, build_keys(args), args.key_prefix, args.concurrency,
+                                      rate=args.rate, seed=args.seed)
+            if args.preload:
+                print('Preloading {} users: {}'.format(args.keyspace, generator.preload(args.keyspace)),
+                      file=sys.stderr)
+
+            elapsed = generator.run(
+                args.warmup, args.duration, args.report_interval,
+                print_interval)
+    finally:
+        if server is not None:
+            server.stop()
+
+    results = summarize(generator, elapsed)
+    print('Summary over {:.1f}s'.format(elapsed))
+    for operation, result in results.items():
+        latency = result['latency_ms']
+        print('{operation:<12} {count:>9} ops {rate:>9.1f} ops/s errors={errors} not_found={not_found} '
+              'p50={p50}ms p99={p99}ms p999={p999}ms p9999={p9999}ms max={max}ms'.format(
+                  operation=operation, count=result['count'], rate=result['throughput_ops'] or 0,
+                  errors=result['errors'], not_found=result['not_found'],
+                  p50=_format_ms(latency['p50']), p99=_format_ms(latency['p99']),
+                  p999=_format_ms(latency['p999']), p9999=_format_ms(latency['p9999']),
+                  max=_format_ms(latency['max'])))
+
+    if args.output:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'base_uri': args.base_uri or 'fake',
+            'config': {
+                'mix': args.mix,
+                'distribution': args.distribution,
+                'zipfian_theta': args.zipfian_theta,
+                'hot_fraction': args.hot_fraction,
+                'hot_access': args.hot_access,
+                'keyspace': args.keyspace,
+                'concurrency': args.concurrency,
+                'rate': args.rate,
+                'warmup': args.warmup,
+                'duration': args.duration,
+                'seed': args.seed,
+                'wire_format': args.wire_format,
+                'latency': args.latency,
+                'latency_jitter': args.latency_jitter,
+                'error_rate': args.error_rate,
+            },
+            'elapsed_s': elapsed,
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+'''
+Import users into a set from JSONL or CSV, and export a set to JSONL or MessagePack.
+
+Input is parsed as a stream and written by several concurrent workers. Progress is checkpointed
+to a file every few seconds, and an interrupted command run again with the same arguments
+resumes from its checkpoint instead of starting over. The checkpoint is removed once the
+command completes.
+
+JSONL input has one user object per line, with `id`, `name`, `email` and `interests` fields.
+CSV input has a header row with the same columns, interests being separated by `;`.
+
+Example:
+    python rc_users_bulk.py import users.jsonl --concurrency 32
+    python rc_users_bulk.py export users.msgpack --set users
+    python rc_users_bulk.py rebuild-index --index-set users_interests
+'''
+import argparse
+import base64
+from concurrent import futures
+import csv
+import json
+import os
+import sys
+import threading
+import time
+
+import msgpack
+
+from asrestclient import constants
+from asrestclient import interestindex
+from asrestclient.restclientconnector import ASRestClientConnector
+from asrestclient.restclientconnector import RecordExistsError
+from asrestclient.user_connector import UserConnector
+from asrestclient.user import User
+
+JSONL_FORMAT = 'jsonl'
+CSV_FORMAT = 'csv'
+MSGPACK_FORMAT = 'msgpack'
+
+CSV_INTEREST_SEPARATOR = ';'
+
+
+class Checkpoint(object):
+    '''
+    The progress of a command, saved as JSON. It is written to a temporary file which then
+    replaces the checkpoint, so a crash while saving leaves the previous checkpoint intact.
+    '''
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._saved_at = time.monotonic()
+
+    def load(self):
+        '''Get the saved state, or None if there is no checkpoint'''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def due(self):
+        return time.monotonic() - self._saved_at >= self.interval
+
+    def save(self, state):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_path, self.path)
+        self._saved_at = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Progress(object):
+    '''
+    Prints the counts of a command and its rate every `interval` seconds.
+    '''
+
+    def __init__(self, label, interval, stream=sys.stderr):
+        self.label = label
+        self.interval = interval
+        self.stream = stream
+        self._started_at = time.monotonic()
+        self._reported_at = self._started_at
+        self._reported_done = 0
+
+    def report(self, done, force=False, **counts):
+        now = time.monotonic()
+        if not force and now - self._reported_at < self.interval:
+            return
+
+        recent_rate = (done - self._reported_done) / max(now - self._reported_at, 1e-9)
+        overall_rate = done / max(now - self._started_at, 1e-9)
+        details = ''.join(' {}={}'.format(name, count) for name, count in sorted(counts.items()))
+        print('{label}: {done} done ({recent:.1f}/s, {overall:.1f}/s overall){details}'.format(
+            label=self.label, done=done, recent=recent_rate, overall=overall_rate, details=details),
+            file=self.stream)
+        self._reported_at = now
+        self._reported_done = done
+
+
+class ImportState(object):
+    '''
+    The counts of an import, and the watermark: the number of input records before which
+    every record has been written or has failed, which is what is checkpointed. It is thread safe.
+    '''
+
+    def __init__(self, watermark=0, written=0, existing=0, failed=0):
+        self.watermark = watermark
+        self.written = written
+        self.existing = existing
+        self.failed = failed
+        self._completed = set()
+        self._lock = threading.Lock()
+
+    def complete(self, index, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self._completed.add(index)
+            while self.watermark in self._completed:
+                self._completed.remove(self.watermark)
+                self.watermark += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'watermark': self.watermark, 'written': self.written, 'existing': self.existing,
+                    'failed': self.failed}
+
+
+def read_users(path, input_format):
+    '''Parse users from a file one at a time. A record which cannot be parsed is yielded as the
+    ValueError describing it, so the position of every later record is unchanged.'''
+    with open(path, newline='' if input_format == CSV_FORMAT else None, encoding='utf-8') as input_file:
+        if input_format == CSV_FORMAT:
+            for row in csv.DictReader(input_file):
+                try:
+                    interests = [interest for interest in (row.get('interests') or '').split(
+                        CSV_INTEREST_SEPARATOR) if interest]
+                    yield User(_required(row, 'id'), row.get('name'), row.get('email'), interests)
+                except ValueError as ve:
+                    yield ve
+        else:
+            for line in input_file:
+                if not line.strip():
+                    continue
+                try:
+                    fields = json.loads(line)
+                    yield User(_required(fields, 'id'), fields.get('name'), fields.get('email'),
+                               fields.get('interests'))
+                except ValueError as ve:
+                    yield ve
+
+
+def import_users(user_connector, users, state, concurrency, checkpoint, progress, failures_file=None):
+    '''Create users with up to `concurrency` writes in flight, skipping the first `state.watermark`
+    users, which were completed by an earlier run'''
+    skip = state.watermark
+    # Bounds the users parsed ahead of the workers
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    failures_lock = threading.Lock()
+
+    def record_failure(user, error):
+        if failures_file is None:
+            return
+        with failures_lock:
+            failures_file.write(json.dumps({
+                'user': _user_fields(user) if user is not None else None,
+                'error': str(error)}) + '\n')
+
+    def create(index, user):
+        # Every user is completed, whatever the error, or the watermark would stop advancing
+        outcome = 'failed'
+        try:
+            user_connector.create_user(user)
+            outcome = 'written'
+        except RecordExistsError:
+            # Written by an earlier run after its last checkpoint, or already in the set
+            outcome = 'existing'
+        except Exception as ex:
+            record_failure(user, ex)
+        finally:
+            state.complete(index, outcome)
+            slots.release()
+
+    def save_checkpoint():
+        checkpoint.save(dict(state.snapshot(), command='import'))
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for index, user in enumerate(users):
+                if index < skip:
+                    continue
+
+                if isinstance(user, ValueError):
+                    record_failure(None, user)
+                    state.complete(index, 'failed')
+                else:
+                    slots.acquire()
+                    executor.submit(create, index, user)
+
+                counts = state.snapshot()
+                progress.report(counts['watermark'] - skip, written=counts['written'],
+                                existing=counts['existing'], failed=counts['failed'])
+                if checkpoint.due():
+                    save_checkpoint()
+    finally:
+        # The executor has waited for the writes in flight, so the watermark covers them
+        save_checkpoint()
+
+    counts = state.snapshot()
+    progress.report(counts['watermark'] - skip, force=True, written=counts['written'],
+                    existing=counts['existing'], failed=counts['failed'])
+
+
+def export_set(client, namespace, setname, output_path, output_format, page_size, state, checkpoint, progress):
+    '''Write every record of a set to a file, continuing from the cursor and file offset of state'''
+    cursor = state.get('cursor')
+    exported = state.get('exported', 0)
+    skipped = exported
+
+    # Data written after the last checkpoint is discarded, as its records are fetched again
+    with open(output_path, 'r+b' if cursor and os.path.exists(output_path) else 'wb') as output:
+        output.seek(state.get('offset', 0))
+        output.truncate()
+
+        def save_checkpoint(records):
+            output.flush()
+            os.fsync(output.fileno())
+            checkpoint.save({'command': 'export', 'cursor': records.cursor, 'offset': output.tell(),
+                             'exported': exported})
+
+        with client.scan(namespace, setname, page_size=page_size, cursor=cursor) as records:
+            try:
+                for record in records:
+                    output.write(encode_record(record['bins'], output_format))
+                    exported += 1
+                    progress.report(exported - skipped)
+                    if checkpoint.due():
+                        save_checkpoint(records)
+            finally:
+                save_checkpoint(records)
+
+    progress.report(exported - skipped, force=True, total=exported)
+
+
+def encode_record(bins, output_format):
+    if output_format == MSGPACK_FORMAT:
+        return msgpack.packb(bins, use_bin_type=True)
+    return (json.dumps(bins, default=_encode_bytes) + '\n').encode('utf-8')
+
+
+def _encode_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError('Cannot encode {!r} as JSON'.format(value))
+
+
+def _user_fields(user):
+    return {'id': user.id, 'name': user.name, 'email': user.email, 'interests': user.interests}
+
+
+def _required(fields, name):
+    value = fields.get(name)
+    if value in (None, ''):
+        raise ValueError('Missing {!r} in {!r}'.format(name, fields))
+    return value
+
+
+def _format_from_path(path, choices):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return extension if extension in choices else None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Import users into, and export records from, an Aerospike set.')
+    parser.add_argument('--base-uri', default='http://localhost:8080',
+                        help='REST client address, or comma separated addresses. Default: http://localhost:8080')
+    parser.add_argument('--namespace', default='test', help='Default: test')
+    parser.add_argument('--set', dest='setname', default='users', help='Default: users')
+    parser.add_argument('--checkpoint', help='Checkpoint file. Default: the data file name with .checkpoint appended')
+    parser.add_argument('--checkpoint-interval', type=float, default=10.0,
+                        help='Seconds between checkpoints. Default: 10')
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help='Seconds between progress reports. Default: 5')
+    parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint and start over')
+    parser.add_argument('--index-set',
+                        help='Set of the interest index, which import keeps up to date when given. '
+                             'Default for rebuild-index: the set name with _interests appended')
+    parser.add_argument('--index-buckets', type=int, default=interestindex.DEFAULT_BUCKETS,
+                        help='Index records per interest. Default: {}'.format(interestindex.DEFAULT_BUCKETS))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='Create users from a JSONL or CSV file')
+    import_parser.add_argument('input', help='The file to import')
+    import_parser.add_argument('--format', choices=[JSONL_FORMAT, CSV_FORMAT],
+                               help='Default: from the file extension, else jsonl')
+    import_parser.add_argument('--concurrency', type=int, default=16, help='Concurrent writes. Default: 16')
+    import_parser.add_argument('--failures', help='Write the users which failed to this JSONL file')
+
+    export_parser = commands.add_parser('export', help='Write every record of the set to a JSONL or MessagePack file')
+    export_parser.add_argument('output', help='The file to write')
+    export_parser.add_argument('--format', choices=[JSONL_FORMAT, MSGPACK_FORMAT],
+                               help='Default: from the file extension, else jsonl')
+    export_parser.add_argument('--page-size', type=int, default=1000, help='Records per scan request. Default: 1000')
+
+    rebuild_parser = commands.add_parser('rebuild-index',
+                                         help='Rebuild the interest index from every user of the set')
+    rebuild_parser.add_argument('--page-size', type=int, default=1000, help='Users per scan request. Default: 1000')
+    rebuild_parser.add_argument('--concurrency', type=int, default=16,
+                                help='Concurrent index record writes. Default: 16')
+    return parser.parse_args(argv)
+
+
+def rebuild_index(args, base_uri):
+    '''Replace the interest index with one built from a scan of the set'''
+    with ASRestClientConnector(base_uri, pool_maxsize=args.concurrency) as client:
+        index = interestindex.InterestIndex(client, args.namespace, args.index_set or args.setname + '_interests',
+                                            buckets=args.index_buckets)
+        user_connector = UserConnector(client, args.namespace, args.setname, interest_index=index)
+        progress = Progress('rebuild-index', args.progress_interval)
+        counts = user_connector.rebuild_interest_index(page_size=args.page_size, max_in_flight=args.concurrency)
+    progress.report(counts['users'], force=True, records=counts['records'], deleted=counts['deleted'])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    base_uri = args.base_uri.split(',') if ',' in args.base_uri else args.base_uri
+    if args.command == 'rebuild-index':
+        # A rebuild is not resumable, as the index is built in memory before being written
+        rebuild_index(args, base_uri)
+        return
+
+    data_path = args.input if args.command == 'import' else args.output
+    checkpoint = Checkpoint(args.checkpoint or data_path + '.checkpoint', args.checkpoint_interval)
+
+    saved = None if args.restart else checkpoint.load()
+    if saved is not None:
+        if saved.get('command') != args.command:
+            sys.exit('{} is a checkpoint of an {}, pass --restart to ignore it'.format(
+                checkpoint.path, saved.get('command')))
+        print('Resuming from {}'.format(checkpoint.path), file=sys.stderr)
+
+    if args.command == 'import':
+        input_format = args.format or _format_from_path(args.input, [CSV_FORMAT]) or JSONL_FORMAT
+        saved = saved or {}
+        state = ImportState(saved.get('watermark', 0), saved.get('written', 0), saved.get('existing', 0),
+                            saved.get('failed', 0))
+
+        with ASRestClientConnector(base_uri, pool_maxsize=args.concurrency) as client:
+            index = None
+            if args.index_set:
+                index = interestindex.InterestIndex(
+                    client, args.namespace, args.index_set, buckets=args.index_buckets)
+            user_connector = UserConnector(client, args.namespace, args.setname, interest_index=index)
+            failures_file = open(args.failures, 'a', encoding='utf-8') if args.failures else None
+            try:
+                import_users(user_connector, read_users(args.input, input_format), state, args.concurrency,
+                             checkpoint, Progress('import', args.progress_interval), failures_file)
+            finally:
+                if failures_file is not None:
+                    failures_file.close()
+    else:
+        output_format = args.format or _format_from_path(args.output, [MSGPACK_FORMAT]) or JSONL_FORMAT
+        # MessagePack keeps bytes bins as bytes, rather than base64 strings
+        wire_format = constants.MSGPACK_WIRE_FORMAT if output_format == MSGPACK_FORMAT else constants.JSON_WIRE_FORMAT
+
+        with ASRestClientConnector(base_uri, wire_format=wire_format) as client:
+            export_set(client, args.namespace, args.setname, args.output, output_format, args.page_size,
+                       saved or {}, checkpoint, Progress('export', args.progress_interval))
+
+    checkpoint.remove()
+
+
+if __name__ == '__main__':
+    main()